@@ -4,6 +4,7 @@
 
 from typing import (
     Any,
+    Callable,
     Dict,
     Iterable,
     List,
@@ -15,6 +16,7 @@ from typing import (
     TypeVar,
     Union,
 )
+from functools import lru_cache
 from xml.etree import ElementTree as ET
 
 import defusedxml.ElementTree
@@ -66,6 +68,18 @@ def to_camel_case(name: str) -> str:
     return re.sub("([a-z0-9])([A-Z])", r"\1_\2", sub1).lower()
 
 
+# Property names repeat across every object of a listing, so the regexes
+# only run once per distinct name
+_cached_camel_case = lru_cache(maxsize=4096)(to_camel_case)
+
+
+@lru_cache(maxsize=4096)
+def _element_key(namespaced_tag: str) -> str:
+    """Get Python property key for a child element not in a class' table."""
+    return to_camel_case(split_namespace_tag(namespaced_tag)[1])
+
+
+@lru_cache(maxsize=4096)
 def didl_property_key(didl_property_name: str) -> str:
     """Get Python property key for a DIDL property name."""
     if ":" in didl_property_name:
@@ -78,6 +92,7 @@ def didl_property_key(didl_property_name: str) -> str:
     return to_camel_case(didl_property_name.replace("@", "_"))
 
 
+@lru_cache(maxsize=4096)
 def didl_property_def_key(didl_property_def: Tuple[str, ...]) -> str:
     """Get Python property key for didl_property_def."""
     if didl_property_def[1].startswith("@"):
@@ -86,6 +101,73 @@ def didl_property_def_key(didl_property_def: Tuple[str, ...]) -> str:
     return to_camel_case(didl_property_def[1].replace("@", "_"))
 
 
+def _row_getter(
+    source: Union[str, Callable[[Mapping[str, Any]], Any]]
+) -> Callable[[Mapping[str, Any]], Any]:
+    """Get a function returning a property's value from a row."""
+    if callable(source):
+        return source
+    return lambda row: row.get(source)
+
+
+def _constant(value: Any) -> Callable[[Mapping[str, Any]], Any]:
+    """Get a function returning value for any row."""
+    return lambda row: value
+
+
+# Tags looked up while parsing
+_ITEM_TAG = expand_namespace_tag("didl_lite:item")
+_CONTAINER_TAG = expand_namespace_tag("didl_lite:container")
+_RES_TAG = expand_namespace_tag("didl_lite:res")
+_DESC_TAG = expand_namespace_tag("didl_lite:desc")
+_CLASS_TAG = expand_namespace_tag("upnp:class")
+
+# Resource attributes written as res attributes, after protocolInfo
+_RES_ATTRIBUTES = (
+    ("import_uri", "importUri"),
+    ("size", "size"),
+    ("duration", "duration"),
+    ("bitrate", "bitrate"),
+    ("sample_frequency", "sampleFrequency"),
+    ("bits_per_sample", "bitsPerSample"),
+    ("nr_audio_channels", "nrAudioChannels"),
+    ("resolution", "resolution"),
+    ("color_depth", "colorDepth"),
+    ("protection", "protection"),
+)
+
+
+class _Decoder:
+    """
+    Lookup tables for one DidlObject class, derived once from its
+    didl_properties_defs: namespaced child tag -> property key, and the
+    property keys that are mandatory or get a default.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, didl_properties_defs: Sequence[Tuple[str, str, str]]) -> None:
+        """Initialize."""
+        self.element_keys = {}  # type: Dict[str, str]
+        for namespace, name, _ in didl_properties_defs:
+            element = name.partition("@")[0]
+            if element:
+                tag = expand_namespace_tag(namespace + ":" + element)
+                self.element_keys[tag] = to_camel_case(element)
+        self.required_keys = tuple(
+            dict.fromkeys(
+                didl_property_def_key(property_def)
+                for property_def in didl_properties_defs
+                if property_def[2] == "R"
+            )
+        )
+        self.default_keys = tuple(
+            dict.fromkeys(
+                didl_property_def_key(property_def)
+                for property_def in didl_properties_defs
+            )
+        )
+
 
 TDO = TypeVar("TDO", bound="DidlObject")  # pylint: disable=invalid-name
 TC = TypeVar("TC", bound="Container")  # pylint: disable=invalid-name
@@ -126,6 +208,9 @@ class DidlObject:
     xml_el: Optional[ET.Element]
     descriptors: Sequence["Descriptor"]
 
+    # Built on first use, see _get_decoder()
+    _decoder: Optional[_Decoder] = None
+
     @classmethod
     def __init_subclass__(cls: Type["DidlObject"], **kwargs: Any) -> None:
         """Create mapping of upnp_class to Python type for fast lookup."""
@@ -168,17 +253,24 @@ class DidlObject:
 
         python_property_keys = {didl_property_key(key) for key in properties}
 
-        for property_def in self.didl_properties_defs:
-            key = didl_property_def_key(property_def)
-            if property_def[2] == "R" and key not in python_property_keys:
+        for key in self._get_decoder().required_keys:
+            if key not in python_property_keys:
                 raise DidlLiteException(key + " is mandatory")
 
     def _set_property_defaults(self) -> None:
         """Ensure we have default/known slots, and set them all to None."""
-        for property_def in self.didl_properties_defs:
-            key = didl_property_def_key(property_def)
+        for key in self._get_decoder().default_keys:
             setattr(self, key, None)
 
+    @classmethod
+    def _get_decoder(cls) -> _Decoder:
+        """Get the lookup tables for this class, building them on first use."""
+        decoder = cls.__dict__.get("_decoder")
+        if decoder is None:
+            decoder = _Decoder(cls.didl_properties_defs)
+            cls._decoder = decoder
+        return decoder
+
     def _set_properties(self, properties: Mapping[str, Any]) -> None:
         """Set attributes from properties."""
         for key, value in properties.items():
@@ -191,45 +283,115 @@ class DidlObject:
 
         I.e., parse XML and return instance.
         """
-        # pylint: disable=too-many-locals
-        properties = {}  # type: Dict[str, Any]
+        element_keys = cls._get_decoder().element_keys
 
         # attributes
-        for attr_key, attr_value in xml_el.attrib.items():
-            key = to_camel_case(attr_key)
-            properties[key] = attr_value
+        properties = {
+            _cached_camel_case(attr_key): attr_value
+            for attr_key, attr_value in xml_el.attrib.items()
+        }  # type: Dict[str, Any]
 
-        # child-nodes
+        # child-nodes, resources and descriptors, in one pass
+        resources = []
+        descriptors = []
         for xml_child_node in xml_el:
-            if xml_child_node.tag == expand_namespace_tag("didl_lite:res"):
+            tag = xml_child_node.tag
+            if tag == _RES_TAG:
+                resources.append(Resource.from_xml(xml_child_node))
                 continue
+            if tag == _DESC_TAG:
+                descriptors.append(Descriptor.from_xml(xml_child_node))
 
-            _, tag = split_namespace_tag(xml_child_node.tag)
-            key = to_camel_case(tag)
-            value = xml_child_node.text
-            properties[key] = value
+            key = element_keys.get(tag) or _element_key(tag)
+            properties[key] = xml_child_node.text
 
             # attributes of child nodes
-            parent_key = key
             for attr_key, attr_value in xml_child_node.attrib.items():
-                key = parent_key + "_" + to_camel_case(attr_key)
-                properties[key] = attr_value
+                properties[key + "_" + _cached_camel_case(attr_key)] = attr_value
 
-        # resources
-        resources = []
-        for res_el in xml_el.findall("./didl_lite:res", NAMESPACES):
-            resource = Resource.from_xml(res_el)
-            resources.append(resource)
         properties["res"] = properties["resources"] = resources
 
-        # descriptors
-        descriptors = []
-        for desc_el in xml_el.findall("./didl_lite:desc", NAMESPACES):
-            descriptor = Descriptor.from_xml(desc_el)
-            descriptors.append(descriptor)
-
         return cls(xml_el=xml_el, descriptors=descriptors, strict=strict, **properties)
 
+    @classmethod
+    def from_rows(
+        cls: Type[TDO],
+        rows: Iterable[Mapping[str, Any]],
+        fields: Mapping[str, Union[str, Callable[[Mapping[str, Any]], Any]]],
+        strict: bool = True,
+        **shared: Any,
+    ) -> List[TDO]:
+        """
+        Initialize one instance per row, e.g. per entry of a JSON listing.
+
+        fields maps property names to the key of the row holding the value,
+        or to a callable taking the row. shared properties are the same for
+        every instance. The result is the same as calling
+        cls(**shared, **properties) per row, but the property names are
+        validated and resolved only once for the whole batch.
+        """
+        # pylint: disable=too-many-locals
+        decoder = cls._get_decoder()
+        getters = {
+            name: _row_getter(fields[name]) if name in fields else _constant(value)
+            for name, value in {**shared, **dict.fromkeys(fields)}.items()
+        }
+        absent = _constant(None)
+        res_getter = getters.get("res", absent)
+        resources_getter = getters.get("resources", absent)
+
+        # The properties __init__ would set, in the order it sets them
+        property_names = [
+            name for name in getters if name not in ("id", "parent_id", "resources")
+        ]
+        property_names = list(
+            dict.fromkeys(property_names + ["id", "parent_id", "class", "res"])
+        )
+        if strict:
+            python_property_keys = {didl_property_key(key) for key in property_names}
+            for key in decoder.required_keys:
+                if key not in python_property_keys:
+                    raise DidlLiteException(key + " is mandatory")
+
+        # Resolve each property to the attribute __setattr__ would store it
+        # in, filling a template of the instance's __dict__
+        template = dict.fromkeys(decoder.default_keys)  # type: Dict[str, Any]
+        row_getters = {}  # type: Dict[str, Callable[[Mapping[str, Any]], Any]]
+        for name in property_names:
+            attr = name
+            if name not in template:
+                cleaned_name = didl_property_key(name)
+                if cleaned_name in template:
+                    attr = cleaned_name
+            row_getters.pop(attr, None)
+            if name == "class":
+                template[attr] = cls.upnp_class
+            elif name in fields:
+                template[attr] = None
+                row_getters[attr] = getters[name]
+            elif name in shared:
+                template[attr] = shared[name]
+            else:
+                # Unset id and parent_id; res is set per row below
+                template[attr] = ""
+        template["xml_el"] = None
+        template["descriptors"] = None
+        row_getters.pop("xml_el", None)
+        row_getters.pop("descriptors", None)
+        getter_items = list(row_getters.items())
+
+        instances = []
+        for row in rows:
+            state = template.copy()
+            for attr, getter in getter_items:
+                state[attr] = getter(row)
+            state["res"] = res_getter(row) or resources_getter(row) or []
+            state["descriptors"] = []
+            instance = cls.__new__(cls)
+            instance.__dict__.update(state)
+            instances.append(instance)
+        return instances
+
     def to_xml(self) -> ET.Element:
         """Convert self to XML Element."""
         assert self.tag is not None
@@ -1039,6 +1201,10 @@ class Resource:
         attribs = {
             "protocolInfo": self.protocol_info or "",
         }
+        for key, attrib in _RES_ATTRIBUTES:
+            value = getattr(self, key)
+            if value is not None:
+                attribs[attrib] = str(value)
         res_el = ET.Element("res", attribs)
         res_el.text = self.uri
         return res_el
@@ -1145,19 +1311,17 @@ def from_xml_el(
 
     # items and containers, in order
     for child_el in xml_el:
-        if child_el.tag != expand_namespace_tag(
-            "didl_lite:item"
-        ) and child_el.tag != expand_namespace_tag("didl_lite:container"):
+        if child_el.tag != _ITEM_TAG and child_el.tag != _CONTAINER_TAG:
             continue
 
         # construct item
-        upnp_class = child_el.find("./upnp:class", NAMESPACES)
+        upnp_class = child_el.find(_CLASS_TAG)
         if upnp_class is None or not upnp_class.text:
             if strict:
                 continue
             # WiiM Pro and possibly other Linkplay devices emit
             # upnp_class above the item element instead of inside it
-            upnp_class = xml_el.find("./upnp:class", NAMESPACES)
+            upnp_class = xml_el.find(_CLASS_TAG)
             if upnp_class is None or not upnp_class.text:
                 continue
         didl_object_type = type_by_upnp_class(upnp_class.text, strict)
@@ -1169,7 +1333,7 @@ def from_xml_el(
         didl_objects.append(didl_object)
 
     # descriptors
-    for desc_el in xml_el.findall("./didl_lite:desc", NAMESPACES):
+    for desc_el in xml_el.findall(_DESC_TAG):
         desc = Descriptor.from_xml(desc_el)
         didl_objects.append(desc)
 
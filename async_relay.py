@@ -0,0 +1,278 @@
+import time
+import asyncio
+
+import event_log
+from async_upstream import UpstreamError, open_stream
+from stream_relay import (
+    CHUNK_SIZE,
+    JOIN_AHEAD,
+    LINGER,
+    READ_AHEAD,
+    RING_SIZE,
+    REFUSED_STATUSES,
+    UPSTREAM_TIMEOUT,
+    FellBehind,
+    RelayError,
+)
+
+
+class AsyncSharedStream:
+    """
+    The event loop counterpart of stream_relay.SharedStream: one upstream
+    fetch of a (video, format) from a byte offset, written into a ring buffer
+    that its viewers read at their own pace. Everything runs on one loop, so
+    no locking is needed; waiters are woken through a replaceable Event.
+    """
+
+    def __init__(self, relay, key, start):
+        self.relay = relay
+        self.key = key
+        # Resolved by the fetch task, off the loop as it may call upstream
+        self.url = None
+        self.start = start
+        self.ring = bytearray(RING_SIZE)
+        # Absolute offsets: [base, end) is held in the ring
+        self.base = start
+        self.end = start
+        self.total_length = None
+        self.content_type = None
+        self.done = False
+        self.error = None
+        self.ready = asyncio.Event()
+        self._changed = asyncio.Event()
+        # viewer id -> absolute position
+        self.positions = {}
+        # Furthest position any viewer has reached
+        self.leader = start
+        self.idle_since = time.monotonic()
+        self.task = None
+
+    def covers(self, pos):
+        """Whether a viewer at pos can be served from this fetch."""
+        if self.error or (self.done and pos >= self.end):
+            return False
+        return self.base <= pos <= self.end + JOIN_AHEAD
+
+    def attach(self, viewer_id, pos):
+        self.positions[viewer_id] = pos
+        self.leader = max(self.leader, pos)
+        self._wake()
+
+    def detach(self, viewer_id):
+        self.positions.pop(viewer_id, None)
+        if not self.positions:
+            self.idle_since = time.monotonic()
+        self._wake()
+
+    async def read(self, viewer_id, pos, size):
+        """Return up to size bytes at pos, waiting for upstream if needed."""
+        while pos >= self.end and not self.done and not self.error:
+            if not await self._wait(UPSTREAM_TIMEOUT):
+                raise RelayError("upstream stalled")
+        if pos < self.base:
+            raise FellBehind(pos)
+        if self.error and pos >= self.end:
+            raise RelayError(self.error)
+        size = min(size, self.end - pos)
+        offset = pos % RING_SIZE
+        if offset + size <= RING_SIZE:
+            data = bytes(self.ring[offset : offset + size])
+        else:
+            head = RING_SIZE - offset
+            data = bytes(self.ring[offset:]) + bytes(self.ring[: size - head])
+        self.positions[viewer_id] = pos + len(data)
+        self.leader = max(self.leader, pos + len(data))
+        self._wake()
+        return data
+
+    def _wake(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def _wait(self, timeout):
+        """Wait for any change to the stream, returning False on timeout."""
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _write(self, data):
+        # Don't run more than READ_AHEAD past the fastest viewer. Not reading
+        # upstream meanwhile lets TCP flow control slow it down.
+        while self.end - self.leader >= READ_AHEAD:
+            await self._wait(1)
+            if self._idle_too_long():
+                return False
+        offset = self.end % RING_SIZE
+        head = min(len(data), RING_SIZE - offset)
+        self.ring[offset : offset + head] = data[:head]
+        self.ring[: len(data) - head] = data[head:]
+        self.end += len(data)
+        self.base = max(self.base, self.end - RING_SIZE)
+        self._wake()
+        return not self._idle_too_long()
+
+    def _idle_too_long(self):
+        return not self.positions and time.monotonic() - self.idle_since > LINGER
+
+    async def _fetch(self):
+        response = None
+        try:
+            headers = {"Range": f"bytes={self.start}-"} if self.start else {}
+            response = await self._open(headers)
+            self.content_type = response.headers.get("Content-Type")
+            self.total_length = _total_length(response)
+            # Upstream ignored the Range header, so skip up to our start
+            skip = self.start if response.status == 200 else 0
+            self.ready.set()
+            while True:
+                chunk = await response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if skip:
+                    dropped = min(skip, len(chunk))
+                    chunk, skip = chunk[dropped:], skip - dropped
+                if chunk and not await self._write(chunk):
+                    break
+        except asyncio.CancelledError:
+            self.error = "relay stopped"
+            raise
+        except (UpstreamError, ValueError) as e:
+            self.error = str(e)
+            event_log.log(
+                "stream", video_id=self.key[0], itag=self.key[1], error=str(e)
+            )
+        finally:
+            if response is not None:
+                response.close()
+            self.done = True
+            self.ready.set()
+            self._wake()
+            self.relay._remove(self)
+
+    async def _open(self, headers):
+        """
+        The upstream response, resolving the URL once more if upstream
+        refused it or its instance couldn't be reached.
+        """
+        loop = asyncio.get_running_loop()
+        for retry in (False, True):
+            self.url = await loop.run_in_executor(
+                None, self.relay.resolve_url, *self.key
+            )
+            try:
+                return await open_stream(self.url, headers, UPSTREAM_TIMEOUT)
+            except UpstreamError as e:
+                # No status: the instance couldn't be reached
+                if retry or e.status not in (None,) + REFUSED_STATUSES:
+                    raise
+                reason = str(e)
+            event_log.log(
+                "stream", video_id=self.key[0], itag=self.key[1], reresolve=reason
+            )
+            self.relay.invalidate_url(self.key[0])
+
+
+class AsyncRelayReader:
+    """A viewer's cursor into the shared fetches of one (video, format)."""
+
+    def __init__(self, relay, key, stream, pos):
+        self.relay = relay
+        self.key = key
+        self.stream = stream
+        self.pos = pos
+        stream.attach(id(self), pos)
+
+    @property
+    def total_length(self):
+        return self.stream.total_length
+
+    @property
+    def content_type(self):
+        return self.stream.content_type
+
+    async def wait_ready(self):
+        """Wait for upstream response headers, raising RelayError on failure."""
+        try:
+            await asyncio.wait_for(self.stream.ready.wait(), UPSTREAM_TIMEOUT)
+        except asyncio.TimeoutError as err:
+            raise RelayError("upstream timed out") from err
+        if self.stream.error:
+            raise RelayError(self.stream.error)
+
+    async def read(self, size=CHUNK_SIZE):
+        """Return the next chunk, or b"" at the end of the stream."""
+        while True:
+            try:
+                data = await self.stream.read(id(self), self.pos, size)
+            except FellBehind:
+                # Too slow for the shared buffer; continue on our own fetch
+                self.stream.detach(id(self))
+                self.stream = self.relay._start(self.key, self.pos)
+                self.stream.attach(id(self), self.pos)
+                continue
+            self.pos += len(data)
+            return data
+
+    def close(self):
+        self.stream.detach(id(self))
+
+
+class AsyncStreamRelay:
+    """
+    stream_relay.StreamRelay for the asyncio server: viewers of the same
+    (video, format) at nearby positions share one upstream fetch, which is
+    a task on the event loop instead of a thread.
+    """
+
+    def __init__(self, resolve_url, invalidate_url=None):
+        # (video_id, itag) -> url
+        self.resolve_url = resolve_url
+        # video_id -> None, forgetting the URLs upstream refused
+        self.invalidate_url = invalidate_url or (lambda video_id: None)
+        # (video_id, itag) -> running AsyncSharedStreams
+        self._streams = {}
+
+    def open(self, video_id, itag, start=0):
+        """Attach a new viewer at byte offset start."""
+        key = (video_id, itag)
+        stream = next((s for s in self._streams.get(key, ()) if s.covers(start)), None)
+        if stream is None:
+            stream = self._start(key, start)
+        return AsyncRelayReader(self, key, stream, start)
+
+    def stop(self):
+        """Cancel every upstream fetch."""
+        for streams in list(self._streams.values()):
+            for stream in streams:
+                stream.task.cancel()
+
+    def active_keys(self):
+        """
+        The (video_id, itag) keys being fetched from upstream. Called from
+        other threads; copying the keys is a single step under the GIL.
+        """
+        return list(self._streams)
+
+    def _start(self, key, start):
+        stream = AsyncSharedStream(self, key, start)
+        self._streams.setdefault(key, []).append(stream)
+        stream.task = asyncio.get_running_loop().create_task(stream._fetch())
+        return stream
+
+    def _remove(self, stream):
+        streams = self._streams.get(stream.key, [])
+        if stream in streams:
+            streams.remove(stream)
+        if not streams:
+            self._streams.pop(stream.key, None)
+
+
+def _total_length(response):
+    content_range = response.headers.get("Content-Range", "")
+    if "/" in content_range and not content_range.endswith("*"):
+        return int(content_range.rsplit("/", 1)[1])
+    if response.status == 200 and "Content-Length" in response.headers:
+        return int(response.headers["Content-Length"])
+    return None
@@ -0,0 +1,378 @@
+import io
+import socket
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import event_log
+import soap
+import ssdp
+from async_relay import AsyncStreamRelay
+from dlna import (
+    CHUNK_SIZE,
+    KEEPALIVE_TIMEOUT,
+    DLNAHttpRequestHandler,
+    DLNAServer,
+    _parse_range,
+    _stream_features,
+    _time_seek_header,
+)
+from stream_relay import RelayError
+
+# Threads running control requests (SOAP, GENA, description) off the loop
+CONTROL_THREADS = 8
+# Largest request line plus headers accepted
+MAX_HEADER_SIZE = 64 * 1024
+
+
+class BufferedRequestHandler(DLNAHttpRequestHandler):
+    """
+    Runs the threaded handler's routes for a request the event loop has
+    already read, collecting the response in memory. Control, eventing and
+    description responses are small, so both server modes share one
+    implementation of them; only streaming is done natively on the loop.
+    """
+
+    def __init__(self, server, client_address, head, requests_served):
+        self.server = server
+        self.client_address = client_address
+        self.requests_served = requests_served
+        self.connection = None
+        self.close_connection = True
+        self.wfile = io.BytesIO()
+        request_line, _, header_block = head.partition(b"\r\n")
+        self.raw_requestline = request_line + b"\r\n"
+        self.rfile = io.BytesIO(header_block)
+        # Sends the error response itself when the request is malformed
+        self.parsed = self.parse_request()
+
+    def run(self):
+        """Handle the request and return the response bytes."""
+        method = getattr(self, "do_" + self.command, None)
+        if method is None:
+            self.send_error(501, f"Unsupported method ({self.command!r})")
+        else:
+            method()
+        return self.take_output()
+
+    def take_output(self):
+        """Return and clear what has been written so far."""
+        data = self.wfile.getvalue()
+        self.wfile = io.BytesIO()
+        return data
+
+
+class SSDPProtocol(asyncio.DatagramProtocol):
+    """Datagram endpoint the ssdp:alive announcements are sent from."""
+
+    def error_received(self, exc):
+        event_log.log("error", ssdp="broadcast", error=str(exc))
+
+
+class AsyncDLNAServer(DLNAServer):
+    """
+    The DLNA HTTP service, SSDP announcements and upstream media fetches on
+    a single asyncio event loop. Each renderer connection is a task rather
+    than a thread, and streams are paced end to end: the relay only reads
+    upstream as fast as its fastest viewer drains its socket.
+
+    Control requests run the threaded handler's code on a small thread pool,
+    as MediaStore may still block on upstream listing fetches.
+    """
+
+    request_handler_class = BufferedRequestHandler
+
+    def __init__(self, host="0.0.0.0", port=8000):
+        super().__init__(host, port)
+        self.loop = None
+        self._stopped = None
+        self._connections = set()
+        self._executor = ThreadPoolExecutor(
+            max_workers=CONTROL_THREADS, thread_name_prefix="control"
+        )
+
+    def create_stream_relay(self):
+        from media_store import stream_urls
+
+        relay = AsyncStreamRelay(stream_urls.get, stream_urls.invalidate)
+        stream_urls.playing = relay.active_keys
+        return relay
+
+    def start(self, announce=True):
+        """Run the event loop in a background thread, returning once it listens."""
+        ready = threading.Event()
+        self.thread = threading.Thread(
+            target=asyncio.run, args=(self.serve(announce, ready),), daemon=True
+        )
+        self.thread.start()
+        ready.wait()
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._stopped.set)
+            self.thread.join(timeout=5)
+
+    async def serve(self, announce=True, ready=None):
+        """Serve until stop() is called, optionally announcing over SSDP."""
+        self.loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        server = await asyncio.start_server(
+            self._handle_connection,
+            self.host,
+            self.port,
+            limit=MAX_HEADER_SIZE,
+            reuse_address=True,
+        )
+        self.events.start()
+        tasks = [self.loop.create_task(self._announce())] if announce else []
+        print(
+            f"DLNA HTTP Service running at http://{self._get_local_ip()}:{self.port}"
+            " (asyncio)"
+        )
+        if ready is not None:
+            ready.set()
+        threading.Thread(target=self.warm_up, daemon=True).start()
+        try:
+            await self._stopped.wait()
+        finally:
+            server.close()
+            pending = tasks + list(self._connections)
+            for task in pending:
+                task.cancel()
+            if self.stream_relay:
+                self.stream_relay.stop()
+            await asyncio.gather(*pending, return_exceptions=True)
+            self.events.stop()
+            self._executor.shutdown(wait=False)
+            if self.chunk_cache:
+                print(self.chunk_cache.report())
+            event_log.flush()
+            print("DLNA HTTP Service stopped.")
+
+    async def _announce(self):
+        """Send ssdp:alive every ANNOUNCE_INTERVAL seconds."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+        sock.setblocking(False)
+        transport, _ = await self.loop.create_datagram_endpoint(SSDPProtocol, sock=sock)
+        location = f"http://{ssdp.get_local_ip()}:{self.port}/description.xml"
+        print("SSDP Broadcaster started.")
+        try:
+            while True:
+                for msg in ssdp.alive_messages(location, self.server_uuid):
+                    transport.sendto(msg, (ssdp.MCAST_GRP, ssdp.MCAST_PORT))
+                await asyncio.sleep(ssdp.ANNOUNCE_INTERVAL)
+        finally:
+            transport.close()
+            print("SSDP Broadcaster stopped.")
+
+    async def _handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        client_address = writer.get_extra_info("peername")
+        requests_served = 0
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(
+                        reader.readuntil(b"\r\n\r\n"), KEEPALIVE_TIMEOUT
+                    )
+                except (
+                    asyncio.TimeoutError,
+                    asyncio.IncompleteReadError,
+                    asyncio.LimitOverrunError,
+                ):
+                    return
+                handler = self.request_handler_class(
+                    self, client_address, head, requests_served
+                )
+                if handler.parsed:
+                    await self._handle_request(handler, reader, writer)
+                else:
+                    writer.write(handler.take_output())
+                    await writer.drain()
+                requests_served = handler.requests_served
+                if handler.close_connection:
+                    return
+        except (
+            ConnectionError,
+            RelayError,
+            asyncio.IncompleteReadError,
+            asyncio.TimeoutError,
+        ):
+            # Renderer went away or stalled, or upstream failed mid-body
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _handle_request(self, handler, reader, writer):
+        try:
+            length = int(handler.headers.get("Content-Length", 0))
+        except ValueError:
+            length = 0
+        body = b""
+        if 0 < length <= soap.MAX_REQUEST_SIZE:
+            body = await asyncio.wait_for(reader.readexactly(length), KEEPALIVE_TIMEOUT)
+        handler.rfile = io.BytesIO(body)
+
+        if handler.command == "GET" and handler.path.startswith("/stream/"):
+            await self._serve_stream(handler, writer)
+        else:
+            response = await self.loop.run_in_executor(self._executor, handler.run)
+            writer.write(response)
+            await writer.drain()
+        if length > soap.MAX_REQUEST_SIZE:
+            # The body was left unread, so the next request can't be found
+            handler.close_connection = True
+
+    async def _serve_stream(self, handler, writer):
+        """The asyncio counterpart of DLNAHttpRequestHandler._serve_stream."""
+        from media_store import keyframe_index, prefetch_keyframe_index, stream_urls
+
+        url = urlsplit(handler.path)
+        video_id = url.path.rpartition("/")[2]
+        itag = parse_qs(url.query).get("itag", ["18"])[0]
+        byte_range = _parse_range(handler.headers.get("Range"))
+        start, last = byte_range or (0, None)
+        if not await asyncio.to_thread(handler._wait_until_ready, True):
+            handler.send_error(503)
+            writer.write(handler.take_output())
+            await writer.drain()
+            return
+
+        cache_key = f"{video_id}-{itag}"
+        cached = self.chunk_cache.get(cache_key)
+        npt = None
+        if "TimeSeekRange.dlna.org" in handler.headers:
+            # Building the index may read upstream
+            time_seek = await self.loop.run_in_executor(
+                self._executor,
+                handler._time_seek,
+                keyframe_index,
+                video_id,
+                itag,
+                cached,
+            )
+            if time_seek is None:
+                writer.write(handler.take_output())
+                await writer.drain()
+                return
+            (start, last, npt), byte_range = time_seek, None
+        elif start == 0:
+            prefetch_keyframe_index(video_id, itag, cached)
+        reader = None
+        if cached is not None:
+            total, content_type = cached.total_length, cached.content_type
+        else:
+            reader = self.stream_relay.open(video_id, itag, start)
+            try:
+                await reader.wait_ready()
+            except RelayError as e:
+                reader.close()
+                event_log.log("stream", video_id=video_id, itag=itag, error=str(e))
+                handler.send_error(502)
+                writer.write(handler.take_output())
+                await writer.drain()
+                return
+            total, content_type = reader.total_length, reader.content_type
+            if total is not None:
+                cached = self.chunk_cache.create(cache_key, total, content_type)
+
+        if total is not None:
+            # Listed in the res element from now on, cached or relayed
+            stream_urls.record_details(video_id, itag, size=total)
+            if start >= total:
+                if reader:
+                    reader.close()
+                handler.send_response(416)
+                handler.send_header("Content-Range", f"bytes */{total}")
+                handler.send_header("Content-Length", "0")
+                handler.end_headers()
+                writer.write(handler.take_output())
+                await writer.drain()
+                return
+            last = total - 1 if last is None else min(last, total - 1)
+        end = None if last is None else last + 1
+
+        handler.send_response(206 if byte_range else 200)
+        handler.send_header("Content-Type", content_type or "video/mp4")
+        handler.send_header("Accept-Ranges", "bytes")
+        handler._send_dlna_headers(_stream_features(itag)[0], "Streaming")
+        if end is None:
+            # Unknown length: the end of the body is the end of the connection
+            handler.close_connection = True
+        else:
+            handler.send_header("Content-Length", str(end - start))
+        if byte_range and total is not None:
+            handler.send_header("Content-Range", f"bytes {start}-{last}/{total}")
+        if npt is not None:
+            handler.send_header(
+                "TimeSeekRange.dlna.org", _time_seek_header(npt, start, last, total)
+            )
+        handler.end_headers()
+        writer.write(handler.take_output())
+
+        sent_to = await self._send_stream_body(
+            writer, video_id, itag, cached, reader, start, end
+        )
+        if end is not None and sent_to < end:
+            # Upstream ended short of what we promised
+            handler.close_connection = True
+
+    async def _send_stream_body(self, writer, video_id, itag, cached, reader, pos, end):
+        """Write [pos, end) of a stream, returning the offset reached."""
+        if cached is not None:
+            self.chunk_cache.acquire(cached)
+        acquired = cached
+        try:
+            while end is None or pos < end:
+                fetch_end = end
+                if cached is not None:
+                    run = cached.cached_length(pos, end)
+                    if run:
+                        try:
+                            f = open(cached.data_path, "rb")
+                        except OSError:
+                            # Evicted by another worker; relay the rest
+                            cached = None
+                            continue
+                        with f:
+                            await self.loop.sendfile(writer.transport, f, pos, run)
+                        self.chunk_cache.record(from_cache=run)
+                        pos += run
+                        continue
+                    fetch_end = cached.missing_end(pos, end)
+
+                # Fetch only up to the next cached block
+                if reader is None or reader.pos != pos:
+                    if reader is not None:
+                        reader.close()
+                    reader = self.stream_relay.open(video_id, itag, pos)
+                block_writer = cached.writer(pos) if cached is not None else None
+                fetched = 0
+                try:
+                    while fetch_end is None or pos < fetch_end:
+                        size = CHUNK_SIZE
+                        if fetch_end is not None:
+                            size = min(size, fetch_end - pos)
+                        chunk = await reader.read(size)
+                        if not chunk:
+                            return pos
+                        writer.write(chunk)
+                        # Don't read further ahead than the renderer takes
+                        await writer.drain()
+                        if block_writer is not None and block_writer.add(chunk):
+                            # Whole blocks are written to disk, off the loop
+                            await asyncio.to_thread(block_writer.flush)
+                        pos += len(chunk)
+                        fetched += len(chunk)
+                finally:
+                    self.chunk_cache.record(from_upstream=fetched)
+            return pos
+        finally:
+            if reader is not None:
+                reader.close()
+            if acquired is not None:
+                self.chunk_cache.release(acquired)
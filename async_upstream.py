@@ -0,0 +1,167 @@
+import io
+import ssl
+import asyncio
+import http.client
+from urllib.parse import urljoin, urlsplit
+
+# Seconds allowed for connecting, and for each read, before giving up
+UPSTREAM_TIMEOUT = 30
+# Redirects followed before giving up (latest_version redirects to the CDN)
+MAX_REDIRECTS = 5
+USER_AGENT = "DLNATube"
+
+_REDIRECT_CODES = (301, 302, 303, 307, 308)
+# Built once: creating a context loads the CA store
+_SSL_CONTEXT = ssl.create_default_context()
+
+
+class UpstreamError(Exception):
+    """
+    Raised when an upstream request fails or returns an error status; status
+    is the HTTP status, or None when there was no response.
+    """
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class AsyncResponse:
+    """
+    The body of an upstream response, read incrementally. Handles
+    Content-Length, chunked and read-until-close bodies.
+    """
+
+    def __init__(self, status, headers, reader, writer, timeout):
+        self.status = status
+        self.headers = headers
+        self._reader = reader
+        self._writer = writer
+        self._timeout = timeout
+        self._chunked = "chunked" in headers.get("Transfer-Encoding", "").lower()
+        length = headers.get("Content-Length")
+        # Bytes left in the body (or in the current chunk); None if unknown
+        self._remaining = 0 if self._chunked else (int(length) if length else None)
+        # Whether a chunk has been started, so its trailing CRLF is pending
+        self._in_chunk = False
+        self._eof = False
+
+    async def read(self, size):
+        """Return up to size bytes of the body, or b"" at its end."""
+        if self._eof:
+            return b""
+        if self._chunked and not self._remaining:
+            self._remaining = await self._next_chunk_size()
+            if not self._remaining:
+                self._eof = True
+                return b""
+        if self._remaining is not None:
+            size = min(size, self._remaining)
+        data = await self._with_timeout(self._reader.read(size))
+        if not data:
+            if self._remaining:
+                raise UpstreamError("connection closed mid-body")
+            self._eof = True
+            return b""
+        if self._remaining is not None:
+            self._remaining -= len(data)
+            if not self._remaining and not self._chunked:
+                self._eof = True
+        return data
+
+    async def _next_chunk_size(self):
+        if self._in_chunk:
+            # CRLF after the previous chunk's data
+            await self._with_timeout(self._reader.readexactly(2))
+        line = await self._with_timeout(self._reader.readline())
+        try:
+            size = int(line.split(b";", 1)[0].strip(), 16)
+        except ValueError as err:
+            raise UpstreamError("bad chunk size") from err
+        self._in_chunk = True
+        if not size:
+            # Skip trailers up to the blank line
+            while (await self._with_timeout(self._reader.readline())).strip():
+                pass
+        return size
+
+    async def _with_timeout(self, awaitable):
+        try:
+            return await asyncio.wait_for(awaitable, self._timeout)
+        except asyncio.TimeoutError as err:
+            raise UpstreamError("upstream timed out") from err
+        except (asyncio.IncompleteReadError, OSError) as err:
+            raise UpstreamError("connection closed mid-body") from err
+
+    def close(self):
+        self._writer.close()
+
+
+async def open_stream(url, headers=None, timeout=UPSTREAM_TIMEOUT):
+    """
+    GET url and return an AsyncResponse once its headers have arrived,
+    following redirects. Raises UpstreamError for error statuses.
+    """
+    for _ in range(MAX_REDIRECTS + 1):
+        response = await _request(url, headers or {}, timeout)
+        location = response.headers.get("Location")
+        if response.status in _REDIRECT_CODES and location:
+            response.close()
+            url = urljoin(url, location)
+            continue
+        if response.status >= 400:
+            response.close()
+            raise UpstreamError(f"upstream returned {response.status}", response.status)
+        return response
+    raise UpstreamError("too many redirects")
+
+
+async def _request(url, headers, timeout):
+    parts = urlsplit(url)
+    secure = parts.scheme == "https"
+    port = parts.port or (443 if secure else 80)
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(
+                parts.hostname,
+                port,
+                ssl=_SSL_CONTEXT if secure else None,
+            ),
+            timeout,
+        )
+    except (OSError, asyncio.TimeoutError) as err:
+        raise UpstreamError(f"could not connect to {parts.hostname}: {err}") from err
+
+    target = parts.path or "/"
+    if parts.query:
+        target += "?" + parts.query
+    lines = [
+        f"GET {target} HTTP/1.1",
+        f"Host: {parts.netloc}",
+        f"User-Agent: {USER_AGENT}",
+        "Accept-Encoding: identity",
+        "Connection: close",
+    ]
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+    try:
+        await writer.drain()
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+    except (
+        OSError,
+        asyncio.TimeoutError,
+        asyncio.IncompleteReadError,
+        asyncio.LimitOverrunError,
+    ) as err:
+        writer.close()
+        raise UpstreamError(f"no response from {parts.hostname}") from err
+
+    status_line, _, header_block = head.partition(b"\r\n")
+    try:
+        status = int(status_line.split(None, 2)[1])
+    except (IndexError, ValueError) as err:
+        writer.close()
+        raise UpstreamError(f"bad status line {status_line!r}") from err
+    response_headers = http.client.parse_headers(io.BytesIO(header_block))
+    return AsyncResponse(status, response_headers, reader, writer, timeout)
@@ -0,0 +1,735 @@
+"""
+Benchmarks for the DLNA HTTP service.
+
+Usage:
+    python benchmark.py keepalive [--items 1000] [--page 50] [--rounds 20]
+    python benchmark.py workers [--workers 4] [--clients 8] [--items 1000]
+    python benchmark.py streaming [--connections 200] [--videos 4] [--size 8]
+    python benchmark.py startup [--runs 5]
+    python benchmark.py didl [--items 1000] [--runs 20]
+    python benchmark.py upstreams [--requests 300]
+    python benchmark.py json [--items 2000]
+    python benchmark.py profiler [--items 1000] [--rounds 10]
+"""
+
+import argparse
+import asyncio
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from http.server import BaseHTTPRequestHandler
+
+import json_records
+import profiler
+from ContentDirectory import Resource, VideoItem, didl_lite_to_xml, from_xml_string
+from async_relay import AsyncStreamRelay
+from async_server import AsyncDLNAServer, BufferedRequestHandler
+from catalog_store import CatalogStore
+from chunk_cache import ChunkCache
+from dlna import (
+    _parse_range,
+    DLNAHttpRequestHandler,
+    DLNAServer,
+    ThreadingHTTPServer,
+)
+from media_store import VIDEO_RESULT_FIELDS, MediaStore
+from ssdp import MCAST_GRP, MCAST_PORT
+from stream_relay import StreamRelay
+from upstream_pool import UpstreamPool
+
+BROWSE_TEMPLATE = """<?xml version="1.0" encoding="utf-8"?>
+<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
+  <s:Body>
+    <u:Browse xmlns:u="urn:schemas-upnp-org:service:ContentDirectory:1">
+      <ObjectID>bench</ObjectID>
+      <BrowseFlag>BrowseDirectChildren</BrowseFlag>
+      <Filter>*</Filter>
+      <StartingIndex>{start}</StartingIndex>
+      <RequestedCount>{count}</RequestedCount>
+      <SortCriteria>+dc:title</SortCriteria>
+    </u:Browse>
+  </s:Body>
+</s:Envelope>"""
+
+
+class SyntheticMediaStore(MediaStore):
+    """MediaStore serving a single 'bench' container of generated videos."""
+
+    def __init__(self, host_url, item_count, catalog=None):
+        self.item_count = item_count
+        super().__init__(host_url, catalog=catalog)
+
+    def _fetch_children(self, object_id, base_url):
+        if object_id != "bench":
+            return super()._fetch_children(object_id, base_url)
+        return [
+            VideoItem(
+                id=f"video{i}",
+                parent_id="bench",
+                title=f"Synthetic video {i}",
+                restricted="1",
+            )
+            for i in range(self.item_count)
+        ]
+
+
+class QuietRequestHandler(DLNAHttpRequestHandler):
+    """Request handler without per-request logging, so it is not timed."""
+
+    def log_request(self, code="-", size="-"):
+        pass
+
+
+class SyntheticServer(DLNAServer):
+    """DLNAServer serving the 'bench' container, without request logging."""
+
+    handler_class = QuietRequestHandler
+    refreshed_containers = ("bench",)
+
+    def __init__(self, *args, item_count=1000, **kwargs):
+        # Workers are started with the default; they read the listing the
+        # supervisor stored in the shared catalog
+        self.item_count = item_count
+        super().__init__(*args, **kwargs)
+
+    def create_media_store(self, host_url):
+        return SyntheticMediaStore(host_url, self.item_count, catalog=self.catalog)
+
+
+class QuietBufferedRequestHandler(BufferedRequestHandler):
+    def log_request(self, code="-", size="-"):
+        pass
+
+
+class QuietAsyncServer(AsyncDLNAServer):
+    request_handler_class = QuietBufferedRequestHandler
+
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    """Serves /video/<id> as server.video_size zero bytes, honouring Range."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        total = self.server.video_size
+        first, last = _parse_range(self.headers.get("Range")) or (0, None)
+        last = total - 1 if last is None else min(last, total - 1)
+        self.send_response(206 if self.headers.get("Range") else 200)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(last + 1 - first))
+        if self.headers.get("Range"):
+            self.send_header("Content-Range", f"bytes {first}-{last}/{total}")
+        self.end_headers()
+        self.server.fetches += 1
+        chunk = bytes(256 * 1024)
+        pos = first
+        try:
+            while pos <= last:
+                size = min(len(chunk), last + 1 - pos)
+                self.wfile.write(chunk[:size])
+                pos += size
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    An upstream instance with injected latency: answers after
+    server.delay() seconds, or with a 503 when that returns None. Requests
+    are counted in server.hits.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.hits += 1
+        delay = self.server.delay()
+        if delay is None:
+            self.send_error(503)
+            return
+        time.sleep(delay)
+        body = b"[]"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+async def _stream_client(port, path, results):
+    started = time.perf_counter()
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n".encode())
+    head = await reader.readuntil(b"\r\n\r\n")
+    first_byte = time.perf_counter() - started
+    length = int(head.lower().split(b"content-length:")[1].split(b"\r\n")[0])
+    received = 0
+    while received < length:
+        data = await reader.read(256 * 1024)
+        if not data:
+            break
+        received += len(data)
+    writer.close()
+    results.append((first_byte, received, received == length))
+
+
+async def _stream_clients(port, connections, videos):
+    results = []
+    await asyncio.gather(
+        *(
+            _stream_client(port, f"/stream/video{i % videos}?itag=18", results)
+            for i in range(connections)
+        ),
+        return_exceptions=True,
+    )
+    return results
+
+
+def bench_streaming(args):
+    upstream = ThreadingHTTPServer(("127.0.0.1", 0), FakeUpstreamHandler)
+    upstream.video_size = args.size * 1024 * 1024
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    upstream_port = upstream.server_address[1]
+
+    def resolve(video_id, itag):
+        return f"http://127.0.0.1:{upstream_port}/video/{video_id}"
+
+    print(
+        f"{args.connections} connections over {args.videos} videos "
+        f"of {args.size} MiB each"
+    )
+    for mode in ("threads", "asyncio"):
+        port = free_port()
+        if mode == "asyncio":
+            server = QuietAsyncServer("127.0.0.1", port)
+            server.stream_relay = AsyncStreamRelay(resolve)
+        else:
+            server = SyntheticServer("127.0.0.1", port)
+            server.stream_relay = StreamRelay(resolve)
+        with tempfile.TemporaryDirectory() as directory:
+            # A fresh cache, so every byte is relayed
+            server.chunk_cache = ChunkCache(directory)
+            upstream.fetches = 0
+            if mode == "asyncio":
+                server.start(announce=False)
+            else:
+                server.start()
+            try:
+                started = time.perf_counter()
+                results = asyncio.run(
+                    _stream_clients(port, args.connections, args.videos)
+                )
+                elapsed = time.perf_counter() - started
+            finally:
+                server.stop()
+        complete = sum(1 for _, _, ok in results if ok)
+        received = sum(size for _, size, _ in results)
+        first_bytes = sorted(first_byte for first_byte, _, _ in results) or [0]
+        print(
+            f"{mode:>8}: {complete}/{args.connections} complete, "
+            f"{received / elapsed / 1048576:8.1f} MiB/s, "
+            f"first byte p50 {first_bytes[len(first_bytes) // 2] * 1000:.0f} ms "
+            f"p95 {first_bytes[int(len(first_bytes) * 0.95)] * 1000:.0f} ms, "
+            f"{upstream.fetches} upstream fetches"
+        )
+    upstream.shutdown()
+
+
+def import_time(module):
+    """Cumulative import time of a module in a fresh interpreter, in seconds."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    last = result.stderr.strip().splitlines()[-1]
+    return int(last.split("|")[1]) / 1e6
+
+
+def ssdp_listener():
+    """A socket receiving the SSDP multicast group."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("", MCAST_PORT))
+    membership = struct.pack("4sl", socket.inet_aton(MCAST_GRP), socket.INADDR_ANY)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+    return sock
+
+
+def startup_once(listener, mode):
+    """
+    Start main.py and time its first ssdp:alive, the first description.xml
+    served, and the first Browse answered (once the catalog is warm).
+    """
+    port = free_port()
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "main.py", "--port", str(port), "--mode", mode],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        listener.settimeout(30)
+        while True:
+            data, _ = listener.recvfrom(4096)
+            if f":{port}/description.xml".encode() in data:
+                break
+        first_notify = time.perf_counter() - started
+
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        conn.request("GET", "/description.xml")
+        response = conn.getresponse()
+        response.read()
+        assert response.status == 200, response.status
+        description = time.perf_counter() - started
+
+        body = BROWSE_TEMPLATE.replace("bench", "0").format(start=0, count=10)
+        conn.request(
+            "POST",
+            "/ContentDirectory/control",
+            body=body.encode("utf-8"),
+            headers={
+                "SOAPACTION": '"urn:schemas-upnp-org:service:ContentDirectory:1#Browse"'
+            },
+        )
+        response = conn.getresponse()
+        response.read()
+        assert response.status == 200, response.status
+        browse = time.perf_counter() - started
+        conn.close()
+    finally:
+        process.send_signal(signal.SIGINT)
+        process.wait(timeout=10)
+    return first_notify, description, browse
+
+
+def bench_startup(args):
+    imports = min(import_time("main") for _ in range(args.runs))
+    print(f"{'import main':>24}: {imports * 1000:7.1f} ms")
+    try:
+        listener = ssdp_listener()
+    except OSError as e:
+        print(f"Can't join the SSDP multicast group: {e}")
+        return
+    with listener:
+        for mode in ("threads", "asyncio"):
+            runs = [startup_once(listener, mode) for _ in range(args.runs)]
+            # Best of the runs, each column on its own
+            for label, times in zip(
+                ("first NOTIFY", "description.xml served", "first Browse"),
+                zip(*runs),
+            ):
+                print(f"{mode + ' ' + label:>32}: {min(times) * 1000:7.1f} ms")
+
+
+def bench_didl(args):
+    """Parse a Browse result from another media server."""
+    items = [
+        VideoItem(
+            id=f"video{i}",
+            parent_id="bench",
+            title=f"Synthetic video {i}",
+            restricted="1",
+            creator=f"Channel {i % 50}",
+            genre="Music",
+            description=f"Description of video {i}",
+            res=[
+                Resource(f"http://127.0.0.1/stream/video{i}", "http-get:*:video/mp4:*")
+            ],
+        )
+        for i in range(args.items)
+    ]
+    xml = didl_lite_to_xml(*items)
+    # The first parse builds the decoder tables
+    first = time.perf_counter()
+    parsed = from_xml_string(xml)
+    first = time.perf_counter() - first
+    assert len(parsed) == args.items
+    best = float("inf")
+    for _ in range(args.runs):
+        started = time.perf_counter()
+        from_xml_string(xml)
+        best = min(best, time.perf_counter() - started)
+    print(f"{'first parse':>24}: {first * 1000:7.1f} ms")
+    print(f"{'best of ' + str(args.runs):>24}: {best * 1000:7.1f} ms")
+
+
+def stand_in(delay):
+    """Start a stand-in instance on an ephemeral port and return its URL."""
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    httpd.delay = delay
+    httpd.hits = 0
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{httpd.server_address[1]}/"
+
+
+def bench_upstreams(args):
+    rng = random.Random(1)
+    # Usually fast, but one request in ten stalls for a second
+    stalling = stand_in(lambda: 1.0 if rng.random() < 0.1 else 0.02)
+    steady = stand_in(lambda: 0.08)
+    failing = stand_in(lambda: None)
+    down = f"http://127.0.0.1:{free_port()}/"
+    for label, urls in (
+        ("single instance", [stalling]),
+        ("pool of four", [stalling, steady, failing, down]),
+    ):
+        pool = UpstreamPool(urls)
+        times = []
+        errors = 0
+        for _ in range(args.requests):
+            started = time.perf_counter()
+            try:
+                pool.get("api/v1/trending", timeout=5)
+            except Exception:
+                errors += 1
+            times.append(time.perf_counter() - started)
+        times.sort()
+        p50, p95, p99 = (times[int(len(times) * q)] for q in (0.5, 0.95, 0.99))
+        print(
+            f"{label:>24}: p50 {p50 * 1000:6.1f} ms, p95 {p95 * 1000:6.1f} ms,"
+            f" p99 {p99 * 1000:6.1f} ms, {errors} errors"
+        )
+
+
+def trending_payload(item_count):
+    """
+    A trending response shaped like Invidious' full one: every thumbnail
+    size, a long description, and the stream formats.
+    """
+    thumbnails = [
+        {
+            "quality": quality,
+            "url": f"https://i.ytimg.com/vi/VIDEO/{quality}.jpg",
+            "width": 1280,
+            "height": 720,
+        }
+        for quality in (
+            "maxres",
+            "maxresdefault",
+            "sddefault",
+            "high",
+            "medium",
+            "default",
+            "start",
+            "middle",
+            "end",
+        )
+    ]
+    formats = [
+        {
+            "url": f"https://example.invalid/videoplayback?itag={itag}&expire=0",
+            "itag": str(itag),
+            "type": 'video/mp4; codecs="avc1.4d401f"',
+            "bitrate": "1000000",
+            "clen": "12345678",
+            "resolution": "720p",
+        }
+        for itag in (18, 22, 133, 134, 135, 136, 140, 251)
+    ]
+    return [
+        {
+            "type": "video",
+            "title": f"Video number {i}",
+            "videoId": f"video{i:06d}",
+            "author": f"Channel {i % 50}",
+            "authorId": f"UC{i % 50:022d}",
+            "videoThumbnails": thumbnails,
+            "description": "A long description of the video. " * 40,
+            "descriptionHtml": "<p>A long description of the video.</p>" * 40,
+            "viewCount": 123456 + i,
+            "published": 1700000000 - i * 60,
+            "publishedText": "1 day ago",
+            "lengthSeconds": 600,
+            "liveNow": False,
+            "premium": False,
+            "isUpcoming": False,
+            "adaptiveFormats": formats,
+        }
+        for i in range(item_count)
+    ]
+
+
+def measure(func):
+    """Run func, returning (result, seconds, peak bytes allocated)."""
+    started = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - started
+    # Timed on its own, as tracing slows allocation down
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def bench_json(args):
+    payload = trending_payload(args.items)
+    full = json.dumps(payload).encode("utf-8")
+    spec = json_records.parse_fields(VIDEO_RESULT_FIELDS)
+    projected = json.dumps(json_records.project(payload, spec)).encode("utf-8")
+    del payload
+
+    def chunks(body):
+        size = json_records.READ_SIZE
+        return (body[i : i + size] for i in range(0, len(body), size))
+
+    for label, body, decode in (
+        ("json.loads, everything", full, lambda: json.loads(full)),
+        (
+            "streamed, fields ignored",
+            full,
+            lambda: json_records.decode(chunks(full), VIDEO_RESULT_FIELDS),
+        ),
+        (
+            "streamed, fields applied",
+            projected,
+            lambda: json_records.decode(chunks(projected), VIDEO_RESULT_FIELDS),
+        ),
+    ):
+        records, elapsed, peak = measure(decode)
+        assert len(records) == args.items
+        print(
+            f"{label:>26}: {len(body) / 2**20:6.1f} MiB body, {elapsed * 1000:7.1f} ms,"
+            f" {peak / 2**20:6.1f} MiB peak"
+        )
+
+
+def start_server(media_store):
+    """Start the request handler on an ephemeral localhost port."""
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), QuietRequestHandler)
+    httpd.server_uuid = uuid.uuid4()
+    httpd.media_store = media_store
+    httpd.catalog_ready = True
+    httpd.ready = threading.Event()
+    httpd.ready.set()
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+def page_through(port, item_count, page_size, rounds, keepalive):
+    """Browse every page of the container `rounds` times, returning requests/sec."""
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    requests_made = 0
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for start in range(0, item_count, page_size):
+            if not keepalive:
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port)
+            body = BROWSE_TEMPLATE.format(start=start, count=page_size)
+            conn.request(
+                "POST",
+                "/ContentDirectory/control",
+                body=body.encode("utf-8"),
+                headers={
+                    "Content-Type": 'text/xml; charset="utf-8"',
+                    "SOAPACTION": '"urn:schemas-upnp-org:service:ContentDirectory:1#Browse"',
+                },
+            )
+            response = conn.getresponse()
+            response.read()
+            assert response.status == 200, response.status
+            requests_made += 1
+    elapsed = time.perf_counter() - started
+    conn.close()
+    return requests_made / elapsed
+
+
+def bench_keepalive(args):
+    media_store = SyntheticMediaStore("http://127.0.0.1", args.items)
+    httpd = start_server(media_store)
+    port = httpd.server_address[1]
+    try:
+        # Warm the catalog and sorted permutation before timing
+        page_through(port, args.items, args.page, 1, True)
+        for keepalive in (False, True):
+            rate = page_through(port, args.items, args.page, args.rounds, keepalive)
+            label = "one connection" if keepalive else "connection per request"
+            print(f"{label:>24}: {rate:8.1f} requests/sec")
+    finally:
+        httpd.shutdown()
+
+
+def bench_profiler(args):
+    media_store = SyntheticMediaStore("http://127.0.0.1", args.items)
+    httpd = start_server(media_store)
+    port = httpd.server_address[1]
+    settings = (
+        ("off", {}),
+        ("1 in 100", {"DLNATUBE_PROFILE_EVERY": "100"}),
+        ("slower than 1 s", {"DLNATUBE_PROFILE_SLOW_MS": "1000"}),
+        (
+            "every request, stacks",
+            {"DLNATUBE_PROFILE_EVERY": "1", "DLNATUBE_PROFILE_STACKS": "1"},
+        ),
+    )
+    try:
+        page_through(port, args.items, args.page, 1, True)
+        with tempfile.TemporaryDirectory() as directory:
+            for label, environ in settings:
+                for name in list(os.environ):
+                    if name.startswith("DLNATUBE_PROFILE_"):
+                        del os.environ[name]
+                os.environ.update(environ, DLNATUBE_PROFILE_DIR=directory)
+                profiler.configure()
+                rate = page_through(port, args.items, args.page, args.rounds, True)
+                print(f"{label:>24}: {rate:8.1f} requests/sec")
+            with open(os.path.join(directory, "requests.jsonl")) as f:
+                print(f"Last profile: {f.readlines()[-1].strip()}")
+    finally:
+        httpd.shutdown()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server on port {port} did not come up")
+
+
+def _client(port, item_count, page_size, rounds):
+    return page_through(port, item_count, page_size, rounds, True)
+
+
+def load_test(port, args):
+    """Page through the container from several client processes, returning requests/sec."""
+    with multiprocessing.get_context("spawn").Pool(args.clients) as pool:
+        # Warm every worker's copy of the listing and sorted permutation
+        pool.starmap(_client, [(port, args.items, args.page, 1)] * args.clients)
+        started = time.perf_counter()
+        pool.starmap(
+            _client, [(port, args.items, args.page, args.rounds)] * args.clients
+        )
+        elapsed = time.perf_counter() - started
+    pages = -(-args.items // args.page)
+    return pages * args.rounds * args.clients / elapsed
+
+
+def bench_workers(args):
+    print(f"{args.clients} clients on {os.cpu_count()} CPUs")
+    with tempfile.TemporaryDirectory() as directory:
+        for workers in (0, args.workers):
+            port = free_port()
+            catalog = CatalogStore(os.path.join(directory, f"catalog{workers}.db"))
+            server = SyntheticServer(
+                "127.0.0.1",
+                port,
+                workers=workers,
+                catalog=catalog if workers else None,
+                item_count=args.items,
+            )
+            # The supervisor fetches the listing once; workers share it
+            server.warm_up()
+            server.media_store.browse("bench", "")
+            server.start()
+            try:
+                wait_for_port(port)
+                # Give every worker time to bind before measuring
+                time.sleep(2 if workers else 0)
+                rate = load_test(port, args)
+            finally:
+                server.stop()
+            label = f"{workers} workers" if workers else "single process"
+            print(f"{label:>24}: {rate:8.1f} requests/sec")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    keepalive = subparsers.add_parser(
+        "keepalive", help="TV paging through a container over HTTP keep-alive"
+    )
+    keepalive.add_argument("--items", type=int, default=1000)
+    keepalive.add_argument("--page", type=int, default=50)
+    keepalive.add_argument("--rounds", type=int, default=20)
+    keepalive.set_defaults(func=bench_keepalive)
+
+    workers = subparsers.add_parser(
+        "workers", help="Concurrent renderers against SO_REUSEPORT worker processes"
+    )
+    workers.add_argument("--workers", type=int, default=os.cpu_count())
+    workers.add_argument("--clients", type=int, default=8)
+    workers.add_argument("--items", type=int, default=1000)
+    workers.add_argument("--page", type=int, default=50)
+    workers.add_argument("--rounds", type=int, default=5)
+    workers.set_defaults(func=bench_workers)
+
+    streaming = subparsers.add_parser(
+        "streaming", help="Many renderers streaming at once, threads vs asyncio"
+    )
+    streaming.add_argument("--connections", type=int, default=200)
+    streaming.add_argument("--videos", type=int, default=4)
+    streaming.add_argument("--size", type=int, default=8, help="MiB per video")
+    streaming.set_defaults(func=bench_streaming)
+
+    startup = subparsers.add_parser(
+        "startup", help="Import time and time from launch to the first NOTIFY"
+    )
+    startup.add_argument("--runs", type=int, default=5)
+    startup.set_defaults(func=bench_startup)
+
+    didl = subparsers.add_parser(
+        "didl", help="Parsing a DIDL-Lite Browse result into objects"
+    )
+    didl.add_argument("--items", type=int, default=1000)
+    didl.add_argument("--runs", type=int, default=20)
+    didl.set_defaults(func=bench_didl)
+
+    upstreams = subparsers.add_parser(
+        "upstreams", help="API latency from one instance vs a hedged pool"
+    )
+    upstreams.add_argument("--requests", type=int, default=300)
+    upstreams.set_defaults(func=bench_upstreams)
+
+    json_parser = subparsers.add_parser(
+        "json", help="Decoding a large trending response, whole vs field-projected"
+    )
+    json_parser.add_argument("--items", type=int, default=2000)
+    json_parser.set_defaults(func=bench_json)
+
+    profiler_parser = subparsers.add_parser(
+        "profiler", help="Browse throughput with request profiling off and on"
+    )
+    profiler_parser.add_argument("--items", type=int, default=1000)
+    profiler_parser.add_argument("--page", type=int, default=50)
+    profiler_parser.add_argument("--rounds", type=int, default=10)
+    profiler_parser.set_defaults(func=bench_profiler)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+import os
+import time
+import pickle
+import sqlite3
+import threading
+
+# Shared catalog used by the HTTP worker processes
+CATALOG_DB = os.path.join("cache", "catalog.db")
+# Seconds a writer waits for another process holding the database lock
+BUSY_TIMEOUT = 10
+
+
+class CatalogStore:
+    """
+    Container listings shared between processes through a SQLite database,
+    so a listing fetched by one HTTP worker (or the supervisor's background
+    refresh) is reused by the others instead of being fetched again.
+
+    Each stored listing gets an update id from a single counter across all
+    containers, which doubles as the SystemUpdateID of the device.
+
+    GENA subscriptions are kept here too, so that whichever worker a
+    renewal or UNSUBSCRIBE reaches knows the subscription.
+    """
+
+    def __init__(self, path=CATALOG_DB):
+        self.path = path
+        # sqlite3 connections can't be shared between threads
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS listings ("
+                "container_id TEXT PRIMARY KEY, "
+                "fetched_at REAL NOT NULL, "
+                "update_id INTEGER NOT NULL, "
+                "items BLOB NOT NULL)"
+            )
+            # expires_at is wall clock, compared across processes; seq is
+            # the SEQ of the subscription's next event
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS subscriptions ("
+                "sid TEXT PRIMARY KEY, "
+                "service TEXT NOT NULL, "
+                "callbacks TEXT NOT NULL, "
+                "timeout INTEGER NOT NULL, "
+                "expires_at REAL NOT NULL, "
+                "seq INTEGER NOT NULL DEFAULT 0)"
+            )
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT)
+            # Readers don't block the writer and vice versa
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def clear(self):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM listings")
+            conn.execute("DELETE FROM subscriptions")
+
+    def system_update_id(self):
+        """The highest update id handed out, 0 before the first listing."""
+        return self._fetch_row("SELECT COALESCE(MAX(update_id), 0) FROM listings")[0]
+
+    def changes_since(self, update_id):
+        """(container id, update id) of listings stored after update_id, oldest first."""
+        return (
+            self._connection()
+            .execute(
+                "SELECT container_id, update_id FROM listings "
+                "WHERE update_id > ? ORDER BY update_id",
+                (update_id,),
+            )
+            .fetchall()
+        )
+
+    def update_id(self, container_id, max_age=None):
+        """
+        Return the update id of a container's listing, or None if none is
+        stored or it is older than max_age seconds.
+        """
+        row = self._fetch_row(
+            "SELECT fetched_at, update_id FROM listings WHERE container_id = ?",
+            container_id,
+        )
+        if row is None or _expired(row[0], max_age):
+            return None
+        return row[1]
+
+    def get(self, container_id, max_age=None):
+        """
+        Return (update id, children) for a container, or None if no listing
+        is stored or it is older than max_age seconds.
+        """
+        row = self._fetch_row(
+            "SELECT fetched_at, update_id, items FROM listings WHERE container_id = ?",
+            container_id,
+        )
+        if row is None or _expired(row[0], max_age):
+            return None
+        return row[1], pickle.loads(row[2])
+
+    def age(self, container_id):
+        """Seconds since a container was last stored, or None if it never was."""
+        row = self._fetch_row(
+            "SELECT fetched_at FROM listings WHERE container_id = ?", container_id
+        )
+        return None if row is None else time.time() - row[0]
+
+    def put(self, container_id, items):
+        """Store a container listing and return its new update id."""
+        blob = pickle.dumps(items, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._connection() as conn:
+            # Take the write lock before reading the counter, so two
+            # processes can't hand out the same update id
+            conn.execute("BEGIN IMMEDIATE")
+            (update_id,) = conn.execute(
+                "SELECT COALESCE(MAX(update_id), 0) + 1 FROM listings"
+            ).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)",
+                (container_id, time.time(), update_id, blob),
+            )
+        return update_id
+
+    def add_subscription(self, sid, service, callbacks, timeout):
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO subscriptions VALUES (?, ?, ?, ?, ?, 0)",
+                (sid, service, " ".join(callbacks), timeout, time.time() + timeout),
+            )
+
+    def renew_subscription(self, sid, timeout):
+        """
+        Extend a subscription by timeout seconds and return its (service,
+        callbacks), or None if it is unknown or expired.
+        """
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "DELETE FROM subscriptions WHERE sid = ? AND expires_at <= ?",
+                (sid, now),
+            )
+            row = conn.execute(
+                "SELECT service, callbacks FROM subscriptions WHERE sid = ?", (sid,)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE subscriptions SET timeout = ?, expires_at = ? WHERE sid = ?",
+                (timeout, now + timeout, sid),
+            )
+        return row[0], row[1].split()
+
+    def remove_subscription(self, sid):
+        """Drop a subscription; False if there was none."""
+        with self._connection() as conn:
+            cursor = conn.execute("DELETE FROM subscriptions WHERE sid = ?", (sid,))
+        return cursor.rowcount > 0
+
+    def subscriptions(self):
+        """(sid, service, callbacks, timeout) of every subscription, dropping expired ones."""
+        with self._connection() as conn:
+            conn.execute(
+                "DELETE FROM subscriptions WHERE expires_at <= ?", (time.time(),)
+            )
+            rows = conn.execute(
+                "SELECT sid, service, callbacks, timeout FROM subscriptions"
+            ).fetchall()
+        return [
+            (sid, service, callbacks.split(), timeout)
+            for sid, service, callbacks, timeout in rows
+        ]
+
+    def next_seq(self, sid):
+        """
+        Take the SEQ for a subscription's next event, or None if it is gone.
+        SEQ wraps to 1, 0 is reserved for the initial event.
+        """
+        with self._connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT seq FROM subscriptions WHERE sid = ?", (sid,)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE subscriptions SET seq = ? WHERE sid = ?",
+                (row[0] + 1 if row[0] < 0xFFFFFFFF else 1, sid),
+            )
+        return row[0]
+
+    def _fetch_row(self, query, *args):
+        return self._connection().execute(query, args).fetchone()
+
+
+def _expired(fetched_at, max_age):
+    # Wall clock, since the timestamp is compared across processes
+    return max_age is not None and time.time() - fetched_at >= max_age
@@ -0,0 +1,389 @@
+import os
+import re
+import fcntl
+import struct
+import threading
+
+# Where relayed media is cached between runs
+CACHE_DIR = "cache"
+# Total bytes of media kept on disk, by all worker processes together
+CACHE_BUDGET = 2 * 1024 * 1024 * 1024
+# Bytes a process stores between checks of the whole cache directory
+# against the budget; other worker processes store blocks too
+BUDGET_CHECK_INTERVAL = 64 * 1024 * 1024
+# Granularity of caching; only whole blocks are stored
+BLOCK_SIZE = 1024 * 1024
+
+# .map header: magic, total length, block size, content type length
+_MAP_MAGIC = b"DTC1"
+_MAP_HEADER = struct.Struct("<4sQIH")
+
+
+class CachedObject:
+    """
+    One relayed media object on disk: a sparse data file holding whichever
+    blocks have been fetched, and a .map file with a bitmap of those blocks.
+    """
+
+    def __init__(self, cache, key, total_length, content_type, bitmap=None):
+        self.cache = cache
+        self.key = key
+        self.total_length = total_length
+        self.content_type = content_type
+        self.block_size = cache.block_size
+        self.block_count = -(-total_length // self.block_size)
+        self.bitmap = bitmap or bytearray(-(-self.block_count // 8))
+        self.cached_blocks = sum(bin(b).count("1") for b in self.bitmap)
+        self.data_path = os.path.join(cache.directory, key + ".data")
+        self.map_path = os.path.join(cache.directory, key + ".map")
+        self.header_size = _MAP_HEADER.size + len(content_type.encode("utf-8"))
+        self.evicted = False
+        self.lock = threading.Lock()
+        # Connections sending from the data file; guarded by the cache's
+        # lock, and the object isn't evicted while there are any
+        self.readers = 0
+
+    @property
+    def cached_bytes(self):
+        return self.cached_blocks * self.block_size
+
+    def has_block(self, index):
+        return bool(self.bitmap[index >> 3] & (1 << (index & 7)))
+
+    def cached_length(self, pos, end):
+        """Number of bytes from pos (up to end) that can be served from disk."""
+        index = pos // self.block_size
+        run_end = pos
+        while run_end < end and index < self.block_count and self.has_block(index):
+            index += 1
+            run_end = index * self.block_size
+        return min(run_end, end) - pos
+
+    def missing_end(self, pos, end):
+        """Offset of the first cached byte after pos, or end if there is none."""
+        index = pos // self.block_size + 1
+        while index < self.block_count and index * self.block_size < end:
+            if self.has_block(index):
+                return index * self.block_size
+            index += 1
+        return end
+
+    def writer(self, pos):
+        return BlockWriter(self, pos)
+
+    def write_block(self, index, data):
+        """
+        Store one block and record it in the bitmap. If the files are gone,
+        evicted by another worker process, the block is dropped and so is
+        the object, as if it had never been cached.
+        """
+        with self.lock:
+            if self.evicted or self.has_block(index):
+                return
+            try:
+                # Not created here, so an evicted object isn't brought back
+                fd = os.open(self.data_path, os.O_WRONLY)
+                try:
+                    os.pwrite(fd, data, index * self.block_size)
+                finally:
+                    os.close(fd)
+                with open(self.map_path, "r+b") as f:
+                    # Only mark the block once its data is on disk
+                    byte = self.bitmap[index >> 3] | 1 << (index & 7)
+                    f.seek(self.header_size + (index >> 3))
+                    f.write(bytes((byte,)))
+            except OSError:
+                self.evicted = True
+            else:
+                self.bitmap[index >> 3] = byte
+                self.cached_blocks += 1
+        if self.evicted:
+            self.cache._forget(self)
+        else:
+            self.cache._block_added(self)
+
+    def merge_bitmap(self):
+        """Add the blocks other worker processes stored to the bitmap."""
+        try:
+            with open(self.map_path, "rb") as f:
+                f.seek(self.header_size)
+                stored = f.read(len(self.bitmap))
+        except OSError:
+            return
+        with self.lock:
+            for i, byte in enumerate(stored):
+                self.bitmap[i] |= byte
+            self.cached_blocks = sum(bin(b).count("1") for b in self.bitmap)
+
+    def touch(self):
+        try:
+            os.utime(self.map_path)
+        except OSError:
+            pass
+
+    def _create_files(self):
+        content_type = self.content_type.encode("utf-8")
+        with open(self.map_path, "wb") as f:
+            f.write(
+                _MAP_HEADER.pack(
+                    _MAP_MAGIC, self.total_length, self.block_size, len(content_type)
+                )
+            )
+            f.write(content_type)
+            f.write(self.bitmap)
+        # Sparse: size the file up front, blocks are filled in as fetched.
+        # Not truncated to zero, in case another process is writing blocks.
+        fd = os.open(self.data_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, self.total_length)
+        finally:
+            os.close(fd)
+
+    def _delete_files(self):
+        with self.lock:
+            self.evicted = True
+            for path in (self.map_path, self.data_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    @classmethod
+    def load(cls, cache, key):
+        """Read an object back from its .map file, or None if it is unusable."""
+        map_path = os.path.join(cache.directory, key + ".map")
+        with open(map_path, "rb") as f:
+            header = f.read(_MAP_HEADER.size)
+            if len(header) != _MAP_HEADER.size:
+                return None
+            magic, total_length, block_size, type_length = _MAP_HEADER.unpack(header)
+            if magic != _MAP_MAGIC or block_size != cache.block_size:
+                return None
+            content_type = f.read(type_length).decode("utf-8")
+            bitmap = bytearray(f.read())
+        obj = cls(cache, key, total_length, content_type, bitmap)
+        if len(bitmap) != -(-obj.block_count // 8):
+            return None
+        return obj
+
+
+class BlockWriter:
+    """Collects streamed bytes at block boundaries and stores whole blocks."""
+
+    def __init__(self, obj, pos):
+        self.obj = obj
+        self.pos = pos
+        self.buffer = bytearray()
+        block_size = obj.block_size
+        # Bytes before the first block boundary can't form a whole block
+        self.skip = -pos % block_size
+        self.index = -(-pos // block_size)
+
+    def feed(self, data):
+        if self.add(data):
+            self.flush()
+
+    def add(self, data):
+        """Buffer data without writing; True if flush() has blocks to write."""
+        self.pos += len(data)
+        if self.skip:
+            dropped = min(self.skip, len(data))
+            data = data[dropped:]
+            self.skip -= dropped
+        self.buffer += data
+        return self._block_ready()
+
+    def flush(self):
+        """Write the whole blocks buffered, and the last one once complete."""
+        block_size = self.obj.block_size
+        while self._block_ready():
+            block = bytes(self.buffer[:block_size])
+            del self.buffer[:block_size]
+            self.obj.write_block(self.index, block)
+            self.index += 1
+
+    def _block_ready(self):
+        return len(self.buffer) >= self.obj.block_size or bool(
+            self.buffer and self.pos >= self.obj.total_length
+        )
+
+
+class ChunkCache:
+    """
+    Size-bounded on-disk cache of relayed media, kept in whole blocks so a
+    partially watched video can be resumed from disk and only the missing
+    blocks fetched. Least recently used objects are evicted to stay within
+    budget. The cache is rebuilt from the .map files on start.
+
+    Worker processes share the directory and its budget: every
+    BUDGET_CHECK_INTERVAL bytes stored, a process takes the directory's
+    lock file, catches up with the objects and blocks the others stored,
+    and evicts until all of them fit.
+    """
+
+    def __init__(self, directory=CACHE_DIR, budget=CACHE_BUDGET, block_size=BLOCK_SIZE):
+        self.directory = directory
+        self.budget = budget
+        self.block_size = block_size
+        self._objects = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_from_cache = 0
+        self.bytes_from_upstream = 0
+        # Bytes stored since the directory was last checked against the budget
+        self._unchecked = 0
+        os.makedirs(directory, exist_ok=True)
+        self._lock_path = os.path.join(directory, ".lock")
+        self._load()
+
+    def get(self, key):
+        with self._lock:
+            obj = self._objects.get(_safe_key(key))
+        if obj is not None:
+            obj.touch()
+        return obj
+
+    def create(self, key, total_length, content_type):
+        """Return the cache entry for key, creating an empty one if needed."""
+        key = _safe_key(key)
+        with self._lock:
+            obj = self._objects.get(key)
+            if obj is None:
+                # Another worker process may have started caching it
+                obj = self._load_one(key)
+                if obj is not None:
+                    self._objects[key] = obj
+            if obj is None or obj.total_length != total_length:
+                if obj is not None:
+                    obj._delete_files()
+                obj = CachedObject(self, key, total_length, content_type or "")
+                obj._create_files()
+                self._objects[key] = obj
+        return obj
+
+    def acquire(self, obj):
+        """Note that obj is being read, keeping it from eviction until release()."""
+        with self._lock:
+            obj.readers += 1
+
+    def release(self, obj):
+        with self._lock:
+            obj.readers -= 1
+
+    def record(self, from_cache=0, from_upstream=0):
+        """Count bytes served to a renderer from disk or from upstream."""
+        with self._lock:
+            if from_cache:
+                self.hits += 1
+                self.bytes_from_cache += from_cache
+            if from_upstream:
+                self.misses += 1
+                self.bytes_from_upstream += from_upstream
+
+    def stats(self):
+        total = self.bytes_from_cache + self.bytes_from_upstream
+        return {
+            "objects": len(self._objects),
+            "cached_bytes": sum(o.cached_bytes for o in self._objects.values()),
+            "hit_ratio": self.bytes_from_cache / total if total else 0.0,
+            "bytes_saved": self.bytes_from_cache,
+        }
+
+    def report(self):
+        stats = self.stats()
+        return (
+            f"Media cache: {stats['objects']} objects, "
+            f"{stats['cached_bytes'] / 1048576:.0f} MiB on disk, "
+            f"hit ratio {stats['hit_ratio']:.1%}, "
+            f"{stats['bytes_saved'] / 1048576:.0f} MiB saved"
+        )
+
+    def _forget(self, obj):
+        with self._lock:
+            if self._objects.get(obj.key) is obj:
+                del self._objects[obj.key]
+
+    def _block_added(self, obj):
+        with self._lock:
+            self._unchecked += obj.block_size
+            if (
+                self._unchecked < BUDGET_CHECK_INTERVAL
+                and sum(o.cached_bytes for o in self._objects.values()) <= self.budget
+            ):
+                return
+            self._unchecked = 0
+        with open(self._lock_path, "a") as lock_file:
+            # One process at a time sizes up the directory and evicts
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._sync()
+            with self._lock:
+                self._evict_locked(obj)
+
+    def _sync(self):
+        """Catch up with the objects and blocks other worker processes stored."""
+        keys = {
+            name[: -len(".map")]
+            for name in os.listdir(self.directory)
+            if name.endswith(".map")
+        }
+        with self._lock:
+            for key in list(self._objects):
+                if key not in keys:
+                    # Evicted by another process
+                    del self._objects[key]
+            objects = list(self._objects.values())
+            new_keys = keys - self._objects.keys()
+        for obj in objects:
+            obj.merge_bitmap()
+        for key in new_keys:
+            obj = self._load_one(key)
+            if obj is not None:
+                with self._lock:
+                    self._objects.setdefault(key, obj)
+
+    def _evict_locked(self, obj):
+        used = sum(o.cached_bytes for o in self._objects.values())
+        if used <= self.budget:
+            return
+        # Evict least recently used objects, never the one being filled
+        # nor one being read
+        by_age = sorted(
+            (o for o in self._objects.values() if o is not obj and not o.readers),
+            key=_last_used,
+        )
+        for victim in by_age:
+            if used <= self.budget:
+                break
+            used -= victim.cached_bytes
+            del self._objects[victim.key]
+            victim._delete_files()
+
+    def _load(self):
+        for name in os.listdir(self.directory):
+            if not name.endswith(".map"):
+                continue
+            key = name[: -len(".map")]
+            obj = self._load_one(key)
+            if obj is not None:
+                self._objects[key] = obj
+
+    def _load_one(self, key):
+        try:
+            obj = CachedObject.load(self, key)
+        except (OSError, ValueError, struct.error):
+            return None
+        if obj is None or not os.path.exists(obj.data_path):
+            return None
+        return obj
+
+
+def _safe_key(key):
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", key)
+
+
+def _last_used(obj):
+    try:
+        return os.path.getmtime(obj.map_path)
+    except OSError:
+        return 0
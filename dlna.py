@@ -1,17 +1,73 @@
 import os
+import sys
+import time
+import signal
 import platform
 import uuid
 import mimetypes
 import threading
 import socket
-import xml.etree.ElementTree as ET
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
 
-import ContentDirectory
-from media_store import MediaStore
+import event_log
+import gena
+import mp4_index
+import profiler
+import renderers
+import soap
+from catalog_store import CatalogStore
+from chunk_cache import ChunkCache
+from stream_relay import RelayError, StreamRelay
 
 WEB_DIR = "web"
 
+# Worker mode: seconds between checks that every HTTP worker is alive
+SUPERVISE_INTERVAL = 1
+# Worker mode: seconds between background refreshes of the shared catalog
+REFRESH_INTERVAL = 60
+# Upstream feeds the supervisor keeps fresh for the workers
+REFRESHED_CONTAINERS = ("trending", "subscriptions")
+# Seconds a request waits for warm_up() before it is refused
+READY_TIMEOUT = 30
+
+CD_SERVICE = "urn:schemas-upnp-org:service:ContentDirectory:1"
+CM_SERVICE = "urn:schemas-upnp-org:service:ConnectionManager:1"
+
+# <eventSubURL> from description.xml -> evented service
+EVENT_PATHS = {
+    "/ContentDirectory/event": "ContentDirectory",
+    "/ConnectionManager/event": "ConnectionManager",
+}
+
+# Input arguments of the Browse action
+BROWSE_ARGS = (
+    "ObjectID",
+    "BrowseFlag",
+    "Filter",
+    "StartingIndex",
+    "RequestedCount",
+    "SortCriteria",
+)
+
+# Seconds an idle keep-alive connection is held open
+KEEPALIVE_TIMEOUT = 15
+# Seconds a media body waits on a renderer that stopped reading, as one
+# that is paused does
+STREAM_TIMEOUT = 3600
+# Requests served on one connection before the server closes it
+KEEPALIVE_MAX_REQUESTS = 1000
+# Bytes written to a renderer per write while streaming
+CHUNK_SIZE = 64 * 1024
+
+# transferMode.dlna.org values a renderer may ask for
+TRANSFER_MODES = ("Streaming", "Interactive", "Background")
+# DLNA.ORG_FLAGS of files served whole: background transfer mode and DLNA
+# 1.5, with streaming transfer mode for media and interactive for images
+STREAMING_FILE_FLAGS = f"{0x01000000 | 0x00400000 | 0x00100000:08x}" + "0" * 24
+INTERACTIVE_FILE_FLAGS = f"{0x00800000 | 0x00400000 | 0x00100000:08x}" + "0" * 24
+
 
 class DLNAHttpRequestHandler(BaseHTTPRequestHandler):
     """
@@ -19,115 +75,306 @@ class DLNAHttpRequestHandler(BaseHTTPRequestHandler):
     and GET requests for the device description.
     """
 
+    # Renderers page through Browse results in bursts, so keep the
+    # connection open between requests instead of reconnecting each time.
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; without TCP_NODELAY the
+    # body waits on the client's delayed ACK on a reused connection.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.requests_served = 0
+
+    def handle_one_request(self):
+        # The keep-alive timeout is for the wait on the next request; media
+        # bodies switch to STREAM_TIMEOUT once they start
+        self.connection.settimeout(KEEPALIVE_TIMEOUT)
+        super().handle_one_request()
+
+    def parse_request(self):
+        # After the request line arrived, so keep-alive idle time isn't counted
+        self.request_started = time.monotonic()
+        return super().parse_request()
+
+    def log_request(self, code="-", size="-"):
+        """Queue an access record when the response starts; see event_log."""
+        headers = getattr(self, "headers", None)
+        # Unset when the request line itself was refused
+        started = getattr(self, "request_started", None)
+        event_log.log(
+            "access",
+            client=self.client_address[0] if self.client_address else None,
+            method=self.command,
+            path=self.path if self.command else None,
+            status=int(code) if isinstance(code, int) else code,
+            ms=(
+                None
+                if started is None
+                else round((time.monotonic() - started) * 1000, 3)
+            ),
+            agent=headers.get("User-Agent") if headers else None,
+        )
+
+    def log_message(self, format, *args):
+        # Errors from send_error and the like, instead of stderr
+        event_log.log("http", message=format % args)
+
+    def send_response(self, code, message=None):
+        super().send_response(code, message)
+        self.requests_served += 1
+        if self.close_connection or self.requests_served >= KEEPALIVE_MAX_REQUESTS:
+            # Also sets close_connection, ending the keep-alive loop
+            self.send_header("Connection", "close")
+        else:
+            self.send_header(
+                "Keep-Alive",
+                f"timeout={KEEPALIVE_TIMEOUT}, max={KEEPALIVE_MAX_REQUESTS}",
+            )
+
     def do_POST(self):
         # The paths here should match the <controlURL> defined in description.xml
         if self.path == "/ContentDirectory/control":
             self._handle_cd_soap_request()
         elif self.path == "/ConnectionManager/control":
             self._handle_cm_soap_request()
+        elif self._read_body() is not None:
+            self.send_error(404)
+
+    def do_SUBSCRIBE(self):
+        """GENA subscribe, or renew when a SID is given."""
+        service = EVENT_PATHS.get(self.path)
+        if service is None:
+            self.send_error(404)
+            return
+        events = self.server.events
+        timeout = gena.parse_timeout(self.headers.get("TIMEOUT"))
+        sid = self.headers.get("SID")
+        callback = self.headers.get("CALLBACK")
+
+        if sid:
+            if callback or self.headers.get("NT"):
+                self.send_error(400, "SID cannot be combined with CALLBACK or NT")
+                return
+            sub = events.renew(sid, timeout)
+            if sub is None:
+                self.send_error(412)
+                return
         else:
+            callbacks = gena.parse_callbacks(callback)
+            if self.headers.get("NT") != "upnp:event" or not callbacks:
+                self.send_error(412)
+                return
+            sub = events.subscribe(service, callbacks, timeout)
+
+        self.send_response(200)
+        self.send_header("SID", sub.sid)
+        self.send_header("TIMEOUT", f"Second-{sub.timeout}")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        if not sid:
+            events.send_initial_event(sub)
+
+    def do_UNSUBSCRIBE(self):
+        if self.path not in EVENT_PATHS:
             self.send_error(404)
+            return
+        sid = self.headers.get("SID")
+        if not sid or not self.server.events.unsubscribe(sid):
+            self.send_error(412)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
 
-    def do_GET(self):
+    def do_GET(self, head=False):
         req_path = self.path.lstrip("/")
 
         # 1. Device Description XML
         if req_path == "description.xml":
-            self._serve_description()
+            self._serve_description(head)
+            return
+
+        # 2. Relayed upstream media
+        if req_path.startswith("stream/"):
+            if head:
+                self._head_stream()
+            else:
+                self._serve_stream()
             return
 
-        # 2. Static Web Assets (Icons, etc.)
+        # 3. Static Web Assets (Icons, etc.)
         web_file_path = os.path.join(WEB_DIR, req_path)
         if os.path.exists(web_file_path) and os.path.isfile(web_file_path):
-            self._serve_file(web_file_path)
+            self._serve_file(web_file_path, head)
             return
 
-        # 3. Media files / Resources
+        # 4. Media files / Resources
         if os.path.exists(req_path) and os.path.isfile(req_path):
-            self._serve_file(req_path)
+            self._serve_file(req_path, head)
         else:
             self.send_error(404)
 
-    def _handle_cd_soap_request(self):
-        """Handle Content Directory 'Browse' requests using MediaStore."""
-        length = int(self.headers.get("Content-Length", 0))
-        body = self.rfile.read(length).decode("utf-8")
+    def do_HEAD(self):
+        """
+        The headers a GET would get, from what is already known of the
+        resource: renderers send HEAD to learn a stream's length and DLNA
+        features before playing, so neither upstream nor the file is opened.
+        """
+        self.do_GET(head=True)
 
-        if "Browse" in body:
-            try:
-                # Extract the ObjectID (the folder the user is looking into)
-                root = ET.fromstring(body)
-                obj_id_node = root.find(".//ObjectID")
-                object_id = obj_id_node.text if obj_id_node is not None else "0"
-
-                # Get dynamic items from MediaStore
-                base_url = f"http://{self.headers['Host']}/"
-                (
-                    didl_xml,
-                    number_returned,
-                    total_matches,
-                ) = self.server.media_store.browse(object_id, base_url)
-
-                # Build the SOAP response
-                response = self._generate_soap_envelope(
-                    "Browse",
-                    {
-                        "Result": didl_xml,
-                        "NumberReturned": str(number_returned),
-                        "TotalMatches": str(total_matches),
-                        "UpdateID": "1",
-                    },
-                    "urn:schemas-upnp-org:service:ContentDirectory:1",
+    def _read_body(self):
+        """
+        Read the request body so the connection can be reused. None, once an
+        error is sent, if its length isn't a number or is too large to read.
+        """
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True
+            self.send_error(400, "Bad Content-Length")
+            return None
+        if length > soap.MAX_REQUEST_SIZE:
+            # Don't read it, and don't try to find the next request after it
+            self.close_connection = True
+            self.send_error(413)
+            return None
+        return self.rfile.read(length)
+
+    def _dispatch_soap(self, service_type, actions):
+        """Route a control request to its action handler by SOAPACTION header."""
+        profile = profiler.begin(self.path)
+        try:
+            self._run_soap(service_type, actions)
+        finally:
+            profiler.end(profile)
+
+    def _run_soap(self, service_type, actions):
+        with profiler.phase("parse"):
+            body = self._read_body()
+        if body is None:
+            return
+        if not self._wait_until_ready():
+            self._send_soap_fault(soap.UPnPError(soap.ACTION_FAILED))
+            return
+
+        action = None
+        try:
+            with profiler.phase("parse"):
+                requested_service, action = soap.parse_soap_action(
+                    self.headers.get("SOAPACTION")
                 )
+            profiler.annotate(action)
+            handler = actions.get(action)
+            if requested_service != service_type or handler is None:
+                raise soap.UPnPError(soap.INVALID_ACTION)
+            with profiler.phase("build"):
+                out_args = handler(self, body)
+        except soap.UPnPError as e:
+            self._send_soap_fault(e)
+            return
+        except Exception as e:
+            event_log.log("error", action=action, error=str(e))
+            self._send_soap_fault(soap.UPnPError(soap.ACTION_FAILED))
+            return
+
+        self._send_soap_response(action, service_type, out_args)
 
-                self._send_soap_response(response)
-            except Exception as e:
-                print(f"DLNA Browse Error: {e}")
-                self.send_error(500)
+    def _wait_until_ready(self, streaming=False):
+        """
+        Hold a request until warm_up() has built what it needs: the catalog,
+        or with streaming the relay and media cache. False if that took over
+        READY_TIMEOUT or failed, and the request should be refused.
+        """
+        if not self.server.ready.wait(READY_TIMEOUT):
+            return False
+        if streaming:
+            return (
+                self.server.stream_relay is not None
+                and self.server.chunk_cache is not None
+            )
+        return self.server.catalog_ready
+
+    def _handle_cd_soap_request(self):
+        self._dispatch_soap(CD_SERVICE, self.CD_ACTIONS)
 
     def _handle_cm_soap_request(self):
-        """Basic Connection Manager response."""
-        response = self._generate_soap_envelope(
-            "GetProtocolInfo",
-            {"Source": "http-get:*:*:*", "Sink": ""},
-            "urn:schemas-upnp-org:service:ConnectionManager:1",
-        )
-        self._send_soap_response(response)
-
-    def _build_didl_lite_xml(self, items):
-        """Helper to wrap ContentDirectory items into DIDL-Lite root."""
-        root = ET.Element(
-            "DIDL-Lite",
-            {
-                "xmlns": ContentDirectory.NAMESPACES["didl_lite"],
-                "xmlns:dc": ContentDirectory.NAMESPACES["dc"],
-                "xmlns:upnp": ContentDirectory.NAMESPACES["upnp"],
-                "xmlns:sec": ContentDirectory.NAMESPACES["sec"],
-            },
-        )
-        for item in items:
-            root.append(item.to_xml())
-        return ET.tostring(root, encoding="unicode")
+        self._dispatch_soap(CM_SERVICE, self.CM_ACTIONS)
 
-    def _generate_soap_envelope(self, action, args, ns):
-        """Builds a standard SOAP envelope with XML-escaped arguments."""
+    def _cd_browse(self, body):
+        """Browse a container's children, or a single object's metadata."""
+        from media_store import NoSuchObjectError
 
-        def escape_xml(v):
-            return (
-                str(v).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+        with profiler.phase("parse"):
+            args = soap.parse_arguments(body, "Browse", BROWSE_ARGS)
+        browse_flag = args["BrowseFlag"] or "BrowseDirectChildren"
+        if browse_flag not in ("BrowseDirectChildren", "BrowseMetadata"):
+            raise soap.UPnPError(soap.INVALID_ARGS, "Invalid BrowseFlag")
+        starting_index = soap.parse_uint(args, "StartingIndex")
+        requested_count = soap.parse_uint(args, "RequestedCount")
+        profiler.annotate(
+            f"Browse {args['ObjectID'] or '0'} {browse_flag} "
+            f"{starting_index}+{requested_count}"
+        )
+
+        # Get dynamic items from MediaStore
+        media_store = self.server.media_store
+        base_url = f"http://{self.headers['Host']}/"
+        try:
+            didl_xml, number_returned, total_matches = media_store.browse(
+                args["ObjectID"] or "0",
+                base_url,
+                starting_index,
+                requested_count,
+                args["SortCriteria"] or "",
+                browse_flag,
+                renderers.match_renderer(self.headers),
             )
+        except NoSuchObjectError as e:
+            raise soap.UPnPError(soap.NO_SUCH_OBJECT) from e
+
+        return {
+            "Result": didl_xml,
+            "NumberReturned": str(number_returned),
+            "TotalMatches": str(total_matches),
+            "UpdateID": str(media_store.system_update_id),
+        }
+
+    def _cd_get_system_update_id(self, body):
+        return {"Id": str(self.server.media_store.system_update_id)}
+
+    def _cd_get_search_capabilities(self, body):
+        # No Search action yet, so nothing is searchable
+        return {"SearchCaps": ""}
+
+    def _cd_get_sort_capabilities(self, body):
+        from media_store import SORT_CAPABILITIES
+
+        return {"SortCaps": SORT_CAPABILITIES}
 
-        arg_xml = "".join([f"<{k}>{escape_xml(v)}</k>" for k, v in args.items()])
-        return f"""<?xml version="1.0" encoding="utf-8"?>
-<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
-  <s:Body>
-    <u:{action}Response xmlns:u="{ns}">
-      {arg_xml}
-    </u:{action}Response>
-  </s:Body>
-</s:Envelope>"""
-
-    def _serve_description(self):
+    def _cd_get_feature_list(self, body):
+        return {"FeatureList": _read_web_file("x_featurelist.xml")}
+
+    def _cm_get_protocol_info(self, body):
+        """Advertise the formats this renderer can actually be served."""
+        renderer = renderers.match_renderer(self.headers)
+        return {"Source": ",".join(renderer.protocol_infos), "Sink": ""}
+
+    # SOAPACTION action name -> handler
+    CD_ACTIONS = {
+        "Browse": _cd_browse,
+        "GetSystemUpdateID": _cd_get_system_update_id,
+        "GetSearchCapabilities": _cd_get_search_capabilities,
+        "GetSortCapabilities": _cd_get_sort_capabilities,
+        "X_GetFeatureList": _cd_get_feature_list,
+    }
+    CM_ACTIONS = {
+        "GetProtocolInfo": _cm_get_protocol_info,
+    }
+
+    def _serve_description(self, head=False):
         """Serves the description.xml with template replacements."""
         file_path = os.path.join(WEB_DIR, "description.xml")
         if os.path.exists(file_path):
@@ -137,62 +384,647 @@ class DLNAHttpRequestHandler(BaseHTTPRequestHandler):
             # Replace template tags
             content = content.replace("{{UUID}}", str(self.server.server_uuid))
             content = content.replace("{{NODE_NAME}}", platform.node())
+            body = content.encode("utf-8")
 
             self.send_response(200)
             self.send_header("Content-type", "application/xml; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
             self.end_headers()
-            self.wfile.write(content.encode("utf-8"))
+            if not head:
+                self.wfile.write(body)
         else:
             self.send_error(404)
 
-    def _serve_file(self, file_path):
+    def _serve_file(self, file_path, head=False):
         mime_type, _ = mimetypes.guess_type(file_path)
+        mime_type = mime_type or "application/octet-stream"
+        features = _file_features(mime_type)
+        time_seek = None
+        if features and not head and "TimeSeekRange.dlna.org" in self.headers:
+            time_seek = self._time_seek(_file_keyframe_index, file_path, mime_type)
+            if time_seek is None:
+                return
         try:
-            with open(file_path, "rb") as f:
-                content = f.read()
+            if head:
+                content, length = None, os.path.getsize(file_path)
+            else:
+                with open(file_path, "rb") as f:
+                    content = f.read()
+                length = len(content)
+            if time_seek is not None:
+                first, last, npt = time_seek
+                last = length - 1 if last is None else min(last, length - 1)
+                content, total = content[first : last + 1], length
+                length = len(content)
             self.send_response(200)
-            self.send_header("Content-type", mime_type or "application/octet-stream")
-            self.send_header("Content-Length", str(len(content)))
+            self.send_header("Content-type", mime_type)
+            self.send_header("Content-Length", str(length))
+            if features:
+                # Served whole, without ranges, or from a time seek's keyframe
+                self.send_header("Accept-Ranges", "none")
+                self._send_dlna_headers(*features)
+            if time_seek is not None:
+                self.send_header(
+                    "TimeSeekRange.dlna.org", _time_seek_header(npt, first, last, total)
+                )
             self.end_headers()
-            self.wfile.write(content)
+            if content is not None:
+                self.connection.settimeout(STREAM_TIMEOUT)
+                self.wfile.write(content)
         except Exception:
             self.send_error(500)
 
-    def _send_soap_response(self, body):
+    def _send_dlna_headers(self, content_features, transfer_mode):
+        """
+        Send contentFeatures.dlna.org and transferMode.dlna.org, the mode the
+        renderer asked for if it asked for one.
+        """
+        requested = self.headers.get("transferMode.dlna.org")
+        if requested in TRANSFER_MODES:
+            transfer_mode = requested
+        self.send_header("transferMode.dlna.org", transfer_mode)
+        self.send_header("contentFeatures.dlna.org", content_features)
+
+    def _time_seek(self, index_of, *args):
+        """
+        Map the request's TimeSeekRange.dlna.org onto the keyframe index
+        index_of(*args) returns: (first byte, last byte or None, npt range),
+        starting at the keyframe at or before the start time. Sends the
+        error response and returns None when it can't be answered.
+        """
+        seek = _parse_time_seek(self.headers["TimeSeekRange.dlna.org"])
+        if seek is None:
+            self.send_error(400)
+            return None
+        try:
+            index = index_of(*args)
+        except Exception as e:
+            event_log.log("stream", path=self.path, error=str(e))
+            self.send_error(502)
+            return None
+        if index is None:
+            # Only MP4 media can be seeked by time
+            self.send_error(406)
+            return None
+        if seek[0] > index.duration:
+            self.send_error(416)
+            return None
+        start_time, first = index.seek(seek[0])
+        stop = None if seek[1] is None else index.next_after(seek[1])
+        if stop is None:
+            end_time, last = index.duration, None
+        else:
+            end_time, last = stop[0], stop[1] - 1
+        npt = f"npt={start_time:.3f}-{end_time:.3f}/{index.duration:.3f}"
+        return first, last, npt
+
+    def _head_stream(self):
+        """HEAD /stream/<videoId>?itag=<itag>, from the cache and resolved details."""
+        from media_store import stream_urls
+
+        url = urlsplit(self.path)
+        video_id = url.path.rpartition("/")[2]
+        itag = parse_qs(url.query).get("itag", ["18"])[0]
+        if not self._wait_until_ready(streaming=True):
+            self.send_error(503)
+            return
+        cached = self.server.chunk_cache.get(f"{video_id}-{itag}")
+        if cached is not None:
+            total, content_type = cached.total_length, cached.content_type
+        else:
+            total = stream_urls.details(video_id, itag).get("size")
+            content_type = None
+        content_features, mime_type = _stream_features(itag)
         self.send_response(200)
-        self.send_header("Content-Type", "text/xml; charset=utf-8")
+        self.send_header("Content-Type", content_type or mime_type)
+        self.send_header("Accept-Ranges", "bytes")
+        if total is not None:
+            self.send_header("Content-Length", str(total))
+        self._send_dlna_headers(content_features, "Streaming")
         self.end_headers()
-        self.wfile.write(body.encode("utf-8"))
+
+    def _serve_stream(self):
+        """
+        Serve /stream/<videoId>?itag=<itag>, honouring Range and
+        TimeSeekRange.dlna.org. Blocks already in the disk cache are sent
+        from there; the rest is relayed from upstream and added to the cache
+        on the way through.
+        """
+        from media_store import keyframe_index, prefetch_keyframe_index, stream_urls
+
+        url = urlsplit(self.path)
+        video_id = url.path.rpartition("/")[2]
+        itag = parse_qs(url.query).get("itag", ["18"])[0]
+        byte_range = _parse_range(self.headers.get("Range"))
+        start, last = byte_range or (0, None)
+        if not self._wait_until_ready(streaming=True):
+            self.send_error(503)
+            return
+
+        chunk_cache = self.server.chunk_cache
+        cache_key = f"{video_id}-{itag}"
+        cached = chunk_cache.get(cache_key)
+        npt = None
+        if "TimeSeekRange.dlna.org" in self.headers:
+            time_seek = self._time_seek(keyframe_index, video_id, itag, cached)
+            if time_seek is None:
+                return
+            # Answered with 200 and the bytes the times map to, not 206
+            (start, last, npt), byte_range = time_seek, None
+        elif start == 0:
+            # So that a later seek by time doesn't wait on upstream
+            prefetch_keyframe_index(video_id, itag, cached)
+        reader = None
+        if cached is not None:
+            total, content_type = cached.total_length, cached.content_type
+        else:
+            reader = self.server.stream_relay.open(video_id, itag, start)
+            try:
+                reader.wait_ready()
+            except RelayError as e:
+                reader.close()
+                event_log.log("stream", video_id=video_id, itag=itag, error=str(e))
+                self.send_error(502)
+                return
+            total, content_type = reader.total_length, reader.content_type
+            if total is not None:
+                cached = chunk_cache.create(cache_key, total, content_type)
+
+        if total is not None:
+            # Listed in the res element from now on, cached or relayed
+            stream_urls.record_details(video_id, itag, size=total)
+            if start >= total:
+                if reader:
+                    reader.close()
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{total}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            last = total - 1 if last is None else min(last, total - 1)
+        end = None if last is None else last + 1
+
+        self.send_response(206 if byte_range else 200)
+        self.send_header("Content-Type", content_type or "video/mp4")
+        self.send_header("Accept-Ranges", "bytes")
+        self._send_dlna_headers(_stream_features(itag)[0], "Streaming")
+        if end is None:
+            # Unknown length: the end of the body is the end of the connection
+            self.close_connection = True
+        else:
+            self.send_header("Content-Length", str(end - start))
+        if byte_range and total is not None:
+            self.send_header("Content-Range", f"bytes {start}-{last}/{total}")
+        if npt is not None:
+            self.send_header(
+                "TimeSeekRange.dlna.org", _time_seek_header(npt, start, last, total)
+            )
+        self.end_headers()
+
+        self.connection.settimeout(STREAM_TIMEOUT)
+        try:
+            sent_to = self._send_stream_body(video_id, itag, cached, reader, start, end)
+            if end is not None and sent_to < end:
+                # Upstream ended short of what we promised
+                self.close_connection = True
+        except (BrokenPipeError, ConnectionResetError, RelayError):
+            # Renderer went away or upstream failed mid-body
+            self.close_connection = True
+
+    def _send_stream_body(self, video_id, itag, cached, reader, pos, end):
+        """Write [pos, end) of a stream, returning the offset reached."""
+        relay = self.server.stream_relay
+        chunk_cache = self.server.chunk_cache
+        if cached is not None:
+            chunk_cache.acquire(cached)
+        acquired = cached
+        try:
+            while end is None or pos < end:
+                fetch_end = end
+                if cached is not None:
+                    run = cached.cached_length(pos, end)
+                    if run:
+                        try:
+                            f = open(cached.data_path, "rb")
+                        except OSError:
+                            # Evicted by another worker; relay the rest
+                            cached = None
+                            continue
+                        with f:
+                            self.connection.sendfile(f, pos, run)
+                        chunk_cache.record(from_cache=run)
+                        pos += run
+                        continue
+                    fetch_end = cached.missing_end(pos, end)
+
+                # Fetch only up to the next cached block
+                if reader is None or reader.pos != pos:
+                    if reader is not None:
+                        reader.close()
+                    reader = relay.open(video_id, itag, pos)
+                writer = cached.writer(pos) if cached is not None else None
+                fetched = 0
+                while fetch_end is None or pos < fetch_end:
+                    size = CHUNK_SIZE
+                    if fetch_end is not None:
+                        size = min(size, fetch_end - pos)
+                    chunk = reader.read(size)
+                    if not chunk:
+                        chunk_cache.record(from_upstream=fetched)
+                        return pos
+                    self.wfile.write(chunk)
+                    if writer is not None:
+                        writer.feed(chunk)
+                    pos += len(chunk)
+                    fetched += len(chunk)
+                chunk_cache.record(from_upstream=fetched)
+            return pos
+        finally:
+            if reader is not None:
+                reader.close()
+            if acquired is not None:
+                chunk_cache.release(acquired)
+
+    def _send_soap_fault(self, error):
+        with profiler.phase("serialize"):
+            body = soap.generate_fault(error)
+        with profiler.phase("write"):
+            self.send_response(500)
+            self.send_header("Content-Type", "text/xml; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def _send_soap_response(self, action, service_type, args):
+        with profiler.phase("serialize"):
+            fragments = soap.build_response(action, service_type, args)
+        with profiler.phase("write"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/xml; charset=utf-8")
+            self.send_header("Content-Length", str(sum(map(len, fragments))))
+            self.end_headers()
+            self._write_fragments(fragments)
+
+    def _write_fragments(self, fragments):
+        """Write body fragments with vectored sends, without joining them first."""
+        sendmsg = getattr(self.connection, "sendmsg", None)
+        if sendmsg is None:
+            self.wfile.writelines(fragments)
+            return
+        views = [memoryview(fragment) for fragment in fragments if fragment]
+        while views:
+            sent = sendmsg(views)
+            while views and sent >= len(views[0]):
+                sent -= len(views.pop(0))
+            if sent:
+                views[0] = views[0][sent:]
+
+
+def _parse_range(header):
+    """
+    Parse a single "bytes=first-[last]" Range header into (first, last).
+
+    Returns None for a missing or unsupported header, in which case the
+    whole resource is served.
+    """
+    if not header or not header.startswith("bytes="):
+        return None
+    first, sep, last = header[len("bytes=") :].partition("-")
+    if not sep or not first.strip().isdigit() or "," in last:
+        return None
+    last = last.strip()
+    if last and not last.isdigit():
+        return None
+    first = int(first)
+    last = int(last) if last else None
+    if last is not None and last < first:
+        return None
+    return first, last
+
+
+def _parse_time_seek(header):
+    """
+    Parse a TimeSeekRange.dlna.org "npt=start-[end]" header into (start,
+    end) in seconds, end None when open. Times are seconds ("83.5") or
+    H:MM:SS ("0:01:23.5"). Returns None for anything else.
+    """
+    header = header.strip()
+    if not header.startswith("npt="):
+        return None
+    first, sep, last = header[len("npt=") :].partition("-")
+    try:
+        start = _npt_seconds(first)
+        end = _npt_seconds(last) if last.strip() else None
+    except ValueError:
+        return None
+    if not sep or (end is not None and end < start):
+        return None
+    return start, end
+
+
+def _npt_seconds(value):
+    parts = value.strip().split(":")
+    if len(parts) > 3:
+        raise ValueError(value)
+    seconds = 0.0
+    for part in parts:
+        seconds = seconds * 60 + float(part)
+    if not 0 <= seconds < float("inf"):
+        raise ValueError(value)
+    return seconds
+
+
+def _time_seek_header(npt, first, last, total):
+    """TimeSeekRange.dlna.org of a response: the times, and the bytes if known."""
+    if total is None:
+        return npt
+    return f"{npt} bytes={first}-{last}/{total}"
+
+
+def _file_keyframe_index(path, mime_type):
+    """The keyframe index of a local file, rebuilt when the file changes."""
+    from media_store import keyframe_indexes
+
+    if mime_type != "video/mp4":
+        return None
+    stat = os.stat(path)
+    return keyframe_indexes.get(
+        (path, stat.st_mtime_ns, stat.st_size), mp4_index.file_reader(path)
+    )
+
+
+@lru_cache(maxsize=64)
+def _stream_features(itag):
+    """(contentFeatures.dlna.org, MIME type) of a stream format, worked out once."""
+    stream_format = renderers.FORMATS_BY_ITAG.get(itag)
+    if stream_format is None:
+        # Not one we list, but still relayed with byte ranges
+        stream_format = renderers.STREAM_FORMATS[0]._replace(dlna_profile=None)
+    return renderers.content_features(stream_format), stream_format.mime_type
+
+
+@lru_cache(maxsize=64)
+def _file_features(mime_type):
+    """
+    (contentFeatures.dlna.org, transfer mode) of a media file served whole,
+    or None for other files.
+    """
+    kind = mime_type.partition("/")[0]
+    # MP4 files can be seeked by time, through their keyframe index
+    op = "10" if mime_type == "video/mp4" else "00"
+    if kind in ("video", "audio"):
+        flags, transfer_mode = STREAMING_FILE_FLAGS, "Streaming"
+    elif kind == "image":
+        flags, transfer_mode = INTERACTIVE_FILE_FLAGS, "Interactive"
+    else:
+        return None
+    return f"DLNA.ORG_OP={op};DLNA.ORG_CI=0;DLNA.ORG_FLAGS={flags}", transfer_mode
+
+
+@lru_cache(maxsize=None)
+def _read_web_file(name):
+    with open(os.path.join(WEB_DIR, name), "r", encoding="utf-8") as f:
+        return f.read()
+
+
+class ReusePortHTTPServer(ThreadingHTTPServer):
+    """
+    ThreadingHTTPServer bound with SO_REUSEPORT, so several worker
+    processes can listen on the same port and the kernel spreads incoming
+    connections between them.
+    """
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
 
 
 class DLNAServer:
     """
     The main DLNA HTTP Service.
     Manages the web server and the virtual MediaStore.
+
+    With workers > 0 this process becomes a supervisor: it starts that many
+    HTTP worker processes sharing the port, keeps them running, and refreshes
+    the catalog they share in the background. SSDP stays with the caller.
     """
 
-    def __init__(self, host="0.0.0.0", port=8000):
+    handler_class = DLNAHttpRequestHandler
+    refreshed_containers = REFRESHED_CONTAINERS
+
+    def __init__(
+        self, host="0.0.0.0", port=8000, workers=0, server_uuid=None, catalog=None
+    ):
         self.host = host
         self.port = port
-        self.server_uuid = uuid.uuid4()
-        host_url = f"http://{self._get_local_ip()}:{self.port}"
-        self.media_store = MediaStore(host_url)
+        self.workers = workers
+        self.server_uuid = server_uuid or uuid.uuid4()
+        if workers and catalog is None:
+            # Start from an empty catalog, pickled listings may be from an
+            # older version of the code
+            catalog = CatalogStore()
+            catalog.clear()
+        self.catalog = catalog
+        # Built by warm_up(), after HTTP is already answering
+        self.media_store = None
+        self.stream_relay = None
+        self.chunk_cache = None
+        # Set by warm_up() once the catalog is built; ready is set when it
+        # ends, whether or not everything could be built
+        self.catalog_ready = False
+        self.ready = threading.Event()
+        state_providers = {
+            "ContentDirectory": self._content_directory_state,
+            "ConnectionManager": self._connection_manager_state,
+        }
+        if catalog is None:
+            self.events = gena.EventManager(state_providers)
+        else:
+            # Workers share the port, so a renewal may reach any of them
+            self.events = gena.SharedEventManager(state_providers, catalog)
         self.httpd = None
+        self.processes = []
+        self._stop_event = threading.Event()
 
-    def start(self):
-        self.httpd = HTTPServer((self.host, self.port), DLNAHttpRequestHandler)
-        # Inject properties into the server instance so the Handler can access them
-        self.httpd.server_uuid = self.server_uuid
-        self.httpd.media_store = self.media_store
+    def create_media_store(self, host_url):
+        from media_store import MediaStore, stream_urls, upstream
 
+        upstream.start()
+        stream_urls.start()
+        media_store = MediaStore(host_url, catalog=self.catalog)
+        # Workers list the subscriptions the supervisor stores in the catalog
+        if self.workers or self.catalog is None:
+            media_store.follow_subscriptions()
+        return media_store
+
+    def create_stream_relay(self):
+        from media_store import stream_urls
+
+        relay = StreamRelay(stream_urls.get, stream_urls.invalidate)
+        stream_urls.playing = relay.active_keys
+        return relay
+
+    def warm_up(self):
+        """
+        Build the catalog, relay and media cache. start() runs this in the
+        background once description.xml can be served, so the device can be
+        announced straight away; requests that need them wait for it, and
+        are refused if it fails.
+        """
+        try:
+            if self.media_store is None:
+                host_url = f"http://{self._get_local_ip()}:{self.port}"
+                self.media_store = self.create_media_store(host_url)
+                self.media_store.on_change = self.events.container_changed
+            self.catalog_ready = True
+            if self.httpd is not None:
+                self.httpd.media_store = self.media_store
+                self.httpd.catalog_ready = True
+            # Browsing works without these, so a media cache that can't be
+            # created only refuses streams
+            if self.stream_relay is None:
+                self.stream_relay = self.create_stream_relay()
+            if self.chunk_cache is None:
+                self.chunk_cache = ChunkCache()
+            if self.httpd is not None:
+                self.httpd.stream_relay = self.stream_relay
+                self.httpd.chunk_cache = self.chunk_cache
+        except Exception as e:
+            event_log.log("error", warm_up="failed", error=str(e))
+            raise
+        finally:
+            self.ready.set()
+
+    def start(self):
+        if self.workers:
+            self._start_workers()
+            return
+        self.httpd = self._create_httpd(ThreadingHTTPServer)
+        self.events.start()
         self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
         self.thread.start()
+        threading.Thread(target=self.warm_up, daemon=True).start()
         print(f"DLNA HTTP Service running at http://{self._get_local_ip()}:{self.port}")
 
     def stop(self):
+        self._stop_event.set()
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join(timeout=5)
+        self.events.stop()
+        if self.stream_relay:
+            self.stream_relay.stop()
         if self.httpd:
             self.httpd.shutdown()
-            print("DLNA HTTP Service stopped.")
+            if self.chunk_cache:
+                print(self.chunk_cache.report())
+        event_log.flush()
+        print("DLNA HTTP Service stopped.")
+
+    def run_worker(self):
+        """Serve HTTP in the foreground of a worker process until it is terminated."""
+        signal.signal(signal.SIGTERM, _exit_worker)
+        self.httpd = self._create_httpd(ReusePortHTTPServer)
+        threading.Thread(target=self.warm_up, daemon=True).start()
+        try:
+            self.httpd.serve_forever()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            self.events.stop()
+            self.httpd.server_close()
+            event_log.flush()
+            if self.stream_relay:
+                self.stream_relay.stop()
+            if self.chunk_cache:
+                print(f"Worker {os.getpid()}: {self.chunk_cache.report()}")
+
+    def _create_httpd(self, server_class):
+        # One thread per connection, so a renderer holding a keep-alive
+        # connection open does not block the others.
+        httpd = server_class((self.host, self.port), self.handler_class)
+        # Inject properties into the server instance so the Handler can access them
+        httpd.server_uuid = self.server_uuid
+        httpd.events = self.events
+        httpd.ready = self.ready
+        httpd.catalog_ready = self.catalog_ready
+        httpd.media_store = self.media_store
+        httpd.stream_relay = self.stream_relay
+        httpd.chunk_cache = self.chunk_cache
+        return httpd
+
+    def _start_workers(self):
+        import multiprocessing
+
+        # Spawned rather than forked: this process already runs threads
+        self._context = multiprocessing.get_context("spawn")
+        self.processes = [self._spawn_worker() for _ in range(self.workers)]
+        # Change events go out from here; workers only take subscriptions
+        self.events.start()
+        self.thread = threading.Thread(target=self._supervise, daemon=True)
+        self.thread.start()
+        print(
+            f"DLNA HTTP Service running at http://{self._get_local_ip()}:{self.port} "
+            f"with {self.workers} workers"
+        )
+
+    def _spawn_worker(self):
+        process = self._context.Process(
+            target=_run_worker,
+            args=(
+                type(self),
+                self.host,
+                self.port,
+                self.server_uuid,
+                self.catalog.path,
+            ),
+            daemon=True,
+        )
+        process.start()
+        return process
+
+    def _supervise(self):
+        """Restart workers that died and keep the shared catalog fresh."""
+        self.warm_up()
+        last_refresh = None
+        while not self._stop_event.wait(SUPERVISE_INTERVAL):
+            for i, process in enumerate(self.processes):
+                if not process.is_alive() and not self._stop_event.is_set():
+                    print(f"HTTP worker {process.pid} exited, restarting")
+                    self.processes[i] = self._spawn_worker()
+            now = time.monotonic()
+            if last_refresh is None or now - last_refresh >= REFRESH_INTERVAL:
+                last_refresh = now
+                self.media_store.refresh(self.refreshed_containers)
+
+    def _content_directory_state(self):
+        """Evented ContentDirectory variables, for a subscriber's initial event."""
+        if self.catalog is not None:
+            # Listings stored by any worker count, not only this one's
+            system_update_id = self.catalog.system_update_id()
+        elif self.ready.wait(READY_TIMEOUT) and self.catalog_ready:
+            system_update_id = self.media_store.system_update_id
+        else:
+            # No catalog to report on yet
+            system_update_id = 0
+        return {
+            "SystemUpdateID": system_update_id,
+            "ContainerUpdateIDs": "",
+        }
+
+    def _connection_manager_state(self):
+        """Evented ConnectionManager variables, for a subscriber's initial event."""
+        source = ",".join(
+            dict.fromkeys(
+                renderers.protocol_info(f, full=False) for f in renderers.STREAM_FORMATS
+            )
+        )
+        return {
+            "SourceProtocolInfo": source,
+            "SinkProtocolInfo": "",
+            "CurrentConnectionIDs": "0",
+        }
 
     def _get_local_ip(self):
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -201,3 +1033,15 @@ class DLNAServer:
             return s.getsockname()[0]
         finally:
             s.close()
+
+
+def _run_worker(server_class, host, port, server_uuid, catalog_path):
+    """Entry point of an HTTP worker process."""
+    server = server_class(
+        host, port, server_uuid=server_uuid, catalog=CatalogStore(catalog_path)
+    )
+    server.run_worker()
+
+
+def _exit_worker(signum, frame):
+    sys.exit(0)
@@ -0,0 +1,178 @@
+import os
+import sys
+import json
+import queue
+import random
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+
+# Records waiting for the writer beyond which new ones are dropped
+QUEUE_SIZE = 10000
+# Records written at most per write to the log
+BATCH_SIZE = 256
+# A log file is rotated when it grows past this many bytes
+MAX_BYTES = 10 * 1024 * 1024
+# Rotated files kept: log.1 is the newest, log.<BACKUPS> the oldest
+BACKUPS = 5
+# Seconds between records of how many records were dropped, when some were
+DROP_REPORT_INTERVAL = 60
+
+# Settings, read from the environment by configure() so that worker
+# processes share them
+# File the log is written to; "-" is stderr
+LOG_PATH = "-"
+# category -> fraction of its records written; the others are 1
+SAMPLE_RATES = {}
+
+# category -> records dropped because the queue was full
+dropped = Counter()
+
+_queue = queue.Queue(QUEUE_SIZE)
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def configure():
+    """
+    Read the settings from DLNATUBE_LOG (a file, or "-" for stderr) and
+    DLNATUBE_LOG_SAMPLE ("access=0.1,stream=0.5").
+    """
+    global LOG_PATH, SAMPLE_RATES
+    LOG_PATH = os.environ.get("DLNATUBE_LOG") or "-"
+    SAMPLE_RATES = {}
+    for part in (os.environ.get("DLNATUBE_LOG_SAMPLE") or "").split(","):
+        category, _, rate = part.partition("=")
+        if category.strip() and rate.strip():
+            SAMPLE_RATES[category.strip()] = float(rate)
+
+
+def log(category, **fields):
+    """
+    Queue a record for the background writer, never waiting: when the
+    queue is full the record is dropped and counted instead. It is written
+    as a JSON line with its time and category first.
+    """
+    rate = SAMPLE_RATES.get(category)
+    if rate is not None and random.random() >= rate:
+        return
+    if _writer is None:
+        _start_writer()
+    try:
+        _queue.put_nowait((datetime.now(timezone.utc), category, fields))
+    except queue.Full:
+        dropped[category] += 1
+
+
+def flush(timeout=5):
+    """Wait until the queued records have been written, for shutdown."""
+    if _writer is None:
+        return
+    done = threading.Event()
+    try:
+        _queue.put((None, None, done), timeout=timeout)
+    except queue.Full:
+        return
+    done.wait(timeout)
+
+
+def _start_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_write_loop, daemon=True)
+            _writer.start()
+
+
+def _write_loop():
+    log_file = _LogFile(LOG_PATH)
+    reported = Counter()
+    while True:
+        try:
+            batch = [_queue.get(timeout=DROP_REPORT_INTERVAL)]
+        except queue.Empty:
+            batch = []
+        while len(batch) < BATCH_SIZE:
+            try:
+                batch.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+        lines = []
+        flushed = []
+        for when, category, fields in batch:
+            if category is None:
+                # A flush() waiting for what was queued before it
+                flushed.append(fields)
+                continue
+            lines.append(_format(when, category, fields))
+        # Counted by the request threads; reported as the difference
+        new_drops = Counter(dropped)
+        new_drops.subtract(reported)
+        new_drops = +new_drops
+        if new_drops:
+            reported.update(new_drops)
+            lines.append(
+                _format(datetime.now(timezone.utc), "log", {"dropped": new_drops})
+            )
+        try:
+            log_file.write("".join(lines))
+        except OSError as e:
+            sys.stderr.write(f"Writing the log failed: {e}\n")
+        for done in flushed:
+            done.set()
+
+
+def _format(when, category, fields):
+    record = {
+        "time": when.isoformat(timespec="milliseconds"),
+        "category": category,
+    }
+    record.update(fields)
+    return json.dumps(record, default=str) + "\n"
+
+
+class _LogFile:
+    """The log, rotated by size when it is a file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.size = 0
+
+    def write(self, text):
+        if not text:
+            return
+        if self.path == "-":
+            sys.stderr.write(text)
+            sys.stderr.flush()
+            return
+        if self.file is not None and self._rotated_elsewhere():
+            self.file.close()
+            self.file = None
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+            self.size = self.file.tell()
+        self.file.write(text)
+        self.file.flush()
+        self.size += len(text)
+        if self.size >= MAX_BYTES:
+            self._rotate()
+
+    def _rotated_elsewhere(self):
+        # Worker processes share the log, and any of them may rotate it
+        try:
+            return os.stat(self.path).st_ino != os.fstat(self.file.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def _rotate(self):
+        self.file.close()
+        self.file = None
+        for i in range(BACKUPS - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if os.path.exists(self.path):
+            os.replace(self.path, f"{self.path}.1")
+
+
+configure()
@@ -0,0 +1,255 @@
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import event_log
+import soap
+
+# Subscription lifetime granted when the control point asks for "infinite"
+# or more than this
+MAX_SUBSCRIPTION_TIMEOUT = 1800
+DEFAULT_SUBSCRIPTION_TIMEOUT = 1800
+# Minimum seconds between two change events for one service (the
+# ContentDirectory spec moderates SystemUpdateID to at most 0.2 Hz)
+MODERATION_INTERVAL = 5
+# Threads delivering NOTIFY requests
+NOTIFIER_THREADS = 4
+# Seconds allowed for a subscriber to accept a NOTIFY
+NOTIFY_TIMEOUT = 5
+
+
+class Subscription:
+    """A control point subscribed to one service's events."""
+
+    def __init__(self, service, callbacks, timeout, sid=None):
+        self.sid = sid or f"uuid:{uuid.uuid4()}"
+        self.service = service
+        self.callbacks = callbacks
+        self.seq = 0
+        self.lock = threading.Lock()
+        self.renew(timeout)
+
+    def renew(self, timeout):
+        self.timeout = timeout
+        self.expires_at = time.monotonic() + timeout
+
+    @property
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+    def next_seq(self):
+        seq = self.seq
+        # SEQ wraps to 1, 0 is reserved for the initial event
+        self.seq = self.seq + 1 if self.seq < 0xFFFFFFFF else 1
+        return seq
+
+
+class EventManager:
+    """
+    GENA eventing for the UPnP services: subscription bookkeeping, the
+    initial event, and moderated change events. Changes are coalesced per
+    service and sent at most every MODERATION_INTERVAL seconds by a small
+    pool of notifier threads.
+    """
+
+    def __init__(self, state_providers):
+        # service name -> callable returning {variable: value} for all
+        # evented variables (used for the initial event)
+        self.state_providers = state_providers
+        self._subscriptions = {}
+        # service name -> {variable: value} waiting to be sent
+        self._pending = {}
+        # ContainerUpdateIDs waiting to be sent: container id -> update id
+        self._container_updates = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._pool = ThreadPoolExecutor(
+            max_workers=NOTIFIER_THREADS, thread_name_prefix="gena-notify"
+        )
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._moderation_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def subscribe(self, service, callbacks, timeout):
+        """Add a subscription and return it. The initial event is sent separately."""
+        sub = Subscription(service, callbacks, timeout)
+        with self._lock:
+            self._subscriptions[sub.sid] = sub
+        return sub
+
+    def renew(self, sid, timeout):
+        """Renew a subscription, or return None if it is unknown or expired."""
+        with self._lock:
+            sub = self._subscriptions.get(sid)
+            if sub is None or sub.expired:
+                self._subscriptions.pop(sid, None)
+                return None
+            sub.renew(timeout)
+            return sub
+
+    def unsubscribe(self, sid):
+        with self._lock:
+            return self._subscriptions.pop(sid, None) is not None
+
+    def send_initial_event(self, sub):
+        """Send every evented variable to a new subscriber (SEQ 0)."""
+        variables = self.state_providers[sub.service]()
+        self._pool.submit(self._notify, sub, _property_set(variables))
+
+    def container_changed(self, system_update_id, container_id, container_update_id):
+        """Record a ContentDirectory change; it is sent with the next batch."""
+        with self._lock:
+            self._pending.setdefault("ContentDirectory", {})[
+                "SystemUpdateID"
+            ] = system_update_id
+            self._container_updates[container_id] = container_update_id
+
+    def _moderation_loop(self):
+        while not self._stop_event.wait(MODERATION_INTERVAL):
+            self._flush()
+
+    def _flush(self):
+        subscriptions = self._current_subscriptions()
+        with self._lock:
+            if self._container_updates:
+                self._pending.setdefault("ContentDirectory", {})[
+                    "ContainerUpdateIDs"
+                ] = ",".join(
+                    f"{cid},{uid}" for cid, uid in self._container_updates.items()
+                )
+                self._container_updates = {}
+            pending, self._pending = self._pending, {}
+
+        for service, variables in pending.items():
+            body = _property_set(variables)
+            for sub in subscriptions:
+                if sub.service == service:
+                    self._pool.submit(self._notify, sub, body)
+
+    def _current_subscriptions(self):
+        """The unexpired subscriptions, dropping the others."""
+        with self._lock:
+            for sid in [s for s, sub in self._subscriptions.items() if sub.expired]:
+                del self._subscriptions[sid]
+            return list(self._subscriptions.values())
+
+    def _next_seq(self, sub):
+        return sub.next_seq()
+
+    def _notify(self, sub, body):
+        # Imported on first use, it takes longer to load than the whole server
+        import requests
+
+        # One NOTIFY at a time per subscriber, so SEQ arrives in order
+        with sub.lock:
+            seq = self._next_seq(sub)
+            if seq is None:
+                # Unsubscribed meanwhile
+                return
+            headers = {
+                "Content-Type": 'text/xml; charset="utf-8"',
+                "NT": "upnp:event",
+                "NTS": "upnp:propchange",
+                "SID": sub.sid,
+                "SEQ": str(seq),
+            }
+            for callback in sub.callbacks:
+                try:
+                    requests.request(
+                        "NOTIFY",
+                        callback,
+                        data=body,
+                        headers=headers,
+                        timeout=NOTIFY_TIMEOUT,
+                    )
+                    return
+                except requests.RequestException as e:
+                    event_log.log("gena", callback=callback, error=str(e))
+
+
+class SharedEventManager(EventManager):
+    """
+    EventManager for HTTP workers sharing one port, any of which may get a
+    subscription's renewal or UNSUBSCRIBE: subscriptions and their SEQ live
+    in the shared catalog. Change events are sent by the one process that
+    runs start(), the supervisor, from the update ids of the listings any
+    process stored in the catalog; container_changed() is ignored.
+    """
+
+    def __init__(self, state_providers, catalog):
+        super().__init__(state_providers)
+        self.catalog = catalog
+        # Highest catalog update id already sent
+        self._sent_update_id = catalog.system_update_id()
+
+    def subscribe(self, service, callbacks, timeout):
+        sub = Subscription(service, callbacks, timeout)
+        self.catalog.add_subscription(sub.sid, service, callbacks, timeout)
+        return sub
+
+    def renew(self, sid, timeout):
+        found = self.catalog.renew_subscription(sid, timeout)
+        return None if found is None else Subscription(*found, timeout, sid=sid)
+
+    def unsubscribe(self, sid):
+        return self.catalog.remove_subscription(sid)
+
+    def container_changed(self, system_update_id, container_id, container_update_id):
+        pass
+
+    def _flush(self):
+        for container_id, update_id in self.catalog.changes_since(self._sent_update_id):
+            self._sent_update_id = update_id
+            super().container_changed(update_id, container_id, update_id)
+        super()._flush()
+
+    def _current_subscriptions(self):
+        rows = self.catalog.subscriptions()
+        with self._lock:
+            # Kept between flushes for their locks, which order their NOTIFYs
+            self._subscriptions = {
+                sid: self._subscriptions.get(sid)
+                or Subscription(service, callbacks, timeout, sid=sid)
+                for sid, service, callbacks, timeout in rows
+            }
+            return list(self._subscriptions.values())
+
+    def _next_seq(self, sub):
+        return self.catalog.next_seq(sub.sid)
+
+
+def parse_callbacks(header):
+    """Split a CALLBACK header ("<url1><url2>") into its http URLs."""
+    urls = [part.strip() for part in (header or "").replace(">", "").split("<")]
+    return [url for url in urls if url.startswith("http://")]
+
+
+def parse_timeout(header):
+    """Turn a "Second-N" / "Second-infinite" TIMEOUT header into seconds."""
+    value = (header or "").strip().lower()
+    if value.startswith("second-"):
+        value = value[len("second-") :]
+        if value.isdigit():
+            return max(1, min(int(value), MAX_SUBSCRIPTION_TIMEOUT))
+        if value == "infinite":
+            return MAX_SUBSCRIPTION_TIMEOUT
+    return DEFAULT_SUBSCRIPTION_TIMEOUT
+
+
+def _property_set(variables):
+    properties = "".join(
+        f"<e:property><{name}>{soap.escape(str(value))}</{name}></e:property>"
+        for name, value in variables.items()
+    )
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        '<e:propertyset xmlns:e="urn:schemas-upnp-org:event-1-0">'
+        f"{properties}</e:propertyset>"
+    ).encode("utf-8")
@@ -0,0 +1,112 @@
+import json
+import codecs
+
+# Bytes read from a response at a time
+READ_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+# What may separate the elements of an array
+_SEPARATORS = " \t\r\n,"
+
+
+def parse_fields(fields):
+    """
+    Turn an Invidious fields= value such as "title,videos(videoId,title)"
+    into {"title": None, "videos": {"videoId": None, "title": None}}.
+    """
+    spec = {}
+    stack = [spec]
+    name = ""
+    for char in fields + ",":
+        if char == "(":
+            sub = {}
+            stack[-1][name.strip()] = sub
+            stack.append(sub)
+            name = ""
+        elif char in ",)":
+            if name.strip():
+                stack[-1][name.strip()] = None
+            name = ""
+            if char == ")" and len(stack) > 1:
+                stack.pop()
+        else:
+            name += char
+    return spec
+
+
+def project(value, spec):
+    """Keep only the fields in spec, applying it to each element of arrays."""
+    if spec is None:
+        return value
+    if isinstance(value, list):
+        return [project(element, spec) for element in value]
+    if isinstance(value, dict):
+        return {
+            key: project(value[key], sub) for key, sub in spec.items() if key in value
+        }
+    return value
+
+
+def decode(chunks, fields=None):
+    """
+    Decode a JSON document from an iterable of byte chunks, keeping only
+    fields (in fields= syntax) when given. Upstream normally applies fields
+    itself; older instances ignore it and send everything.
+
+    Arrays at the top level, the large responses, are decoded one element
+    at a time as the chunks arrive. Only the fields kept of each element
+    stay in memory, never the whole document or its parsed form.
+    """
+    spec = parse_fields(fields) if fields else None
+    pieces = _text(chunks)
+    buffer = ""
+    for piece in pieces:
+        buffer += piece
+        if buffer.strip():
+            break
+    if buffer.lstrip().startswith("["):
+        return list(_array_elements(buffer, pieces, spec))
+    return project(json.loads(buffer + "".join(pieces)), spec)
+
+
+def _text(chunks):
+    # Incremental, as a character may be split between two chunks
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def _array_elements(buffer, pieces, spec):
+    """Yield the projected elements of the array starting in buffer."""
+    pos = buffer.index("[") + 1
+    eof = False
+    while True:
+        while pos < len(buffer) and buffer[pos] in _SEPARATORS:
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+        end = None
+        if pos < len(buffer):
+            try:
+                value, end = _decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                pass
+        # An element ending exactly at the end of what has arrived may be a
+        # number that continues in the next chunk
+        if end is None or (end == len(buffer) and not eof):
+            if eof:
+                raise ValueError("truncated JSON array")
+            piece = next(pieces, None)
+            if piece is None:
+                eof = True
+            else:
+                buffer = buffer[pos:] + piece
+                pos = 0
+            continue
+        yield project(value, spec)
+        pos = end
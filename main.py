@@ -1,26 +1,118 @@
+import os
 import time
 import uuid
+import argparse
 import threading
+import event_log
+import profiler
 from ssdp import SSDPServer
 from dlna import DLNAServer
 
 # Configuration
 HOST = "0.0.0.0"
 PORT = 8000
+# HTTP worker processes sharing the port; 0 serves from this process
+WORKERS = 0
+# "threads": a thread per connection and service; "asyncio": one event loop
+MODE = "threads"
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DLNA media server for YouTube")
+    parser.add_argument("--port", type=int, default=PORT, help="HTTP port")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="number of HTTP worker processes (0 to serve from this process)",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=("threads", "asyncio"),
+        default=MODE,
+        help="serve with a thread per connection or from one asyncio event loop",
+    )
+    parser.add_argument(
+        "--instance",
+        action="append",
+        metavar="URL",
+        help="Invidious instance to use; repeat to give several",
+    )
+    parser.add_argument(
+        "--subscribe",
+        action="append",
+        metavar="CHANNEL_ID",
+        help="list this channel's uploads under Subscriptions; repeat to give several",
+    )
+    parser.add_argument(
+        "--profile-every",
+        type=int,
+        metavar="N",
+        help="profile one control request in N, writing to profiles/",
+    )
+    parser.add_argument(
+        "--profile-slow",
+        type=float,
+        metavar="MS",
+        help="profile control requests slower than MS milliseconds",
+    )
+    parser.add_argument(
+        "--profile-stacks",
+        action="store_true",
+        help="also sample the stacks of profiled requests, for flame graphs",
+    )
+    parser.add_argument(
+        "--log",
+        metavar="FILE",
+        help="write the JSON lines access and event log to FILE instead of stderr",
+    )
+    parser.add_argument(
+        "--log-sample",
+        metavar="CATEGORY=RATE",
+        action="append",
+        help="write only this fraction of a category's records, e.g. access=0.1",
+    )
+    args = parser.parse_args()
+    if args.mode == "asyncio" and args.workers:
+        parser.error("--workers is only supported with --mode threads")
+    if args.instance:
+        # Read by media_store, in this process and in the workers
+        os.environ["DLNATUBE_INSTANCES"] = ",".join(args.instance)
+    if args.subscribe:
+        os.environ["DLNATUBE_SUBSCRIPTIONS"] = ",".join(args.subscribe)
+    # Like the instances, passed to the workers through the environment
+    if args.profile_every:
+        os.environ["DLNATUBE_PROFILE_EVERY"] = str(args.profile_every)
+    if args.profile_slow:
+        os.environ["DLNATUBE_PROFILE_SLOW_MS"] = str(args.profile_slow)
+    if args.profile_stacks:
+        os.environ["DLNATUBE_PROFILE_STACKS"] = "1"
+    profiler.configure()
+    if args.log:
+        os.environ["DLNATUBE_LOG"] = args.log
+    if args.log_sample:
+        os.environ["DLNATUBE_LOG_SAMPLE"] = ",".join(args.log_sample)
+    event_log.configure()
+
     # Generate a unique ID for this session (shared between HTTP and SSDP)
     server_uuid = uuid.uuid4()
 
     # Initialize the separated services
-    http_service = DLNAServer(HOST, PORT)
-    ssdp_service = SSDPServer(PORT, http_service.server_uuid)
+    if args.mode == "asyncio":
+        from async_server import AsyncDLNAServer
+
+        # Announces itself over SSDP from its own event loop
+        http_service = AsyncDLNAServer(HOST, args.port)
+        ssdp_service = None
+    else:
+        http_service = DLNAServer(HOST, args.port, workers=args.workers)
+        ssdp_service = SSDPServer(args.port, http_service.server_uuid)
 
     print("Starting DLNA services...")
 
     try:
         http_service.start()
-        ssdp_service.start()
+        if ssdp_service:
+            ssdp_service.start()
 
         print(f"DLNA Server running (UUID: {server_uuid})")
         print("Press Ctrl+C to stop.")
@@ -31,6 +123,7 @@ if __name__ == "__main__":
 
     except KeyboardInterrupt:
         print("\nStopping services...")
-        ssdp_service.stop()
+        if ssdp_service:
+            ssdp_service.stop()
         http_service.stop()
         print("Services stopped.")
@@ -1,57 +1,738 @@
+import os
+import threading
 import xml.etree.ElementTree as ET
-from ContentDirectory import StorageFolder, VideoItem, Photo, Resource, NAMESPACES
-import json
-import requests
+from collections import OrderedDict
+from datetime import datetime, timezone
+from ContentDirectory import (
+    Container,
+    PlaylistContainer,
+    StorageFolder,
+    VideoItem,
+    Photo,
+    Resource,
+    NAMESPACES,
+)
+from object_registry import ObjectRegistry
+from paged_listing import PagedListing
+from search_cache import SearchCache
+from subscriptions import SubscriptionFeed
+from upstream_pool import UpstreamPool
+from stream_urls import StreamUrlCache
+from stream_relay import UPSTREAM_TIMEOUT
+from renderers import DEFAULT_PROFILE, FORMATS_BY_ITAG, protocol_info
+from mp4_index import IndexCache
+import profiler
+from urllib.parse import parse_qs, quote, quote_plus, urljoin, urlsplit
+import event_log
+import json_records
+import soap
 
-api = "https://yewtu.be/api/v1/"
+# Invidious instances, interchangeable; a comma-separated list in
+# DLNATUBE_INSTANCES replaces them (it reaches worker processes too)
+INSTANCES = os.environ.get("DLNATUBE_INSTANCES", "https://yewtu.be/").split(",")
+upstream = UpstreamPool(INSTANCES)
+# Channel IDs whose uploads the Subscriptions folder lists, from a
+# comma-separated DLNATUBE_SUBSCRIPTIONS; without any the folder is hidden
+SUBSCRIPTIONS = [
+    ucid.strip()
+    for ucid in os.environ.get("DLNATUBE_SUBSCRIPTIONS", "").split(",")
+    if ucid.strip()
+]
 
+# Properties accepted in SortCriteria, as reported by GetSortCapabilities
+SORT_CAPABILITIES = "dc:title,dc:date,upnp:class"
 
-def apiget(apimethod):
-    req = requests.get(f"{api}{apimethod}").json
-    return req
+# Seconds an upstream listing is kept before it is fetched again
+CATALOG_TTL = 900
+# With a shared catalog, listings this close to expiring are refetched by
+# the background refresh before any renderer has to wait for them
+REFRESH_MARGIN = 120
+
+
+# Videos of a Browse result whose stream URLs are resolved in advance; a
+# BrowseMetadata of a video always is
+PREFETCH_ITEMS = 4
+
+# Paged listings (channels, playlists) kept at once, least recently used
+# first out
+MAX_PAGED_LISTINGS = 64
+
+# Folders shown at the root of the server
+ROOT_FOLDERS = (
+    {"id": "trending", "title": "Trending"},
+    {"id": "search", "title": "Search YouTube"},
+)
+# Shown at the root too when there are subscriptions
+SUBSCRIPTIONS_FOLDER = {"id": "subscriptions", "title": "Subscriptions"}
+FOLDER_FIELDS = {"id": "id", "title": "title"}
+# Item properties taken from the videos of an Invidious listing
+VIDEO_FIELDS = {
+    "id": "videoId",
+    "title": "title",
+    "date": "published",
+    "video_id": "videoId",
+    "length_seconds": "lengthSeconds",
+}
+
+
+# What API responses are cut down to (Invidious fields= syntax)
+VIDEO_RESULT_FIELDS = "videoId,title,published,author,lengthSeconds"
+CHANNEL_FIELDS = f"videos({VIDEO_RESULT_FIELDS}),continuation"
+PLAYLIST_FIELDS = f"title,videoCount,videos({VIDEO_RESULT_FIELDS})"
+# Signed URLs and details of every format of a video
+FORMAT_FIELDS = (
+    "lengthSeconds,formatStreams(itag,url,size,bitrate),"
+    "adaptiveFormats(itag,url,size,bitrate,clen)"
+)
+SEARCH_FIELDS = f"type,{VIDEO_RESULT_FIELDS},authorId,playlistId,videoCount"
+
+# Upstream result "type" -> (class, fields, other properties) of the
+# objects made from it
+RESULT_TYPES = {
+    "video": (VideoItem, VIDEO_FIELDS, {}),
+    "channel": (
+        StorageFolder,
+        {"id": lambda row: f"channel:{row['authorId']}", "title": "author"},
+        {"storage_used": "-1"},
+    ),
+    "playlist": (
+        PlaylistContainer,
+        {
+            "id": lambda row: f"playlist:{row['playlistId']}",
+            "title": "title",
+            "child_count": lambda row: str(row.get("videoCount", 0)),
+        },
+        {},
+    ),
+}
+
+
+class NoSuchObjectError(Exception):
+    """Raised when a renderer refers to an ObjectID we do not know."""
+
+
+def apiget(apimethod, fields=None):
+    """
+    Call an API method and return the decoded JSON. fields, in Invidious'
+    fields= syntax, asks for only what we use, and the response is decoded
+    as it arrives into records holding just those fields.
+    """
+    path = f"api/v1/{apimethod}"
+    if fields:
+        path += ("&" if "?" in path else "?") + "fields=" + quote(fields, safe=",()")
+    with profiler.phase("upstream"), upstream.get(path, stream=True) as response:
+        return json_records.decode(
+            response.iter_content(json_records.READ_SIZE), fields
+        )
+
+
+def stream_url(video_id, itag):
+    """Upstream URL of a video in the given format, on the best instance now."""
+    return f"{upstream.best().url}latest_version?id={video_id}&itag={itag}&local=true"
+
+
+def resolve_formats(video_id):
+    """
+    Signed URLs of every format of a video with what upstream tells of
+    them: {itag: (url, details)}. With local=true the URLs go through the
+    instance that answered, relative to it.
+    """
+    path = f"api/v1/videos/{video_id}?local=true&fields=" + quote(
+        FORMAT_FIELDS, safe=",()"
+    )
+    with profiler.phase("upstream"), upstream.get(path, stream=True) as response:
+        video = json_records.decode(
+            response.iter_content(json_records.READ_SIZE), FORMAT_FIELDS
+        )
+        base = response.url
+    formats = video.get("formatStreams", []) + video.get("adaptiveFormats", [])
+    resolved = {}
+    for f in formats:
+        if f.get("itag") and f.get("url"):
+            url = urljoin(base, f["url"])
+            resolved[str(f["itag"])] = (url, format_details(f, url, video))
+    return resolved
+
+
+def format_details(stream_format, url, video):
+    """
+    Size, duration, bitrate and resolution of a format, as far as upstream
+    tells them: in the API response, or in the signed URL's clen and dur.
+    """
+    query = parse_qs(urlsplit(url).query)
+    size = stream_format.get("clen") or query.get("clen", [None])[0]
+    seconds = query.get("dur", [None])[0] or video.get("lengthSeconds")
+    # "640x360"; audio-only formats have none
+    resolution = stream_format.get("size")
+    bitrate = stream_format.get("bitrate")
+    details = {
+        "size": int(size) if str(size or "").isdigit() else None,
+        "seconds": float(seconds) if _is_number(seconds) else None,
+        "resolution": resolution if "x" in str(resolution or "") else None,
+    }
+    if details["size"] and details["seconds"]:
+        # Bytes per second, as DIDL-Lite has it
+        details["bitrate"] = int(details["size"] / details["seconds"])
+    elif str(bitrate or "").isdigit():
+        details["bitrate"] = int(bitrate) // 8
+    return details
+
+
+def _is_number(value):
+    try:
+        return float(value) > 0
+    except (TypeError, ValueError):
+        return False
+
+
+def didl_duration(seconds):
+    """A duration in seconds as DIDL-Lite's H+:MM:SS.FFF."""
+    milliseconds = round(float(seconds) * 1000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{milliseconds // 1000:02}.{milliseconds % 1000:03}"
+
+
+stream_urls = StreamUrlCache(resolve_formats, stream_url)
+keyframe_indexes = IndexCache()
+
+
+def keyframe_index(video_id, itag, cached=None):
+    """
+    The keyframe index of a stream, for seeking by time, built on first
+    use; None when it has none. Its moov box is read from the disk cache
+    (cached) when that holds it, otherwise from upstream.
+    """
+    if not _time_seekable(itag):
+        return None
+
+    def read(offset, size):
+        if cached is not None:
+            end = min(offset + size, cached.total_length)
+            if offset >= end:
+                return b""
+            if cached.cached_length(offset, end) == end - offset:
+                try:
+                    with open(cached.data_path, "rb") as f:
+                        f.seek(offset)
+                        return f.read(end - offset)
+                except OSError:
+                    # Evicted meanwhile; read upstream instead
+                    pass
+        return read_stream_range(video_id, itag, offset, size)
+
+    return keyframe_indexes.get(f"{video_id}-{itag}", read)
+
+
+def prefetch_keyframe_index(video_id, itag, cached=None):
+    """Build a stream's keyframe index in the background, if it has none yet."""
+    if not _time_seekable(itag) or keyframe_indexes.peek(f"{video_id}-{itag}")[0]:
+        return
+    threading.Thread(
+        target=_build_keyframe_index, args=(video_id, itag, cached), daemon=True
+    ).start()
+
+
+def _build_keyframe_index(video_id, itag, cached):
+    try:
+        keyframe_index(video_id, itag, cached)
+    except Exception as e:
+        event_log.log("upstream", video_id=video_id, itag=itag, index=str(e))
+
+
+def _time_seekable(itag):
+    # Formats we don't list are relayed as MP4
+    stream_format = FORMATS_BY_ITAG.get(str(itag))
+    return stream_format is None or stream_format.container == "mp4"
+
+
+def read_stream_range(video_id, itag, offset, size):
+    """Up to size bytes of a stream from offset, read straight from upstream."""
+    # Imported on first use, it takes longer to load than the whole server
+    import requests
+
+    url = stream_urls.get(video_id, itag)
+    headers = {"Range": f"bytes={offset}-{offset + size - 1}"}
+    with profiler.phase("upstream"), requests.get(
+        url, headers=headers, stream=True, timeout=UPSTREAM_TIMEOUT
+    ) as response:
+        if response.status_code == 416:
+            return b""
+        response.raise_for_status()
+        # Upstream ignored the Range header, so skip up to offset
+        skip = offset if response.status_code == 200 else 0
+        data = bytearray()
+        for chunk in response.iter_content(json_records.READ_SIZE):
+            if skip:
+                dropped = min(skip, len(chunk))
+                chunk, skip = chunk[dropped:], skip - dropped
+            data += chunk
+            if len(data) >= size:
+                break
+        return bytes(data[:size])
+
+
+def fetch_channel_page(ucid, cursor):
+    """
+    One page of a channel's videos: (videos, total, next cursor, title).
+
+    The cursor is the continuation token upstream returned, or the number
+    of the next page on instances that don't return one.
+    """
+    method = f"channels/{ucid}/videos"
+    if isinstance(cursor, int):
+        method += f"?page={cursor}"
+    elif cursor:
+        method += f"?continuation={quote(cursor)}"
+    response = apiget(method, CHANNEL_FIELDS)
+    videos = response.get("videos", [])
+    next_cursor = response.get("continuation") or None
+    if next_cursor is None and not isinstance(cursor, str):
+        next_cursor = (cursor or 1) + 1
+    title = videos[0].get("author") if videos else None
+    return videos, None, next_cursor if videos else None, title
+
+
+def _subscription_items(rows):
+    return VideoItem.from_rows(
+        rows, VIDEO_FIELDS, parent_id="subscriptions", restricted="1"
+    )
+
+
+subscription_feed = SubscriptionFeed(
+    SUBSCRIPTIONS, fetch_channel_page, _subscription_items
+)
+
+
+def fetch_playlist_page(plid, cursor):
+    """One page of a playlist's videos: (videos, total, next cursor, title)."""
+    page = cursor or 1
+    response = apiget(f"playlists/{plid}?page={page}", PLAYLIST_FIELDS)
+    videos = response.get("videos", [])
+    next_cursor = page + 1 if videos else None
+    return videos, response.get("videoCount"), next_cursor, response.get("title")
+
+
+def fetch_search_page(query, page):
+    """One page of upstream search results: videos, channels and playlists."""
+    return apiget(f"search?q={quote_plus(query)}&page={page}&type=all", SEARCH_FIELDS)
+
+
+search_cache = SearchCache(fetch_search_page)
+
+
+def fetch_search_listing(query, cursor):
+    """One page of a search container: (results, total, next cursor, title)."""
+    page = cursor or 1
+    rows = search_cache.get(query, page)
+    return rows, None, page + 1 if rows else None, query
+
+
+# ObjectID prefix of a paged container -> (page fetcher, container class,
+# its other properties)
+PAGED_CONTAINERS = {
+    "channel": (fetch_channel_page, StorageFolder, {"storage_used": "-1"}),
+    "playlist": (fetch_playlist_page, PlaylistContainer, {}),
+    "search": (fetch_search_listing, StorageFolder, {"storage_used": "-1"}),
+}
+# Searches listed in the "Search YouTube" folder
+RECENT_SEARCHES = 20
+
+
+def parse_sort_criteria(sort_criteria):
+    """
+    Parse a SortCriteria string such as "+dc:title,-dc:date".
+
+    Returns a tuple of (property, descending) pairs. A property not in
+    SORT_CAPABILITIES, or without its leading + or -, is error 709.
+    """
+    criteria = []
+    for part in (sort_criteria or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        prop = part[1:].strip()
+        if part[0] not in "+-" or prop not in SORT_KEY_FUNCS:
+            raise soap.UPnPError(soap.INVALID_SORT_CRITERIA)
+        criteria.append((prop, part[0] == "-"))
+    return tuple(criteria)
+
+
+def _parse_date(value):
+    """Turn a unix timestamp or ISO 8601 string into a sortable number."""
+    if value is None:
+        return 0.0
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return 0.0
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+SORT_KEY_FUNCS = {
+    "dc:title": lambda obj: (getattr(obj, "title", None) or "").casefold(),
+    "dc:date": lambda obj: _parse_date(getattr(obj, "date", None)),
+    "upnp:class": lambda obj: obj.upnp_class,
+}
+
+
+def _is_paged(object_id):
+    kind, sep, upstream_id = object_id.partition(":")
+    return bool(sep and upstream_id) and kind in PAGED_CONTAINERS
 
 
 class MediaStore:
-    def __init__(self, host_url):
+    def __init__(self, host_url, catalog=None):
         self.host_url = host_url
+        # CatalogStore shared with other processes, or None when this
+        # process fetches everything itself
+        self.catalog = catalog
+        self.registry = ObjectRegistry(on_evict=self._forget)
+        # object id -> {sort property: precomputed key}
+        self._sort_keys = {}
+        # (container id, parsed criteria) -> sorted permutation of children
+        self._sorted = {}
+        # container id -> PagedListing, least recently used first
+        self._paged = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped whenever a container listing changes
+        self.system_update_id = 0
+        # container id -> update id of its listing
+        self.container_update_ids = {}
+        # Called with (system update id, container id, container update id)
+        # after a listing changes
+        self.on_change = None
+        self._add_static_objects()
 
-    def browse(self, object_id, base_url):
-        items = []
+    def _add_static_objects(self):
+        """Index the root container and its virtual folders; these never expire."""
+        root = Container(id="0", parent_id="-1", title="DLNATube", restricted="1")
+        self.registry.add(root, pinned=True)
+        folders = self._fetch_children("0", self.host_url)
+        for folder in folders:
+            self.registry.add(folder, pinned=True)
+        self._ingest("0", folders)
 
-        # ROOT LEVEL
-        if object_id == "0":
-            # Create two virtual folders
-            items.append(
-                StorageFolder(
-                    id="trending",
-                    parent_id="0",
-                    title="Trending",
-                    restricted="1",
-                    storage_used="-1",
+    def browse(
+        self,
+        object_id,
+        base_url,
+        starting_index=0,
+        requested_count=0,
+        sort_criteria="",
+        browse_flag="BrowseDirectChildren",
+        renderer=DEFAULT_PROFILE,
+    ):
+        if browse_flag == "BrowseMetadata":
+            obj = self.registry.get(object_id)
+            if obj is None and _is_paged(object_id):
+                obj = self._paged_container(object_id)
+            if obj is None:
+                raise NoSuchObjectError(object_id)
+            return self._build_didl_lite_xml([obj], base_url, renderer), 1, 1
+
+        # Checked before any listing, which may not be sorted
+        criteria = parse_sort_criteria(sort_criteria)
+
+        if object_id == "search":
+            searches = self._recent_searches()
+            end = starting_index + requested_count if requested_count else None
+            items = searches[starting_index:end]
+            didl = self._build_didl_lite_xml(items, base_url, renderer)
+            return didl, len(items), len(searches)
+
+        if object_id.startswith("search:") and _is_paged(object_id):
+            preview = self._search_preview(object_id, starting_index, requested_count)
+            if preview is not None:
+                return (
+                    self._build_didl_lite_xml(preview, base_url, renderer),
+                    len(preview),
+                    len(preview),
                 )
+
+        if _is_paged(object_id):
+            return self._browse_paged(
+                object_id, base_url, starting_index, requested_count, renderer
             )
-            items.append(
-                StorageFolder(
-                    id="search",
-                    parent_id="0",
-                    title="Search YouTube",
-                    restricted="1",
-                    storage_used="-1",
+
+        children = self._get_children(object_id, base_url)
+        total = len(children)
+
+        end = total
+        if requested_count:
+            end = min(total, starting_index + requested_count)
+
+        if criteria:
+            order = self._sorted_order(object_id, children, criteria)
+            items = [children[i] for i in order[starting_index:end]]
+        else:
+            items = children[starting_index:end]
+
+        for item in items:
+            self.registry.touch(item.id)
+        didl = self._build_didl_lite_xml(items, base_url, renderer)
+        return didl, len(items), total
+
+    def _browse_paged(
+        self, object_id, base_url, starting_index, requested_count, renderer
+    ):
+        """
+        Browse a channel or playlist, fetching only the upstream pages the
+        renderer reads. Children are kept in upstream order, so SortCriteria
+        is ignored; sorting would mean fetching every page. Without a
+        RequestedCount, the rest of the page StartingIndex is on is returned.
+        """
+        listing = self._paged_listing(object_id)
+        end = starting_index + requested_count if requested_count else None
+        items = listing.slice(starting_index, end)
+        total, _ = listing.count()
+        container = self.registry.get(object_id)
+        if container is not None:
+            container.child_count = str(total)
+        for item in items:
+            self.registry.touch(item.id)
+        didl = self._build_didl_lite_xml(items, base_url, renderer)
+        return didl, len(items), total
+
+    def _paged_listing(self, object_id):
+        """Return the PagedListing of a channel or playlist, starting a new one if needed."""
+        with self._lock:
+            listing = self._paged.get(object_id)
+            if listing is None or listing.expired:
+                listing = PagedListing(
+                    lambda cursor: self._fetch_page(object_id, cursor),
+                    max_age=CATALOG_TTL,
                 )
+                self._paged[object_id] = listing
+                if len(self._paged) > MAX_PAGED_LISTINGS:
+                    self._paged.popitem(last=False)
+            self._paged.move_to_end(object_id)
+            return listing
+
+    def _fetch_page(self, object_id, cursor):
+        kind, _, upstream_id = object_id.partition(":")
+        fetch_page = PAGED_CONTAINERS[kind][0]
+        rows, total, next_cursor, title = fetch_page(upstream_id, cursor)
+        children = self._children_from_rows(object_id, rows)
+        for child in children:
+            self.registry.add(child)
+        return children, total, next_cursor, title
+
+    def _children_from_rows(self, object_id, rows):
+        """
+        Build the children of a container from upstream rows, in order.
+        Search results mix videos with channels and playlists, which become
+        containers of their own.
+        """
+        # row type -> indexes of its rows
+        positions = {}
+        for i, row in enumerate(rows):
+            row_type = row.get("type", "video")
+            if row_type in RESULT_TYPES:
+                positions.setdefault(row_type, []).append(i)
+        children = [None] * len(rows)
+        for row_type, indexes in positions.items():
+            item_class, fields, properties = RESULT_TYPES[row_type]
+            built = item_class.from_rows(
+                [rows[i] for i in indexes],
+                fields,
+                parent_id=object_id,
+                restricted="1",
+                **properties,
+            )
+            for i, child in zip(indexes, built):
+                children[i] = child
+        return [child for child in children if child is not None]
+
+    def _search_preview(self, object_id, starting_index, requested_count):
+        """
+        While upstream works on a query being typed, return the matching
+        results of an earlier keystroke's query, or None to browse it as
+        usual.
+        """
+        if starting_index or self._paged_listing(object_id).count()[0]:
+            return None
+        rows = search_cache.typeahead(object_id.partition(":")[2])
+        if rows is None:
+            return None
+        items = self._children_from_rows(object_id, rows)
+        if requested_count:
+            items = items[:requested_count]
+        for item in items:
+            self.registry.add(item)
+        return items
+
+    def _recent_searches(self):
+        return StorageFolder.from_rows(
+            search_cache.recent_queries(RECENT_SEARCHES),
+            {"id": lambda query: f"search:{query}", "title": lambda query: query},
+            parent_id="search",
+            restricted="1",
+            storage_used="-1",
+        )
+
+    def _paged_container(self, object_id):
+        """
+        Describe a channel or playlist that no listing has handed out, from
+        its first page.
+        """
+        listing = self._paged_listing(object_id)
+        listing.slice(0)
+        kind, _, upstream_id = object_id.partition(":")
+        _, container_class, properties = PAGED_CONTAINERS[kind]
+        total, _ = listing.count()
+        return container_class(
+            id=object_id,
+            parent_id="0",
+            title=listing.title or upstream_id,
+            restricted="1",
+            child_count=str(total),
+            **properties,
+        )
+
+    def _get_children(self, object_id, base_url):
+        """Return the indexed children of a container, fetching them if stale."""
+        if self.catalog is not None:
+            return self._get_shared_children(object_id, base_url)
+        children = self.registry.children(object_id, max_age=CATALOG_TTL)
+        if children is not None:
+            return children
+        items = self._fetch_children(object_id, base_url)
+        self._ingest(object_id, items)
+        return items
+
+    def _get_shared_children(self, object_id, base_url):
+        """
+        Like _get_children, but the shared catalog decides whether the local
+        listing is current: it is reloaded when another process has stored
+        a newer one, and only fetched upstream when none is fresh.
+        """
+        update_id = self.catalog.update_id(object_id, max_age=CATALOG_TTL)
+        if update_id is not None:
+            if update_id == self.container_update_ids.get(object_id):
+                children = self.registry.children(object_id)
+                if children is not None:
+                    return children
+            shared = self.catalog.get(object_id, max_age=CATALOG_TTL)
+            if shared is not None:
+                update_id, items = shared
+                self._ingest(object_id, items, update_id)
+                return items
+        items = self._fetch_children(object_id, base_url)
+        self._ingest(object_id, items, self.catalog.put(object_id, items))
+        return items
+
+    def follow_subscriptions(self):
+        """
+        Refresh the subscribed channels in the background, listing their
+        uploads (and storing them in the shared catalog, if there is one)
+        whenever new ones come in.
+        """
+        subscription_feed.on_change = self._subscriptions_changed
+        subscription_feed.start()
+
+    def _subscriptions_changed(self, items):
+        update_id = None
+        if self.catalog is not None:
+            update_id = self.catalog.put("subscriptions", items)
+        self._ingest("subscriptions", items, update_id)
+
+    def refresh(self, container_ids, base_url=""):
+        """
+        Refetch shared listings that are missing or about to expire, so the
+        HTTP workers find them fresh in the catalog.
+        """
+        for object_id in container_ids:
+            age = self.catalog.age(object_id)
+            if age is not None and age < CATALOG_TTL - REFRESH_MARGIN:
+                continue
+            try:
+                items = self._fetch_children(object_id, base_url)
+            except Exception as e:
+                event_log.log("upstream", refresh=object_id, error=str(e))
+                continue
+            self._ingest(object_id, items, self.catalog.put(object_id, items))
+
+    def _ingest(self, object_id, items, update_id=None):
+        """
+        Index a container listing and precompute the sort keys of its
+        children. update_id is the listing's id in the shared catalog, if any.
+        """
+        with self._lock:
+            for item in items:
+                self._sort_keys[item.id] = self._compute_sort_keys(item)
+            self.registry.set_children(object_id, items)
+            # Any sorted permutation of the previous listing is now invalid
+            self._drop_sorted(object_id)
+            if update_id is None:
+                update_id = self.system_update_id + 1
+            self.system_update_id = max(self.system_update_id, update_id)
+            self.container_update_ids[object_id] = update_id
+            change = (self.system_update_id, object_id, update_id)
+        if self.on_change:
+            self.on_change(*change)
+
+    def _forget(self, obj):
+        """Registry eviction hook: drop state derived from an evicted object."""
+        self._sort_keys.pop(obj.id, None)
+        self._drop_sorted(obj.id)
+        self._drop_sorted(obj.parent_id)
+
+    def _drop_sorted(self, object_id):
+        for key in [k for k in self._sorted if k[0] == object_id]:
+            self._sorted.pop(key, None)
+
+    @staticmethod
+    def _compute_sort_keys(obj):
+        return {prop: key_func(obj) for prop, key_func in SORT_KEY_FUNCS.items()}
+
+    def _sorted_order(self, object_id, children, criteria):
+        """Return the cached sorted permutation of a container's children."""
+        cache_key = (object_id, criteria)
+        order = self._sorted.get(cache_key)
+        if order is not None and len(order) == len(children):
+            return order
+
+        keys = [
+            self._sort_keys.get(child.id) or self._compute_sort_keys(child)
+            for child in children
+        ]
+        order = list(range(len(children)))
+        # Stable sorts applied from the least to the most significant key
+        for prop, descending in reversed(criteria):
+            order.sort(key=lambda i: keys[i][prop], reverse=descending)
+        self._sorted[cache_key] = order
+        return order
+
+    def _fetch_children(self, object_id, base_url):
+        items = []
+
+        # ROOT LEVEL
+        if object_id == "0":
+            folders = ROOT_FOLDERS
+            if subscription_feed.channels:
+                folders += (SUBSCRIPTIONS_FOLDER,)
+            items = StorageFolder.from_rows(
+                folders,
+                FOLDER_FIELDS,
+                parent_id="0",
+                restricted="1",
+                storage_used="-1",
             )
 
         elif object_id == "trending":
-            trending_obj = apiget("trending")
-            for v in trending_obj:
-                items.append(
-                    StorageFolder(
-                        id=v["videoId"],
-                        parent_id=object_id,
-                        title=v["title"],
-                        restricted="1",
-                        storage_used="-1",
-                    )
-                )
+            trending_obj = apiget("trending", VIDEO_RESULT_FIELDS)
+            items = VideoItem.from_rows(
+                trending_obj, VIDEO_FIELDS, parent_id=object_id, restricted="1"
+            )
+
+        elif object_id == "subscriptions":
+            # Merged in the background, newest first; nothing to fetch here
+            items = subscription_feed.items()
 
         """
         # INSIDE "My Movies"
@@ -84,20 +765,51 @@ class MediaStore:
                     )
                 )
         """
-        didl = self._build_didl_lite_xml(items)
-        return didl, len(items), len(items)
+        return items
 
-    def _build_didl_lite_xml(self, items):
-        """Helper to wrap ContentDirectory items into DIDL-Lite root."""
-        root = ET.Element(
-            "DIDL-Lite",
-            {
-                "xmlns": NAMESPACES["didl_lite"],
-                "xmlns:dc": NAMESPACES["dc"],
-                "xmlns:upnp": NAMESPACES["upnp"],
-                "xmlns:sec": NAMESPACES["sec"],
-            },
+    def _resource_for(self, item, base_url, renderer):
+        """
+        Build the res element for a video in the renderer's preferred format,
+        with all that is known of it, so the renderer needn't probe the stream
+        to show its length or to seek.
+        """
+        stream_format = renderer.stream_format
+        video_id = item.video_id
+        details = stream_urls.details(video_id, stream_format.itag)
+        seconds = getattr(item, "length_seconds", None) or details.get("seconds")
+        return Resource(
+            f"{base_url}stream/{video_id}?itag={stream_format.itag}",
+            protocol_info(stream_format),
+            size=details.get("size"),
+            duration=didl_duration(seconds) if _is_number(seconds) else None,
+            bitrate=details.get("bitrate"),
+            resolution=details.get("resolution"),
         )
-        for item in items:
-            root.append(item.to_xml())
-        return ET.tostring(root, encoding="unicode")
+
+    def _build_didl_lite_xml(self, items, base_url="", renderer=DEFAULT_PROFILE):
+        """Helper to wrap ContentDirectory items into DIDL-Lite root."""
+        with profiler.phase("serialize"):
+            root = ET.Element(
+                "DIDL-Lite",
+                {
+                    "xmlns": NAMESPACES["didl_lite"],
+                    "xmlns:dc": NAMESPACES["dc"],
+                    "xmlns:upnp": NAMESPACES["upnp"],
+                    "xmlns:sec": NAMESPACES["sec"],
+                },
+            )
+            videos = [item for item in items if getattr(item, "video_id", None)]
+            # Resolved while the renderer shows them, ready when play is
+            # pressed; only the first few, so a long page doesn't fill the
+            # queue ahead of the videos that are playing
+            for item in videos[:PREFETCH_ITEMS]:
+                stream_urls.prefetch(item.video_id, renderer.stream_format.itag)
+            for item in items:
+                item_el = item.to_xml()
+                # Stream resources depend on the renderer, so they are not
+                # stored on the shared object but added at serialization time
+                if getattr(item, "video_id", None):
+                    res = self._resource_for(item, base_url, renderer)
+                    item_el.append(res.to_xml())
+                root.append(item_el)
+            return ET.tostring(root, encoding="unicode")
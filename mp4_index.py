@@ -0,0 +1,303 @@
+import sys
+import struct
+import threading
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+
+# Bytes read at a time while looking for the moov box; with the moov at the
+# front, as upstream's muxed formats have it, one read usually holds it all
+FIRST_READ = 256 * 1024
+# Largest moov box read; bigger ones aren't indexed
+MAX_MOOV_SIZE = 32 * 1024 * 1024
+# Top-level boxes skipped over at most before giving up on finding the moov
+MAX_TOP_BOXES = 64
+# Indexes kept in memory, least recently used first out
+MAX_INDEXES = 256
+
+_BOX = struct.Struct(">I4s")
+_U32 = struct.Struct(">I")
+_U64 = struct.Struct(">Q")
+
+
+class Mp4Error(Exception):
+    """Raised when media has no moov box or keyframe tables to index."""
+
+
+class KeyframeIndex:
+    """
+    Decode times (seconds) and byte offsets of the video keyframes of an
+    MP4, in two arrays, so that seeking to a time is a bisection.
+    """
+
+    __slots__ = ("times", "offsets", "duration")
+
+    def __init__(self, times, offsets, duration):
+        self.times = times
+        self.offsets = offsets
+        self.duration = duration
+
+    def __len__(self):
+        return len(self.times)
+
+    def seek(self, seconds):
+        """(time, byte offset) of the last keyframe at or before seconds."""
+        i = max(bisect_right(self.times, seconds) - 1, 0)
+        return self.times[i], self.offsets[i]
+
+    def next_after(self, seconds):
+        """(time, byte offset) of the first keyframe after seconds, or None."""
+        i = bisect_right(self.times, seconds)
+        if i == len(self.times):
+            return None
+        return self.times[i], self.offsets[i]
+
+
+class IndexCache:
+    """
+    Keyframe indexes by key, each built once however many requests want it
+    at the same time. Media found to have no index is remembered as None.
+    """
+
+    def __init__(self, size=MAX_INDEXES):
+        self.size = size
+        # key -> KeyframeIndex or None, least recently used first
+        self._indexes = OrderedDict()
+        # key -> Event set when the build under way ends
+        self._building = {}
+        self._lock = threading.Lock()
+
+    def peek(self, key):
+        """(True, index) if key was indexed already, else (False, None)."""
+        with self._lock:
+            if key not in self._indexes:
+                return False, None
+            self._indexes.move_to_end(key)
+            return True, self._indexes[key]
+
+    def get(self, key, read):
+        """
+        The index of key, built with read(offset, size) if it isn't cached.
+        Errors reading are raised, and the next call tries again.
+        """
+        while True:
+            with self._lock:
+                if key in self._indexes:
+                    self._indexes.move_to_end(key)
+                    return self._indexes[key]
+                done = self._building.get(key)
+                if done is None:
+                    done = self._building[key] = threading.Event()
+                    break
+            done.wait()
+        try:
+            try:
+                index = build(read)
+            except Mp4Error:
+                index = None
+            with self._lock:
+                self._indexes[key] = index
+                while len(self._indexes) > self.size:
+                    self._indexes.popitem(last=False)
+            return index
+        finally:
+            with self._lock:
+                del self._building[key]
+            done.set()
+
+
+def build(read):
+    """
+    Index the video keyframes of an MP4, given read(offset, size) returning
+    the bytes at offset (fewer at the end of the media). Only the moov box
+    is read: its sample tables (stts, stss, stsc, stsz, stco) say where and
+    when every sample is.
+    """
+    moov = _read_moov(read)
+    try:
+        return _index_track(moov, _video_track(moov))
+    except (IndexError, struct.error) as e:
+        raise Mp4Error(f"malformed sample tables: {e}")
+
+
+def file_reader(path):
+    """A read(offset, size) for build() over a local file."""
+
+    def read(offset, size):
+        with open(path, "rb") as f:
+            f.seek(offset)
+            return f.read(size)
+
+    return read
+
+
+def _read_moov(read):
+    """The body of the moov box, skipping the top-level boxes before it."""
+    offset = 0
+    buffer, buffer_at = b"", None
+    for _ in range(MAX_TOP_BOXES):
+        pos = 0 if buffer_at is None else offset - buffer_at
+        if pos + 16 > len(buffer) and buffer_at != offset:
+            buffer, buffer_at, pos = read(offset, FIRST_READ), offset, 0
+        if pos + 8 > len(buffer):
+            break
+        size, kind = _BOX.unpack_from(buffer, pos)
+        header = 8
+        if size == 1:
+            if pos + 16 > len(buffer):
+                break
+            size, header = _U64.unpack_from(buffer, pos + 8)[0], 16
+        if kind == b"moov":
+            if size < header or size > MAX_MOOV_SIZE:
+                raise Mp4Error("moov box too large")
+            body = buffer[pos + header : pos + size]
+            missing = size - header - len(body)
+            if missing:
+                body += read(offset + size - missing, missing)
+            if len(body) != size - header:
+                raise Mp4Error("truncated moov box")
+            return body
+        if size < header:
+            # Size 0 is the last box, running to the end of the media
+            break
+        offset += size
+    raise Mp4Error("no moov box")
+
+
+def _boxes(data, start, end):
+    """Yield (type, body start, body end) of the boxes in data[start:end]."""
+    pos = start
+    while pos + 8 <= end:
+        size, kind = _BOX.unpack_from(data, pos)
+        header = 8
+        if size == 1:
+            size, header = _U64.unpack_from(data, pos + 8)[0], 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise Mp4Error(f"malformed {kind!r} box")
+        yield kind, pos + header, pos + size
+        pos += size
+
+
+def _child(data, parent, kind):
+    """(start, end) of the body of the first kind box in a parent's body."""
+    for found, start, end in _boxes(data, *parent):
+        if found == kind:
+            return start, end
+    raise Mp4Error(f"no {kind.decode()} box")
+
+
+def _video_track(moov):
+    """(start, end) of the body of the first video trak box."""
+    for kind, start, end in _boxes(moov, 0, len(moov)):
+        if kind != b"trak":
+            continue
+        hdlr = _child(moov, _child(moov, (start, end), b"mdia"), b"hdlr")
+        # Version and flags, pre_defined, then the handler type
+        if moov[hdlr[0] + 8 : hdlr[0] + 12] == b"vide":
+            return start, end
+    raise Mp4Error("no video track")
+
+
+def _index_track(moov, trak):
+    mdia = _child(moov, trak, b"mdia")
+    mdhd = _child(moov, mdia, b"mdhd")[0]
+    if moov[mdhd] == 1:
+        timescale = _U32.unpack_from(moov, mdhd + 20)[0]
+        duration = _U64.unpack_from(moov, mdhd + 24)[0]
+    else:
+        timescale, duration = struct.unpack_from(">II", moov, mdhd + 12)
+    if not timescale:
+        raise Mp4Error("no timescale")
+    stbl = _child(moov, _child(moov, mdia, b"minf"), b"stbl")
+    tables = {kind: (start, end) for kind, start, end in _boxes(moov, *stbl)}
+    for kind in (b"stts", b"stsc", b"stsz"):
+        if kind not in tables:
+            raise Mp4Error(f"no {kind.decode()} box")
+
+    # (sample count, duration) runs
+    durations = _table(moov, tables[b"stts"], fields=2)
+    # (first chunk, samples per chunk, description) runs
+    chunks = _table(moov, tables[b"stsc"], fields=3)
+    sample_size = _U32.unpack_from(moov, tables[b"stsz"][0] + 4)[0]
+    sizes = None if sample_size else _table(moov, tables[b"stsz"], header=12)
+    if b"stco" in tables:
+        chunk_offsets = _table(moov, tables[b"stco"])
+    elif b"co64" in tables:
+        chunk_offsets = _table(moov, tables[b"co64"], "Q")
+    else:
+        raise Mp4Error("no stco box")
+    if b"stss" in tables:
+        keyframes = _table(moov, tables[b"stss"])
+    else:
+        # Without a sync sample table every sample is a keyframe
+        sample_count = _U32.unpack_from(moov, tables[b"stsz"][0] + 8)[0]
+        keyframes = range(1, sample_count + 1)
+    if not keyframes:
+        raise Mp4Error("no keyframes")
+
+    times = array("d", _decode_times(keyframes, durations, timescale))
+    offsets = array(
+        "Q", _sample_offsets(keyframes, chunks, chunk_offsets, sizes, sample_size)
+    )
+    if len(times) != len(keyframes) or len(offsets) != len(keyframes):
+        raise Mp4Error("keyframes outside the sample tables")
+    if not duration:
+        duration = sum(a * b for a, b in zip(durations[::2], durations[1::2]))
+    return KeyframeIndex(times, offsets, duration / timescale)
+
+
+def _table(data, box, typecode="I", fields=1, header=8):
+    """
+    The big-endian entries of a sample table box as an array. The entry
+    count is the last field of its header, each entry has fields numbers.
+    """
+    start = box[0]
+    count = _U32.unpack_from(data, start + header - 4)[0]
+    entries = array(typecode)
+    end = start + header + count * fields * entries.itemsize
+    if end > box[1]:
+        raise Mp4Error("truncated sample table")
+    entries.frombytes(data[start + header : end])
+    if sys.byteorder == "little":
+        entries.byteswap()
+    return entries
+
+
+def _decode_times(keyframes, durations, timescale):
+    """Yield the decode time in seconds of each (ascending) keyframe."""
+    run = 0
+    # First sample of the current run and its decode time
+    first, time = 1, 0
+    for sample in keyframes:
+        while run < len(durations) and sample >= first + durations[run]:
+            time += durations[run] * durations[run + 1]
+            first += durations[run]
+            run += 2
+        if run >= len(durations):
+            return
+        yield (time + (sample - first) * durations[run + 1]) / timescale
+
+
+def _sample_offsets(keyframes, chunks, chunk_offsets, sizes, sample_size):
+    """Yield the byte offset of each (ascending) keyframe."""
+    targets = iter(keyframes)
+    target = next(targets, None)
+    # First sample of the current run of chunks
+    sample = 1
+    for i in range(0, len(chunks), 3):
+        first_chunk, per_chunk = chunks[i], chunks[i + 1]
+        if not per_chunk:
+            raise Mp4Error("empty chunks")
+        end_chunk = chunks[i + 3] if i + 3 < len(chunks) else len(chunk_offsets) + 1
+        run_end = sample + (end_chunk - first_chunk) * per_chunk
+        while target is not None and target < run_end:
+            chunk, within = divmod(target - sample, per_chunk)
+            if sizes is None:
+                before = within * sample_size
+            else:
+                before = sum(sizes[target - within - 1 : target - 1])
+            yield chunk_offsets[first_chunk + chunk - 1] + before
+            target = next(targets, None)
+        sample = run_end
@@ -0,0 +1,152 @@
+import time
+import threading
+from collections import OrderedDict
+
+# Upper bound on the number of DIDL objects kept in memory
+MAX_OBJECTS = 20000
+
+
+class ObjectRegistry:
+    """
+    Index of every DIDL object handed out to renderers, keyed by ObjectID.
+    Keeps parent/child links so containers can be listed and described
+    without going back upstream. Least recently used objects are evicted
+    once MAX_OBJECTS is reached; pinned objects (the static root folders)
+    are never evicted.
+    """
+
+    def __init__(self, max_objects=MAX_OBJECTS, on_evict=None):
+        self.max_objects = max_objects
+        self.on_evict = on_evict
+        # object id -> object, in least to most recently used order
+        self._objects = OrderedDict()
+        # container id -> (fetched at, list of child ids)
+        self._listings = {}
+        # object id -> ids of the containers whose listings hold it; a video
+        # can be in a channel, trending and search results at once
+        self._parents = {}
+        self._pinned = set()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._objects)
+
+    def __contains__(self, object_id):
+        return object_id in self._objects
+
+    def get(self, object_id):
+        """Return the object for an ID, or None if it is not indexed."""
+        with self._lock:
+            obj = self._objects.get(object_id)
+            if obj is not None:
+                self._objects.move_to_end(object_id)
+            return obj
+
+    def add(self, obj, pinned=False):
+        """Index an object, linking it into its parent's listing if one is held."""
+        with self._lock:
+            is_new = obj.id not in self._objects
+            self._objects[obj.id] = obj
+            self._objects.move_to_end(obj.id)
+            if pinned:
+                self._pinned.add(obj.id)
+            listing = self._listings.get(obj.parent_id)
+            if is_new and listing is not None and obj.id not in listing[1]:
+                listing[1].append(obj.id)
+                self._parents.setdefault(obj.id, set()).add(obj.parent_id)
+                self._adjust_child_count(obj.parent_id, 1)
+            self._evict()
+
+    def remove(self, object_id):
+        """Drop an object and unlink it from its parent."""
+        with self._lock:
+            obj = self._objects.pop(object_id, None)
+            if obj is None:
+                return
+            self._pinned.discard(object_id)
+            self._drop_listing(object_id)
+            for parent_id in self._parents.pop(object_id, ()):
+                listing = self._listings.get(parent_id)
+                if listing is not None and object_id in listing[1]:
+                    listing[1].remove(object_id)
+                    self._adjust_child_count(parent_id, -1)
+            if self.on_evict:
+                self.on_evict(obj)
+
+    def set_children(self, parent_id, children):
+        """Replace the listing of a container with freshly fetched children."""
+        with self._lock:
+            self._drop_listing(parent_id)
+            for child in children:
+                self._objects[child.id] = child
+                self._objects.move_to_end(child.id)
+                self._parents.setdefault(child.id, set()).add(parent_id)
+            self._listings[parent_id] = (
+                time.monotonic(),
+                [child.id for child in children],
+            )
+            parent = self._objects.get(parent_id)
+            if parent is not None:
+                parent.child_count = str(len(children))
+            self._evict()
+
+    def children(self, parent_id, max_age=None):
+        """
+        Return the children of a container, or None if no listing is held
+        or it is older than max_age seconds.
+        """
+        with self._lock:
+            listing = self._listings.get(parent_id)
+            if listing is None:
+                return None
+            fetched_at, child_ids = listing
+            if max_age is not None and time.monotonic() - fetched_at >= max_age:
+                return None
+            children = [self._objects.get(child_id) for child_id in child_ids]
+            if None in children:
+                # Incomplete, so fetched again like an expired listing
+                self._drop_listing(parent_id)
+                return None
+            return children
+
+    def touch(self, object_id):
+        """Mark an object as recently used."""
+        with self._lock:
+            if object_id in self._objects:
+                self._objects.move_to_end(object_id)
+
+    def _adjust_child_count(self, parent_id, delta):
+        parent = self._objects.get(parent_id)
+        if parent is None:
+            return
+        count = int(getattr(parent, "child_count", None) or 0)
+        parent.child_count = str(max(0, count + delta))
+
+    def _evict(self):
+        """Evict least recently used objects until within max_objects."""
+        while len(self._objects) > self.max_objects:
+            victim_id = next(
+                (oid for oid in self._objects if oid not in self._pinned), None
+            )
+            if victim_id is None:
+                return
+            victim = self._objects.pop(victim_id)
+            self._drop_listing(victim_id)
+            # The listings holding it would now be incomplete, so drop them
+            # and let the next Browse refetch them. Their childCount stays.
+            for parent_id in self._parents.pop(victim_id, ()):
+                self._drop_listing(parent_id)
+            self._drop_listing(victim.parent_id)
+            if self.on_evict:
+                self.on_evict(victim)
+
+    def _drop_listing(self, parent_id):
+        listing = self._listings.pop(parent_id, None)
+        if listing is None:
+            return
+        for child_id in listing[1]:
+            parents = self._parents.get(child_id)
+            if parents is not None:
+                parents.discard(parent_id)
+                if not parents:
+                    del self._parents[child_id]
@@ -0,0 +1,134 @@
+import time
+import bisect
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import event_log
+
+# Threads fetching the next page ahead of a renderer
+PREFETCH_THREADS = 4
+
+_prefetch_pool = ThreadPoolExecutor(
+    max_workers=PREFETCH_THREADS, thread_name_prefix="page-prefetch"
+)
+
+
+class PagedListing:
+    """
+    The children of a container too large to fetch at once, such as a
+    channel or playlist, produced on demand from upstream pages.
+
+    fetch_page(cursor) returns (children, total, next cursor, title) for the
+    page starting at cursor; None is the first page. total is the number of
+    children upstream reports, or None if it doesn't, and a next cursor of
+    None ends the listing. Pages are fetched in order, since each one tells
+    where the next starts, and kept until the listing expires. When a
+    renderer reads into the last fetched page, the next one is fetched in
+    the background so it is ready when the renderer gets there.
+    """
+
+    def __init__(self, fetch_page, max_age=None):
+        self.fetch_page = fetch_page
+        self.max_age = max_age
+        self.created_at = time.monotonic()
+        self.title = None
+        self._children = []
+        # Index just past the last child of each fetched page
+        self._page_ends = []
+        self._next_cursor = None
+        self._exhausted = False
+        # Number of children upstream reported, if it did
+        self._total = None
+        self._prefetching = False
+        # Guards the fields above
+        self._lock = threading.Lock()
+        # One upstream fetch at a time, so a page is never fetched twice
+        self._fetch_lock = threading.Lock()
+
+    @property
+    def expired(self):
+        return (
+            self.max_age is not None
+            and time.monotonic() - self.created_at >= self.max_age
+        )
+
+    def count(self):
+        """
+        Return (number of children, whether it is exact). Until the last
+        page is reached, and unless upstream reported a total, the count is
+        an estimate of one more page like the last one.
+        """
+        with self._lock:
+            fetched = len(self._children)
+            if self._exhausted:
+                return fetched, True
+            if self._total is not None:
+                return max(self._total, fetched), True
+            last_page = fetched - self._last_page_start()
+            return fetched + last_page, False
+
+    def slice(self, start, end=None):
+        """
+        Return children [start, end), fetching the pages they are on. With
+        no end, return the rest of the page start is on.
+        """
+        self._fill(start + 1 if end is None else end)
+        with self._lock:
+            if end is None:
+                page = bisect.bisect_right(self._page_ends, start)
+                end = self._page_ends[page] if page < len(self._page_ends) else start
+            children = self._children[start:end]
+            # Reading into the last fetched page
+            prefetch = (
+                not self._exhausted
+                and not self._prefetching
+                and end > self._last_page_start()
+            )
+            if prefetch:
+                self._prefetching = True
+                needed = len(self._children) + 1
+        if prefetch:
+            _prefetch_pool.submit(self._prefetch, needed)
+        return children
+
+    def _last_page_start(self):
+        return self._page_ends[-2] if len(self._page_ends) > 1 else 0
+
+    def _fill(self, needed):
+        """Fetch pages until there are needed children or none are left."""
+        while True:
+            with self._lock:
+                if self._exhausted or len(self._children) >= needed:
+                    return
+            self._fetch_next(needed)
+
+    def _fetch_next(self, needed):
+        with self._fetch_lock:
+            with self._lock:
+                # Another thread may have fetched it while we waited
+                if self._exhausted or len(self._children) >= needed:
+                    return
+                cursor = self._next_cursor
+            children, total, next_cursor, title = self.fetch_page(cursor)
+            with self._lock:
+                self._children.extend(children)
+                self._page_ends.append(len(self._children))
+                if total is not None:
+                    self._total = total
+                if title and not self.title:
+                    self.title = title
+                self._next_cursor = next_cursor
+                self._exhausted = (
+                    next_cursor is None
+                    or not children
+                    or (self._total is not None and len(self._children) >= self._total)
+                )
+
+    def _prefetch(self, needed):
+        try:
+            self._fill(needed)
+        except Exception as e:
+            event_log.log("upstream", prefetch="next page", error=str(e))
+        finally:
+            with self._lock:
+                self._prefetching = False
@@ -0,0 +1,229 @@
+import os
+import sys
+import json
+import time
+import itertools
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+
+import event_log
+
+# Settings, read from the environment by configure() so that worker
+# processes share them
+# Profile one request in this many; 0 samples none
+SAMPLE_EVERY = 0
+# Also keep the profile of any request slower than this, in milliseconds;
+# 0 keeps none
+SLOW_MS = 0.0
+# Also sample the stacks of profiled requests, for flame graphs
+STACKS = False
+# Directory profiles are appended to: requests.jsonl holds the phase
+# timings, stacks.folded the stack samples in collapsed-stack format
+PROFILE_DIR = "profiles"
+# Seconds between two stack samples
+STACK_INTERVAL = 0.005
+
+# Whether any request is profiled at all
+enabled = False
+
+# The profile of the request the current thread is handling
+_local = threading.local()
+_counter = itertools.count()
+_write_lock = threading.Lock()
+# Thread ident -> profile of the request it is handling, for the sampler
+_sampled_threads = {}
+_sampler = None
+_sampler_wakeup = threading.Event()
+
+
+def configure():
+    """Read the settings from DLNATUBE_PROFILE_* environment variables."""
+    global SAMPLE_EVERY, SLOW_MS, STACKS, PROFILE_DIR, enabled
+    SAMPLE_EVERY = int(os.environ.get("DLNATUBE_PROFILE_EVERY") or 0)
+    SLOW_MS = float(os.environ.get("DLNATUBE_PROFILE_SLOW_MS") or 0)
+    STACKS = os.environ.get("DLNATUBE_PROFILE_STACKS", "") not in ("", "0")
+    PROFILE_DIR = os.environ.get("DLNATUBE_PROFILE_DIR") or PROFILE_DIR
+    enabled = SAMPLE_EVERY > 0 or SLOW_MS > 0
+
+
+class RequestProfile:
+    """
+    Timings of one request, split into phases. A phase entered inside
+    another pauses it, so each phase counts only its own time: the upstream
+    calls made while building a Browse result count as upstream, not build.
+    """
+
+    def __init__(self, name, sampled):
+        self.name = name
+        self.detail = ""
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        # phase -> seconds spent in it
+        self.phases = {}
+        # [phase, when it was last entered or resumed] of the open phases
+        self._open = []
+        # collapsed stack -> times it was seen
+        self.stacks = Counter() if STACKS else None
+
+    def enter(self, phase):
+        now = time.perf_counter()
+        if self._open:
+            self._pause(self._open[-1], now)
+        self._open.append([phase, now])
+
+    def exit(self):
+        now = time.perf_counter()
+        self._pause(self._open.pop(), now)
+        if self._open:
+            self._open[-1][1] = now
+
+    def _pause(self, entry, now):
+        self.phases[entry[0]] = self.phases.get(entry[0], 0.0) + now - entry[1]
+
+
+class _Phase:
+    __slots__ = ("profile", "name")
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.profile.enter(self.name)
+
+    def __exit__(self, *exc_info):
+        self.profile.exit()
+
+
+class _NoPhase:
+    """What phase() returns outside a profiled request: does nothing."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_PHASE = _NoPhase()
+
+
+def begin(name):
+    """
+    Start profiling the request the current thread is about to handle, if
+    it is sampled or could turn out slow. Returns the profile, or None.
+    """
+    if not enabled:
+        return None
+    sampled = SAMPLE_EVERY > 0 and next(_counter) % SAMPLE_EVERY == 0
+    if not sampled and not SLOW_MS:
+        return None
+    profile = RequestProfile(name, sampled)
+    _local.profile = profile
+    if STACKS:
+        _sampled_threads[threading.get_ident()] = profile
+        _start_sampler()
+    return profile
+
+
+def end(profile):
+    """Finish a profile from begin(), writing it out if it is kept."""
+    if profile is None:
+        return
+    _local.profile = None
+    _sampled_threads.pop(threading.get_ident(), None)
+    elapsed = time.perf_counter() - profile.started
+    if profile.sampled or (SLOW_MS and elapsed * 1000 >= SLOW_MS):
+        try:
+            _write(profile, elapsed)
+        except OSError as e:
+            event_log.log("error", profile=profile.name, error=str(e))
+
+
+def phase(name):
+    """
+    Context manager timing a phase (parse, upstream, build, serialize,
+    write) of the current thread's request, if it is being profiled.
+    """
+    profile = getattr(_local, "profile", None)
+    if profile is None:
+        return _NO_PHASE
+    return _Phase(profile, name)
+
+
+def annotate(detail):
+    """Describe the current thread's request in its profile, if it is profiled."""
+    profile = getattr(_local, "profile", None)
+    if profile is not None:
+        profile.detail = detail
+
+
+def _write(profile, elapsed):
+    accounted = sum(profile.phases.values())
+    phases = {
+        name: round(seconds * 1000, 3) for name, seconds in profile.phases.items()
+    }
+    phases["other"] = round(max(0.0, elapsed - accounted) * 1000, 3)
+    record = {
+        "time": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+        "pid": os.getpid(),
+        "request": profile.name,
+        "detail": profile.detail,
+        "sampled": profile.sampled,
+        "total_ms": round(elapsed * 1000, 3),
+        "phases_ms": phases,
+    }
+    root = (profile.detail or profile.name).split(" ", 1)[0] or "request"
+    stacks = "".join(
+        f"{root};{stack} {count}\n"
+        for stack, count in list((profile.stacks or {}).items())
+    )
+    with _write_lock:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(os.path.join(PROFILE_DIR, "requests.jsonl"), "a") as f:
+            f.write(json.dumps(record) + "\n")
+        if stacks:
+            with open(os.path.join(PROFILE_DIR, "stacks.folded"), "a") as f:
+                f.write(stacks)
+
+
+def _start_sampler():
+    global _sampler
+    _sampler_wakeup.set()
+    if _sampler is None:
+        with _write_lock:
+            if _sampler is None:
+                _sampler = threading.Thread(target=_sample_loop, daemon=True)
+                _sampler.start()
+
+
+def _sample_loop():
+    """Record the stack of every thread handling a profiled request."""
+    while True:
+        if not _sampled_threads:
+            # Sleep until a profiled request starts
+            _sampler_wakeup.clear()
+            if not _sampled_threads:
+                _sampler_wakeup.wait()
+        time.sleep(STACK_INTERVAL)
+        frames = sys._current_frames()
+        for ident, profile in list(_sampled_threads.items()):
+            frame = frames.get(ident)
+            if frame is not None:
+                profile.stacks[_collapse(frame)] += 1
+
+
+def _collapse(frame):
+    """A stack as "file:function;file:function", outermost first."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+configure()
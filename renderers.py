@@ -0,0 +1,210 @@
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+# A stream variant we can hand to a renderer. Cost is the nominal bitrate;
+# dlna_profile is its DLNA.ORG_PN media format profile, if it has one.
+StreamFormat = namedtuple(
+    "StreamFormat",
+    [
+        "itag",
+        "container",
+        "mime_type",
+        "video_codec",
+        "audio_codec",
+        "height",
+        "cost",
+        "dlna_profile",
+    ],
+)
+
+# Muxed (audio+video) formats offered by upstream, cheapest first
+STREAM_FORMATS = [
+    StreamFormat(
+        "18", "mp4", "video/mp4", "h264", "aac", 360, 500_000, "AVC_MP4_BL_L3L_SD_AAC"
+    ),
+    StreamFormat("43", "webm", "video/webm", "vp8", "vorbis", 360, 600_000, None),
+    StreamFormat(
+        "22",
+        "mp4",
+        "video/mp4",
+        "h264",
+        "aac",
+        720,
+        2_000_000,
+        "AVC_MP4_MP_HD_720p_AAC",
+    ),
+]
+
+FORMATS_BY_ITAG = {f.itag: f for f in STREAM_FORMATS}
+
+# DLNA.ORG_OP: streams can be seeked by byte range, and MP4 ones by time
+# too (TimeSeekRange.dlna.org), through the index of their keyframes
+DLNA_OP = "01"
+DLNA_OP_TIME_SEEK = "11"
+# DLNA.ORG_FLAGS: streaming transfer mode, background transfer mode,
+# connection stalling allowed, DLNA 1.5 (then 24 reserved zeros)
+DLNA_FLAGS = f"{0x01000000 | 0x00400000 | 0x00200000 | 0x00100000:08x}" + "0" * 24
+
+# Request headers that identify a renderer, in the order they are matched
+IDENTIFYING_HEADERS = (
+    "User-Agent",
+    "X-AV-Client-Info",
+    "X-AV-Physical-Unit-Info",
+    "FriendlyName.DLNA.ORG",
+)
+
+
+@lru_cache(maxsize=None)
+def protocol_info(stream_format, full=True):
+    """
+    The protocolInfo of a format. Its fourth field names the DLNA profile
+    and, in full, how the stream may be seeked and transferred, which
+    renderers otherwise find out by probing. ConnectionManager lists only
+    the profile.
+    """
+    return (
+        f"http-get:*:{stream_format.mime_type}:{content_features(stream_format, full)}"
+    )
+
+
+@lru_cache(maxsize=None)
+def content_features(stream_format, full=True):
+    """
+    The fourth field of a format's protocolInfo, which is also what the
+    contentFeatures.dlna.org header of its stream carries.
+    """
+    params = []
+    if stream_format.dlna_profile:
+        params.append(f"DLNA.ORG_PN={stream_format.dlna_profile}")
+    if full:
+        op = DLNA_OP_TIME_SEEK if stream_format.container == "mp4" else DLNA_OP
+        params += [f"DLNA.ORG_OP={op}", "DLNA.ORG_CI=0"]
+        params.append(f"DLNA.ORG_FLAGS={DLNA_FLAGS}")
+    return ";".join(params) or "*"
+
+
+class RendererProfile:
+    """What a family of renderers can decode and display."""
+
+    def __init__(
+        self,
+        name,
+        containers,
+        video_codecs,
+        audio_codecs,
+        max_height,
+        match=None,
+    ):
+        self.name = name
+        self.containers = frozenset(containers)
+        self.video_codecs = frozenset(video_codecs)
+        self.audio_codecs = frozenset(audio_codecs)
+        self.max_height = max_height
+        # Regex searched in the identifying headers
+        self.match = re.compile(match, re.IGNORECASE) if match else None
+        # protocolInfo strings for the formats this renderer can play
+        self.protocol_infos = list(
+            dict.fromkeys(
+                protocol_info(f, full=False) for f in STREAM_FORMATS if self.supports(f)
+            )
+        )
+
+    def supports(self, stream_format):
+        return (
+            stream_format.container in self.containers
+            and stream_format.video_codec in self.video_codecs
+            and stream_format.audio_codec in self.audio_codecs
+        )
+
+    @property
+    def stream_format(self):
+        return pick_format(self)
+
+    def __repr__(self):
+        return f"RendererProfile({self.name!r})"
+
+
+DEFAULT_PROFILE = RendererProfile(
+    "Generic DLNA renderer", ["mp4"], ["h264"], ["aac"], 720
+)
+
+PROFILES = [
+    RendererProfile(
+        "Samsung TV",
+        ["mp4", "webm", "mkv", "ts"],
+        ["h264", "hevc", "vp8", "vp9"],
+        ["aac", "mp3", "vorbis", "opus"],
+        2160,
+        match=r"SEC_HHP|Samsung",
+    ),
+    RendererProfile(
+        "LG TV",
+        ["mp4", "webm", "mkv", "ts"],
+        ["h264", "hevc", "vp8", "vp9"],
+        ["aac", "mp3", "vorbis", "opus"],
+        2160,
+        match=r"LGE|webOS|LG-",
+    ),
+    RendererProfile(
+        "Sony Bravia",
+        ["mp4", "ts"],
+        ["h264"],
+        ["aac", "mp3"],
+        1080,
+        match=r"BRAVIA|Sony",
+    ),
+    RendererProfile(
+        "Panasonic Viera",
+        ["mp4", "ts"],
+        ["h264"],
+        ["aac", "mp3"],
+        1080,
+        match=r"Panasonic|Viera",
+    ),
+    RendererProfile(
+        "Xbox",
+        ["mp4"],
+        ["h264"],
+        ["aac"],
+        1080,
+        match=r"Xbox|Windows-Media-Player",
+    ),
+    RendererProfile(
+        "Software player",
+        ["mp4", "webm", "mkv", "ts"],
+        ["h264", "hevc", "vp8", "vp9", "av1"],
+        ["aac", "mp3", "vorbis", "opus"],
+        2160,
+        match=r"VLC|Kodi|BubbleUPnP|foobar",
+    ),
+]
+
+
+@lru_cache(maxsize=256)
+def _match_identity(identity):
+    for profile in PROFILES:
+        if any(value and profile.match.search(value) for value in identity):
+            return profile
+    return DEFAULT_PROFILE
+
+
+def match_renderer(headers):
+    """Return the profile of the renderer that sent a request."""
+    identity = tuple(headers.get(name, "") for name in IDENTIFYING_HEADERS)
+    return _match_identity(identity)
+
+
+@lru_cache(maxsize=None)
+def pick_format(profile):
+    """
+    Pick the stream variant to offer a renderer: the highest resolution it
+    can use, and the cheapest compatible format at that resolution.
+    """
+    compatible = [f for f in STREAM_FORMATS if profile.supports(f)]
+    if not compatible:
+        return STREAM_FORMATS[0]
+    fitting = [f for f in compatible if f.height <= profile.max_height]
+    if not fitting:
+        return min(compatible, key=lambda f: (f.height, f.cost))
+    return min(fitting, key=lambda f: (-f.height, f.cost))
@@ -0,0 +1,172 @@
+import time
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import profiler
+
+# Seconds a page of search results is kept
+SEARCH_TTL = 600
+# Pages of search results kept at once, least recently used first out
+MAX_CACHED_PAGES = 256
+# Threads fetching search results. Few, so that keystrokes typed faster
+# than upstream answers queue up and can be cancelled.
+SEARCH_THREADS = 2
+# Seconds to wait for upstream before answering with results filtered
+# from a shorter query
+TYPEAHEAD_WAIT = 0.3
+# Seconds to wait for upstream otherwise
+SEARCH_TIMEOUT = 30
+
+
+class SearchCache:
+    """
+    Upstream search results, cached per query and page.
+
+    TV on-screen keyboards browse a new query on every keystroke. A fetch
+    still queued when a longer or shorter spelling of its query is asked
+    for is cancelled, since no one will look at its results, unless a
+    get() is already waiting on it. While
+    upstream works on a query, typeahead() answers from the cached results
+    of the longest shorter query it extends, filtered locally.
+    """
+
+    def __init__(self, search_page, max_age=SEARCH_TTL):
+        # (query, page) -> result rows
+        self.search_page = search_page
+        self.max_age = max_age
+        # (query, page) -> (fetched at, rows), least recently used first
+        self._results = OrderedDict()
+        # (query, page) -> Future of a queued or running fetch
+        self._inflight = {}
+        # (query, page) -> get() calls waiting on its fetch, which is then
+        # never cancelled
+        self._waiters = Counter()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(
+            max_workers=SEARCH_THREADS, thread_name_prefix="search"
+        )
+
+    def get(self, query, page=1):
+        """Return the result rows of a page of a query, fetching them if needed."""
+        query = normalize_query(query)
+        key = (query, page)
+        with profiler.phase("upstream"):
+            while True:
+                future = self._request(query, page, wait=True)
+                try:
+                    return future.result(timeout=SEARCH_TIMEOUT)
+                except CancelledError:
+                    # Cancelled as superseded before this call waited on it;
+                    # someone is looking at this query after all
+                    continue
+                finally:
+                    with self._lock:
+                        self._waiters[key] -= 1
+                        if not self._waiters[key]:
+                            del self._waiters[key]
+
+    def typeahead(self, query):
+        """
+        Start fetching the first page of a query. If upstream doesn't have
+        it within TYPEAHEAD_WAIT, return the results of a shorter query that
+        match it. Returns None when the page is ready, or when there is
+        nothing to filter; get() then finds it cached or in flight.
+        """
+        query = normalize_query(query)
+        future = self._request(query, 1)
+        shorter = self._longest_prefix(query)
+        if shorter is None:
+            return None
+        try:
+            with profiler.phase("upstream"):
+                future.result(timeout=TYPEAHEAD_WAIT)
+            return None
+        except (FutureTimeoutError, CancelledError):
+            words = query.split()
+            return [row for row in shorter if _matches(row, words)]
+
+    def recent_queries(self, limit):
+        """Queries with cached results, most recently used first."""
+        with self._lock:
+            queries = [query for query, page in reversed(self._results) if page == 1]
+        return queries[:limit]
+
+    def _request(self, query, page, wait=False):
+        """
+        Return a Future of the rows, from the cache or a new or running
+        fetch. With wait, the caller is counted as waiting on it.
+        """
+        key = (query, page)
+        with self._lock:
+            if wait:
+                self._waiters[key] += 1
+            cached = self._results.get(key)
+            if cached is not None and time.monotonic() - cached[0] < self.max_age:
+                self._results.move_to_end(key)
+                future = _done(cached[1])
+            else:
+                future = self._inflight.get(key)
+                if future is None:
+                    self._cancel_superseded(query)
+                    future = self._pool.submit(self._fetch, query, page)
+                    self._inflight[key] = future
+        return future
+
+    def _cancel_superseded(self, query):
+        """Cancel queued fetches for other spellings of a query being typed."""
+        for key, future in list(self._inflight.items()):
+            other = key[0]
+            if self._waiters[key]:
+                continue
+            if other != query and (query.startswith(other) or other.startswith(query)):
+                # Only succeeds if the fetch hasn't started
+                if future.cancel():
+                    del self._inflight[key]
+
+    def _fetch(self, query, page):
+        try:
+            rows = self.search_page(query, page)
+            with self._lock:
+                self._results[(query, page)] = (time.monotonic(), rows)
+                self._results.move_to_end((query, page))
+                while len(self._results) > MAX_CACHED_PAGES:
+                    self._results.popitem(last=False)
+            return rows
+        finally:
+            with self._lock:
+                self._inflight.pop((query, page), None)
+
+    def _longest_prefix(self, query):
+        """First page of the longest cached query that query extends."""
+        best = None
+        now = time.monotonic()
+        with self._lock:
+            for (other, page), (fetched_at, rows) in self._results.items():
+                if (
+                    page == 1
+                    and other != query
+                    and query.startswith(other)
+                    and now - fetched_at < self.max_age
+                    and (best is None or len(other) > len(best[0]))
+                ):
+                    best = (other, rows)
+        return None if best is None else best[1]
+
+
+def normalize_query(query):
+    """Queries differing only in case and spacing share results."""
+    return " ".join(query.casefold().split())
+
+
+def _matches(row, words):
+    text = f"{row.get('title') or ''} {row.get('author') or ''}".casefold()
+    return all(word in text for word in words)
+
+
+def _done(result):
+    """A completed Future, so cached and fetched results are handled alike."""
+    future = Future()
+    future.set_result(result)
+    return future
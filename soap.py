@@ -0,0 +1,173 @@
+from functools import lru_cache
+from xml.etree.ElementTree import ParseError
+
+SOAP_ENV_NS = "http://schemas.xmlsoap.org/soap/envelope/"
+UPNP_CONTROL_NS = "urn:schemas-upnp-org:control-1-0"
+
+# Largest control request body we are willing to parse
+MAX_REQUEST_SIZE = 64 * 1024
+# Largest value accepted for a single action argument
+MAX_ARGUMENT_LENGTH = 4096
+
+# UPnP error codes (UPnP Device Architecture 1.0, section 3.2.2)
+INVALID_ACTION = 401
+INVALID_ARGS = 402
+ACTION_FAILED = 501
+# ContentDirectory error codes
+NO_SUCH_OBJECT = 701
+INVALID_SORT_CRITERIA = 709
+CANNOT_PROCESS = 720
+
+_ENVELOPE_HEAD = (
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    f'<s:Envelope xmlns:s="{SOAP_ENV_NS}" '
+    's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">'
+    "<s:Body>"
+).encode("utf-8")
+_ENVELOPE_TAIL = b"</s:Body></s:Envelope>"
+
+ERROR_DESCRIPTIONS = {
+    INVALID_ACTION: "Invalid Action",
+    INVALID_ARGS: "Invalid Args",
+    ACTION_FAILED: "Action Failed",
+    NO_SUCH_OBJECT: "No such object",
+    INVALID_SORT_CRITERIA: "Unsupported or invalid sort criteria",
+    CANNOT_PROCESS: "Cannot process the request",
+}
+
+
+class UPnPError(Exception):
+    """An error to be reported to the control point as a SOAP fault."""
+
+    def __init__(self, code, description=None):
+        self.code = code
+        self.description = description or ERROR_DESCRIPTIONS.get(code, "Error")
+        super().__init__(f"{code} {self.description}")
+
+
+def parse_soap_action(header):
+    """
+    Split a SOAPACTION header into (service type, action name).
+
+    E.g. '"urn:schemas-upnp-org:service:ContentDirectory:1#Browse"' ->
+        ('urn:schemas-upnp-org:service:ContentDirectory:1', 'Browse')
+    """
+    if not header:
+        raise UPnPError(INVALID_ACTION)
+    service_type, sep, action = header.strip().strip('"').partition("#")
+    if not sep or not action:
+        raise UPnPError(INVALID_ACTION)
+    return service_type, action
+
+
+def _local_name(tag):
+    return tag.rpartition("}")[2]
+
+
+def parse_arguments(body, action, names):
+    """
+    Extract the named input arguments of an action from a SOAP request.
+
+    Only Envelope/Body/<action>/<argument> is visited, rather than searching
+    the whole document. Missing arguments are returned as None.
+    """
+    if len(body) > MAX_REQUEST_SIZE:
+        raise UPnPError(INVALID_ARGS, "Request too large")
+    import defusedxml.ElementTree
+    from defusedxml import DefusedXmlException
+
+    try:
+        envelope = defusedxml.ElementTree.fromstring(body)
+    except (ParseError, DefusedXmlException) as err:
+        raise UPnPError(INVALID_ARGS, "Malformed request") from err
+
+    soap_body = envelope.find(f"{{{SOAP_ENV_NS}}}Body")
+    if soap_body is None or len(soap_body) == 0:
+        raise UPnPError(INVALID_ARGS, "Missing SOAP body")
+    action_el = soap_body[0]
+    if _local_name(action_el.tag) != action:
+        raise UPnPError(INVALID_ACTION)
+
+    args = dict.fromkeys(names)
+    for arg_el in action_el:
+        name = _local_name(arg_el.tag)
+        if name not in args:
+            continue
+        value = arg_el.text or ""
+        if len(value) > MAX_ARGUMENT_LENGTH:
+            raise UPnPError(INVALID_ARGS, f"{name} too long")
+        args[name] = value
+    return args
+
+
+def parse_uint(args, name, default=0):
+    """Read a ui4 argument, raising Invalid Args if it is not a number."""
+    value = args.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        number = int(value)
+    except ValueError as err:
+        raise UPnPError(INVALID_ARGS, f"{name} is not an integer") from err
+    if number < 0:
+        raise UPnPError(INVALID_ARGS, f"{name} is negative")
+    return number
+
+
+def escape(text):
+    """
+    Escape character data for an XML element. Chained str.replace is
+    much faster than str.translate for large DIDL-Lite results.
+    """
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+@lru_cache(maxsize=None)
+def _response_fragments(action, service_type, arg_names):
+    """
+    Precompute the constant byte fragments of an action response: the
+    envelope prefix, the open/close tag of each argument, and the suffix.
+    """
+    prefix = _ENVELOPE_HEAD + (
+        f'<u:{action}Response xmlns:u="{service_type}">'.encode("utf-8")
+    )
+    arg_tags = tuple(
+        (f"<{name}>".encode("utf-8"), f"</{name}>".encode("utf-8"))
+        for name in arg_names
+    )
+    suffix = f"</u:{action}Response>".encode("utf-8") + _ENVELOPE_TAIL
+    return prefix, arg_tags, suffix
+
+
+def build_response(action, service_type, args):
+    """
+    Build an action response as a list of byte fragments, ready for a
+    vectored write. Only argument values are escaped and encoded per call.
+    """
+    prefix, arg_tags, suffix = _response_fragments(action, service_type, tuple(args))
+    fragments = [prefix]
+    for (open_tag, close_tag), value in zip(arg_tags, args.values()):
+        fragments.append(open_tag)
+        fragments.append(escape(str(value)).encode("utf-8"))
+        fragments.append(close_tag)
+    fragments.append(suffix)
+    return fragments
+
+
+def generate_fault(error):
+    """Build a SOAP fault envelope carrying a UPnPError."""
+    return f"""<?xml version="1.0" encoding="utf-8"?>
+<s:Envelope xmlns:s="{SOAP_ENV_NS}" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
+  <s:Body>
+    <s:Fault>
+      <faultcode>s:Client</faultcode>
+      <faultstring>UPnPError</faultstring>
+      <detail>
+        <UPnPError xmlns="{UPNP_CONTROL_NS}">
+          <errorCode>{error.code}</errorCode>
+          <errorDescription>{error.description}</errorDescription>
+        </UPnPError>
+      </detail>
+    </s:Fault>
+  </s:Body>
+</s:Envelope>""".encode("utf-8")
@@ -4,6 +4,36 @@ import threading
 
 MCAST_GRP = "239.255.255.250"
 MCAST_PORT = 1900
+# Seconds between ssdp:alive announcements
+ANNOUNCE_INTERVAL = 30
+
+def get_local_ip():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.connect(("8.8.8.8", 80))
+        return s.getsockname()[0]
+    finally:
+        s.close()
+
+def alive_messages(location, server_uuid):
+    """The ssdp:alive NOTIFY datagrams announcing the device."""
+    targets = [
+        "upnp:rootdevice",
+        f"uuid:{server_uuid}",
+        "urn:schemas-upnp-org:device:MediaServer:1",
+    ]
+    return [
+        (
+            f"NOTIFY * HTTP/1.1\r\n"
+            f"HOST: {MCAST_GRP}:{MCAST_PORT}\r\n"
+            f"CACHE-CONTROL: max-age=1800\r\n"
+            f"LOCATION: {location}\r\n"
+            f"NT: {target}\r\n"
+            f"NTS: ssdp:alive\r\n"
+            f"USN: uuid:{server_uuid}::{target}\r\n\r\n"
+        ).encode()
+        for target in targets
+    ]
 
 class SSDPServer:
     def __init__(self, port, server_uuid):
@@ -13,12 +43,7 @@ class SSDPServer:
         self.thread = None
 
     def _get_local_ip(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        try:
-            s.connect(("8.8.8.8", 80))
-            return s.getsockname()[0]
-        finally:
-            s.close()
+        return get_local_ip()
 
     def _broadcast_presence(self):
         ip = self._get_local_ip()
@@ -27,24 +52,9 @@ class SSDPServer:
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
 
-        targets = [
-            "upnp:rootdevice",
-            f"uuid:{self.server_uuid}",
-            "urn:schemas-upnp-org:device:MediaServer:1",
-        ]
-
         try:
-            for target in targets:
-                msg = (
-                    f"NOTIFY * HTTP/1.1\r\n"
-                    f"HOST: {MCAST_GRP}:{MCAST_PORT}\r\n"
-                    f"CACHE-CONTROL: max-age=1800\r\n"
-                    f"LOCATION: {location}\r\n"
-                    f"NT: {target}\r\n"
-                    f"NTS: ssdp:alive\r\n"
-                    f"USN: uuid:{self.server_uuid}::{target}\r\n\r\n"
-                )
-                sock.sendto(msg.encode(), (MCAST_GRP, MCAST_PORT))
+            for msg in alive_messages(location, self.server_uuid):
+                sock.sendto(msg, (MCAST_GRP, MCAST_PORT))
         except Exception as e:
             print(f"SSDP Broadcast error: {e}")
         finally:
@@ -55,7 +65,7 @@ class SSDPServer:
             # Initial burst
             self._broadcast_presence()
             while not self._stop_event.is_set():
-                time.sleep(30)
+                time.sleep(ANNOUNCE_INTERVAL)
                 if not self._stop_event.is_set():
                     self._broadcast_presence()
 
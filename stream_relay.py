@@ -0,0 +1,285 @@
+import time
+import threading
+
+import event_log
+
+# Bytes of a stream kept in memory and shared by its viewers
+RING_SIZE = 16 * 1024 * 1024
+# How far the upstream fetch may run ahead of the fastest viewer
+READ_AHEAD = RING_SIZE // 2
+# Size of each read from upstream and each write to a viewer
+CHUNK_SIZE = 64 * 1024
+# A viewer may join a running fetch this many bytes ahead of its position
+JOIN_AHEAD = 1024 * 1024
+# Seconds a fetch with no viewers is kept before closing upstream
+LINGER = 10
+# Seconds to wait for upstream before giving up on a viewer
+UPSTREAM_TIMEOUT = 30
+# Statuses upstream answers a signed URL with once it expired or was
+# revoked; the URL is resolved again rather than the viewer failed
+REFUSED_STATUSES = (403, 410)
+
+
+class RelayError(Exception):
+    """Raised when upstream could not be fetched."""
+
+
+class FellBehind(Exception):
+    """Raised when a viewer's position has already left the ring buffer."""
+
+
+class SharedStream:
+    """
+    A single upstream fetch of one (video, format) starting at a byte offset.
+    Data is written into a ring buffer that every attached viewer reads from
+    at its own pace; the fetch is paced by the fastest viewer.
+    """
+
+    def __init__(self, relay, key, start):
+        self.relay = relay
+        self.key = key
+        # Resolved by the fetch thread, so opening never waits on it
+        self.url = None
+        self.start = start
+        self.ring = bytearray(RING_SIZE)
+        # Absolute offsets: [base, end) is held in the ring
+        self.base = start
+        self.end = start
+        self.total_length = None
+        self.content_type = None
+        self.done = False
+        self.error = None
+        self.ready = threading.Event()
+        self.cond = threading.Condition()
+        # viewer id -> absolute position
+        self.positions = {}
+        # Furthest position any viewer has reached
+        self.leader = start
+        self.idle_since = time.monotonic()
+        self.thread = threading.Thread(target=self._fetch, daemon=True)
+
+    def covers(self, pos):
+        """Whether a viewer at pos can be served from this fetch."""
+        with self.cond:
+            if self.error or (self.done and pos >= self.end):
+                return False
+            return self.base <= pos <= self.end + JOIN_AHEAD
+
+    def attach(self, viewer_id, pos):
+        with self.cond:
+            self.positions[viewer_id] = pos
+            self.leader = max(self.leader, pos)
+            self.cond.notify_all()
+
+    def detach(self, viewer_id):
+        with self.cond:
+            self.positions.pop(viewer_id, None)
+            if not self.positions:
+                self.idle_since = time.monotonic()
+            self.cond.notify_all()
+
+    def read(self, viewer_id, pos, size):
+        """Return up to size bytes at pos, waiting for upstream if needed."""
+        with self.cond:
+            while pos >= self.end and not self.done and not self.error:
+                if not self.cond.wait(UPSTREAM_TIMEOUT):
+                    raise RelayError("upstream stalled")
+            if pos < self.base:
+                raise FellBehind(pos)
+            if self.error and pos >= self.end:
+                raise RelayError(self.error)
+            size = min(size, self.end - pos)
+            offset = pos % RING_SIZE
+            if offset + size <= RING_SIZE:
+                data = bytes(self.ring[offset : offset + size])
+            else:
+                head = RING_SIZE - offset
+                data = bytes(self.ring[offset:]) + bytes(self.ring[: size - head])
+            self.positions[viewer_id] = pos + len(data)
+            self.leader = max(self.leader, pos + len(data))
+            self.cond.notify_all()
+            return data
+
+    def _write(self, data):
+        with self.cond:
+            # Don't run more than READ_AHEAD past the fastest viewer
+            while not self.relay.stopping:
+                if self.end - self.leader < READ_AHEAD:
+                    break
+                self.cond.wait(1)
+                if self._idle_too_long():
+                    return False
+            offset = self.end % RING_SIZE
+            head = min(len(data), RING_SIZE - offset)
+            self.ring[offset : offset + head] = data[:head]
+            self.ring[: len(data) - head] = data[head:]
+            self.end += len(data)
+            self.base = max(self.base, self.end - RING_SIZE)
+            self.cond.notify_all()
+            return not self._idle_too_long()
+
+    def _idle_too_long(self):
+        return not self.positions and time.monotonic() - self.idle_since > LINGER
+
+    def _fetch(self):
+        import requests
+
+        try:
+            headers = {"Range": f"bytes={self.start}-"} if self.start else {}
+            with self._open(headers) as response:
+                response.raise_for_status()
+                self.content_type = response.headers.get("Content-Type")
+                self.total_length = self._total_length(response)
+                # Upstream ignored the Range header, so skip up to our start
+                skip = self.start if response.status_code == 200 else 0
+                self.ready.set()
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    if skip:
+                        dropped = min(skip, len(chunk))
+                        chunk, skip = chunk[dropped:], skip - dropped
+                    if chunk and not self._write(chunk):
+                        break
+        except Exception as e:
+            self.error = str(e)
+            event_log.log(
+                "stream", video_id=self.key[0], itag=self.key[1], error=str(e)
+            )
+        finally:
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+            self.ready.set()
+            self.relay._remove(self)
+
+    def _open(self, headers):
+        """
+        The upstream response, resolving the URL once more if upstream
+        refused it or its instance couldn't be reached.
+        """
+        import requests
+
+        for retry in (False, True):
+            self.url = self.relay.resolve_url(*self.key)
+            try:
+                response = requests.get(
+                    self.url, headers=headers, stream=True, timeout=UPSTREAM_TIMEOUT
+                )
+            except requests.ConnectionError as e:
+                if retry:
+                    raise
+                reason = str(e)
+            else:
+                if retry or response.status_code not in REFUSED_STATUSES:
+                    return response
+                response.close()
+                reason = f"upstream returned {response.status_code}"
+            event_log.log(
+                "stream", video_id=self.key[0], itag=self.key[1], reresolve=reason
+            )
+            self.relay.invalidate_url(self.key[0])
+
+    @staticmethod
+    def _total_length(response):
+        content_range = response.headers.get("Content-Range", "")
+        if "/" in content_range and not content_range.endswith("*"):
+            return int(content_range.rsplit("/", 1)[1])
+        if response.status_code == 200 and "Content-Length" in response.headers:
+            return int(response.headers["Content-Length"])
+        return None
+
+
+class RelayReader:
+    """A viewer's cursor into the shared fetches of one (video, format)."""
+
+    def __init__(self, relay, key, stream, pos):
+        self.relay = relay
+        self.key = key
+        self.stream = stream
+        self.pos = pos
+        stream.attach(id(self), pos)
+
+    @property
+    def total_length(self):
+        return self.stream.total_length
+
+    @property
+    def content_type(self):
+        return self.stream.content_type
+
+    def wait_ready(self):
+        """Wait for upstream response headers, raising RelayError on failure."""
+        if not self.stream.ready.wait(UPSTREAM_TIMEOUT):
+            raise RelayError("upstream timed out")
+        if self.stream.error:
+            raise RelayError(self.stream.error)
+
+    def read(self, size=CHUNK_SIZE):
+        """Return the next chunk, or b"" at the end of the stream."""
+        while True:
+            try:
+                data = self.stream.read(id(self), self.pos, size)
+            except FellBehind:
+                # Too slow for the shared buffer; continue on our own fetch
+                self.stream.detach(id(self))
+                self.stream = self.relay._start(self.key, self.pos)
+                self.stream.attach(id(self), self.pos)
+                continue
+            self.pos += len(data)
+            return data
+
+    def close(self):
+        self.stream.detach(id(self))
+
+
+class StreamRelay:
+    """
+    Relays upstream media to renderers, sharing one upstream fetch between
+    viewers of the same (video, format) whose positions are close together.
+    """
+
+    def __init__(self, resolve_url, invalidate_url=None):
+        # (video_id, itag) -> url
+        self.resolve_url = resolve_url
+        # video_id -> None, forgetting the URLs upstream refused
+        self.invalidate_url = invalidate_url or (lambda video_id: None)
+        self.stopping = False
+        # (video_id, itag) -> running SharedStreams
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def open(self, video_id, itag, start=0):
+        """Attach a new viewer at byte offset start."""
+        key = (video_id, itag)
+        with self._lock:
+            stream = next(
+                (s for s in self._streams.get(key, ()) if s.covers(start)), None
+            )
+            if stream is None:
+                stream = self._start_locked(key, start)
+        return RelayReader(self, key, stream, start)
+
+    def stop(self):
+        self.stopping = True
+
+    def active_keys(self):
+        """The (video_id, itag) keys being fetched from upstream."""
+        with self._lock:
+            return list(self._streams)
+
+    def _start(self, key, start):
+        with self._lock:
+            return self._start_locked(key, start)
+
+    def _start_locked(self, key, start):
+        stream = SharedStream(self, key, start)
+        self._streams.setdefault(key, []).append(stream)
+        stream.thread.start()
+        return stream
+
+    def _remove(self, stream):
+        with self._lock:
+            streams = self._streams.get(stream.key, [])
+            if stream in streams:
+                streams.remove(stream)
+            if not streams:
+                self._streams.pop(stream.key, None)
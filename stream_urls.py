@@ -0,0 +1,237 @@
+import re
+import time
+import queue
+import itertools
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import event_log
+
+# Seconds before a signed URL expires at which it is resolved again
+REFRESH_BEFORE = 600
+# A URL with less than this many seconds left isn't handed out; a stream
+# started on it could need to reconnect after it expires
+MIN_REMAINING = 120
+# Lifetime assumed for a URL without an expire parameter
+DEFAULT_LIFETIME = 1800
+# Seconds after a video was last played during which its URLs are kept fresh
+KEEP_WARM = 3600
+# Seconds between checks for URLs due to be resolved again
+REFRESH_INTERVAL = 30
+# Threads resolving URLs
+RESOLVE_THREADS = 4
+# Resolves waiting for a thread beyond which new prefetches are dropped
+MAX_QUEUED = 32
+# Seconds to wait for a URL that wasn't resolved in advance
+RESOLVE_TIMEOUT = 15
+# Formats whose details (size, duration...) are kept, least recently used
+# first out
+MAX_DETAILS = 4096
+
+# Queue priorities, the lowest is resolved first
+_PLAYING, _RECENT, _PREFETCH = 0, 1, 2
+
+# expire=<unix time> in the query, or /expire/<unix time>/ in the path
+_EXPIRE = re.compile(r"[?&/]expire[=/](\d+)")
+
+
+class StreamUrlCache:
+    """
+    Signed upstream media URLs per (video, format), resolved ahead of use.
+
+    Upstream URLs carry an expire parameter. Each one is resolved again
+    REFRESH_BEFORE seconds before it expires, those of videos being played
+    first, so that pressing play or a range request mid-stream takes its
+    URL from here without waiting on upstream, and never gets one that
+    expires before the request is made. Listed videos are resolved in the
+    background, so the URL is usually here before play is pressed.
+
+    resolve(video_id) returns {itag: (url, details)} for every format of a
+    video, as one upstream call answers for all of them; details is a dict
+    of what upstream tells of the format, such as its size. Details are
+    kept after the URLs expire. fallback(video_id, itag) is used for a
+    format resolve didn't return.
+    """
+
+    def __init__(self, resolve, fallback):
+        self.resolve = resolve
+        self.fallback = fallback
+        # Returns the (video_id, itag) keys being streamed; set by the relay
+        self.playing = tuple
+        # (video_id, itag) -> (url, expires at in time.time() seconds)
+        self._urls = {}
+        # (video_id, itag) -> details, least recently used first
+        self._details = OrderedDict()
+        # video_id -> time.monotonic() it was last played
+        self._played = {}
+        # video_id -> Future of a queued or running resolve
+        self._inflight = {}
+        # (priority, order, video_id); a video may be queued more than once
+        # when its priority rises, the first one out resolves it
+        self._queue = queue.PriorityQueue()
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self.threads = []
+
+    def start(self):
+        """Start the resolving and refreshing threads; safe to call more than once."""
+        if self.threads:
+            return
+        self.threads = [threading.Thread(target=self._refresh_loop, daemon=True)]
+        self.threads += [
+            threading.Thread(target=self._resolve_loop, daemon=True)
+            for _ in range(RESOLVE_THREADS)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        for _ in range(RESOLVE_THREADS):
+            self._queue.put((-1, 0, None))
+
+    def get(self, video_id, itag):
+        """The URL of a video in a format, resolving it now if it isn't cached."""
+        key = (video_id, str(itag))
+        with self._lock:
+            self._played[video_id] = time.monotonic()
+            url = self._fresh(key)
+        if url is not None:
+            return url
+        self.start()
+        try:
+            self._enqueue(video_id, _PLAYING).result(timeout=RESOLVE_TIMEOUT)
+        except Exception as e:
+            event_log.log("upstream", resolve=video_id, error=str(e))
+        with self._lock:
+            url = self._fresh(key)
+        return url if url is not None else self.fallback(video_id, itag)
+
+    def prefetch(self, video_id, itag):
+        """Resolve a video in the background if its URL isn't cached."""
+        with self._lock:
+            if self._fresh((video_id, str(itag))) is not None:
+                return
+        if self._queue.qsize() < MAX_QUEUED:
+            self._enqueue(video_id, _PREFETCH)
+
+    def invalidate(self, video_id):
+        """
+        Forget the URLs of a video, as upstream refused one or its instance
+        is down, so the next get() resolves them again.
+        """
+        with self._lock:
+            for key in [key for key in self._urls if key[0] == video_id]:
+                del self._urls[key]
+
+    def details(self, video_id, itag):
+        """What is known of a format, without waiting: a dict, maybe empty."""
+        key = (video_id, str(itag))
+        with self._lock:
+            details = self._details.get(key)
+            if details is None:
+                return {}
+            self._details.move_to_end(key)
+            return details
+
+    def record_details(self, video_id, itag, **details):
+        """Add what was learnt of a format elsewhere, such as by streaming it."""
+        with self._lock:
+            self._merge_details((video_id, str(itag)), details)
+
+    def _merge_details(self, key, details):
+        merged = dict(self._details.get(key, {}))
+        merged.update((name, value) for name, value in details.items() if value)
+        self._details[key] = merged
+        self._details.move_to_end(key)
+        while len(self._details) > MAX_DETAILS:
+            self._details.popitem(last=False)
+
+    def _fresh(self, key):
+        entry = self._urls.get(key)
+        if entry is not None and entry[1] - time.time() > MIN_REMAINING:
+            return entry[0]
+        return None
+
+    def _enqueue(self, video_id, priority):
+        """Queue a resolve of a video and return its Future."""
+        order = next(self._order)
+        with self._lock:
+            future = self._inflight.get(video_id)
+            if future is None:
+                future = self._inflight[video_id] = Future()
+            elif future.running():
+                return future
+        # The latest prefetches first, they are what the renderer shows now
+        self._queue.put(
+            (priority, -order if priority == _PREFETCH else order, video_id)
+        )
+        return future
+
+    def _resolve_loop(self):
+        while True:
+            priority, order, video_id = self._queue.get()
+            if video_id is None:
+                return
+            with self._lock:
+                future = self._inflight.get(video_id)
+                # Already resolved through an earlier queue entry
+                if future is None or future.running():
+                    continue
+                future.set_running_or_notify_cancel()
+            try:
+                formats = self.resolve(video_id)
+            except Exception as e:
+                with self._lock:
+                    del self._inflight[video_id]
+                future.set_exception(e)
+                continue
+            now = time.time()
+            with self._lock:
+                for itag, (url, details) in formats.items():
+                    key = (video_id, str(itag))
+                    self._urls[key] = (url, url_expiry(url, now))
+                    self._merge_details(key, details)
+                del self._inflight[video_id]
+            future.set_result(formats)
+
+    def _refresh_loop(self):
+        while not self._stop_event.wait(REFRESH_INTERVAL):
+            try:
+                self._refresh_due()
+            except Exception as e:
+                event_log.log("upstream", refresh="stream URLs", error=str(e))
+
+    def _refresh_due(self):
+        """
+        Queue the videos whose URLs expire within REFRESH_BEFORE, those being
+        played first and the soonest to expire first, and forget URLs no one
+        has played lately once they expire.
+        """
+        now, wall = time.monotonic(), time.time()
+        playing = {video_id for video_id, itag in self.playing()}
+        due = {}
+        with self._lock:
+            for video_id in playing:
+                self._played[video_id] = now
+            for video_id, played_at in list(self._played.items()):
+                if now - played_at >= KEEP_WARM:
+                    del self._played[video_id]
+            for key, (url, expires_at) in list(self._urls.items()):
+                video_id = key[0]
+                if expires_at - wall >= REFRESH_BEFORE:
+                    continue
+                if video_id in self._played:
+                    due[video_id] = min(expires_at, due.get(video_id, expires_at))
+                elif expires_at <= wall:
+                    del self._urls[key]
+        for video_id in sorted(due, key=lambda v: (v not in playing, due[v])):
+            self._enqueue(video_id, _PLAYING if video_id in playing else _RECENT)
+
+
+def url_expiry(url, now):
+    """When a signed URL expires, in time.time() seconds."""
+    match = _EXPIRE.search(url)
+    return int(match.group(1)) if match else now + DEFAULT_LIFETIME
@@ -0,0 +1,160 @@
+import time
+import threading
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+
+import event_log
+
+# Seconds between refreshes of a channel that has uploaded lately
+REFRESH_INTERVAL = 600
+# A channel with nothing new is refreshed half as often each time, down to
+# once in this many seconds
+MAX_REFRESH_INTERVAL = 6 * 3600
+# Seconds between checks for channels due to be refreshed
+CHECK_INTERVAL = 30
+# Channels refreshed at once
+REFRESH_THREADS = 4
+# Pages of a channel read at most in one refresh, when more than a page of
+# uploads is new
+MAX_PAGES = 3
+# Newest uploads kept in the feed; older ones fall off its end
+MAX_ITEMS = 500
+
+
+class SubscriptionFeed:
+    """
+    The newest uploads of a set of channels, merged into one feed, newest
+    first.
+
+    A background thread refreshes the channels that are due, REFRESH_THREADS
+    at a time. A refresh reads a channel's listing only as far as the first
+    page holding a video it has seen before, so it costs the uploads since
+    the last one, and only those are merged into the feed: each is put in
+    place by bisection, in a list kept in order, so listing the feed never
+    sorts or merges it. Channels with nothing new are refreshed less and
+    less often.
+
+    fetch_page(ucid, cursor) returns (rows, total, next cursor, title) for a
+    page of a channel's videos, newest first; make_items(rows) turns rows
+    into the objects the feed holds. on_change(items), if set, is called
+    with the whole feed after a refresh changed it.
+    """
+
+    def __init__(self, channels, fetch_page, make_items):
+        self.channels = list(dict.fromkeys(channels))
+        self.fetch_page = fetch_page
+        self.make_items = make_items
+        self.on_change = None
+        # (-published, video id) of each item, ascending: newest first
+        self._keys = []
+        self._items = []
+        self._ids = set()
+        # ucid -> video ids on the pages its last refresh read
+        self._seen = {}
+        # ucid -> (time.monotonic() of its next refresh, interval)
+        self._due = {ucid: (0.0, REFRESH_INTERVAL) for ucid in self.channels}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(
+            max_workers=REFRESH_THREADS, thread_name_prefix="subscriptions"
+        )
+        self._stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Start refreshing in the background; safe to call more than once."""
+        if self.thread is None and self.channels:
+            self.thread = threading.Thread(target=self._refresh_loop, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def items(self):
+        """The whole feed, newest first."""
+        with self._lock:
+            return list(self._items)
+
+    def refresh(self):
+        """
+        Refresh the channels that are due, in parallel, and return the
+        number of uploads added to the feed.
+        """
+        now = time.monotonic()
+        due = [ucid for ucid, (at, _) in self._due.items() if at <= now]
+        added = sum(self._pool.map(self._refresh_channel, due))
+        if added and self.on_change:
+            self.on_change(self.items())
+        return added
+
+    def _refresh_loop(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                event_log.log("upstream", refresh="subscriptions", error=str(e))
+            if self._stop_event.wait(CHECK_INTERVAL):
+                return
+
+    def _refresh_channel(self, ucid):
+        first_time = ucid not in self._seen
+        try:
+            rows = self._new_rows(ucid)
+        except Exception as e:
+            event_log.log("upstream", refresh=f"channel:{ucid}", error=str(e))
+            rows = None
+        interval = self._due[ucid][1]
+        if rows or first_time:
+            interval = REFRESH_INTERVAL
+        else:
+            interval = min(interval * 2, MAX_REFRESH_INTERVAL)
+        self._due[ucid] = (time.monotonic() + interval, interval)
+        return self._merge(rows) if rows else 0
+
+    def _new_rows(self, ucid):
+        """The videos of a channel its last refresh didn't see, newest first."""
+        seen = self._seen.get(ucid)
+        new_rows = []
+        read = set()
+        cursor = None
+        for _ in range(MAX_PAGES):
+            rows, _, cursor, _ = self.fetch_page(ucid, cursor)
+            ids = [row.get("videoId") for row in rows]
+            read.update(ids)
+            new_rows += [
+                row for row in rows if seen is None or row.get("videoId") not in seen
+            ]
+            # The first refresh lists a page, later ones stop where they caught up
+            if seen is None or not cursor or not seen.isdisjoint(ids):
+                break
+        # Whatever is still on the first page next time was seen now
+        self._seen[ucid] = read
+        return new_rows
+
+    def _merge(self, rows):
+        """Put new uploads in place in the feed; returns how many were added."""
+        rows = [row for row in rows if row.get("videoId")]
+        items = self.make_items(rows)
+        added = 0
+        with self._lock:
+            for row, item in zip(rows, items):
+                if row["videoId"] in self._ids:
+                    continue
+                key = (-_published(row), row["videoId"])
+                i = bisect_left(self._keys, key)
+                self._keys.insert(i, key)
+                self._items.insert(i, item)
+                self._ids.add(row["videoId"])
+                added += 1
+            for _, video_id in self._keys[MAX_ITEMS:]:
+                self._ids.discard(video_id)
+            del self._keys[MAX_ITEMS:]
+            del self._items[MAX_ITEMS:]
+        return added
+
+
+def _published(row):
+    # Unix time, as Invidious lists it
+    try:
+        return float(row.get("published") or 0)
+    except (TypeError, ValueError):
+        return 0.0
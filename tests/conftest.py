@@ -0,0 +1,34 @@
+import os
+import sys
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+# The modules live at the top of the repository, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import StandInHandler  # noqa: E402
+
+
+@pytest.fixture
+def stand_in():
+    """
+    Start stand-in instances: stand_in(delay) returns (url, server), with
+    server.delay() returning delay.
+    """
+    servers = []
+
+    def start(delay):
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+        httpd.daemon_threads = True
+        httpd.delay = lambda: delay
+        httpd.hits = 0
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        servers.append(httpd)
+        return f"http://127.0.0.1:{httpd.server_address[1]}/", httpd
+
+    yield start
+    for httpd in servers:
+        httpd.shutdown()
+        httpd.server_close()
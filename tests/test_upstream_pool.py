@@ -0,0 +1,86 @@
+import socket
+import time
+
+import pytest
+
+import upstream_pool
+from upstream_pool import MIN_SAMPLES, UpstreamPool, UpstreamUnavailable
+
+
+def unused_url():
+    """The URL of a port nothing listens on, like an instance that is down."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{sock.getsockname()[1]}/"
+
+
+def seed(instance, latency, count=MIN_SAMPLES):
+    for _ in range(count):
+        instance.record_success(latency)
+
+
+def test_ranking_ignores_occasional_stalls():
+    pool = UpstreamPool(["http://stalling/", "http://steady/"])
+    stalling, steady = pool.instances
+    seed(stalling, 0.02, 9)
+    stalling.record_success(1.0)
+    seed(steady, 0.08, 10)
+    assert pool.best() is stalling
+
+
+def test_hedge_fires_and_updates_the_loser(stand_in):
+    slow_url, slow = stand_in(1.0)
+    fast_url, fast = stand_in(0.01)
+    pool = UpstreamPool([slow_url, fast_url])
+    # Ranked first on its history, but now it stalls
+    seed(pool.instances[0], 0.01)
+    seed(pool.instances[1], 0.02)
+    started = time.monotonic()
+    response = pool.get("api/v1/trending", timeout=5)
+    assert response.status_code == 200
+    assert time.monotonic() - started < 0.5
+    assert slow.hits == 1 and fast.hits == 1
+    # The stall counts against the slow instance without waiting for it
+    assert len(pool.instances[0].samples) == MIN_SAMPLES + 1
+    assert pool.instances[0].samples[-1] >= upstream_pool.MIN_HEDGE_DELAY
+    # and its eventual answer isn't counted a second time
+    time.sleep(1.2)
+    assert len(pool.instances[0].samples) == MIN_SAMPLES + 1
+
+
+def test_failover_to_a_healthy_instance(stand_in):
+    failing_url, failing = stand_in(None)
+    healthy_url, healthy = stand_in(0.01)
+    pool = UpstreamPool([unused_url(), failing_url, healthy_url])
+    response = pool.get("api/v1/trending", timeout=5)
+    assert response.status_code == 200
+    assert failing.hits == 1 and healthy.hits == 1
+    down, failing_instance, healthy_instance = pool.instances
+    assert down.failures == 1 and failing_instance.failures == 1
+    assert healthy_instance.failures == 0
+
+
+def test_circuit_opens_and_closes(stand_in, monkeypatch):
+    monkeypatch.setattr(upstream_pool, "OPEN_SECONDS", 0.2)
+    url, server = stand_in(None)
+    pool = UpstreamPool([url])
+    instance = pool.instances[0]
+    for _ in range(upstream_pool.FAILURE_THRESHOLD):
+        with pytest.raises(UpstreamUnavailable):
+            pool.get("api/v1/trending", timeout=5)
+    assert not instance.available(time.monotonic())
+
+    # Requests keep away while the circuit is open...
+    healthy_url, healthy = stand_in(0.01)
+    pool.instances.append(upstream_pool.Instance(healthy_url))
+    pool.get("api/v1/trending", timeout=5)
+    assert server.hits == upstream_pool.FAILURE_THRESHOLD
+
+    # ...and once it has been open long enough, a good answer closes it
+    pool.instances.pop()
+    server.delay = lambda: 0.01
+    time.sleep(0.3)
+    assert instance.available(time.monotonic())
+    assert pool.get("api/v1/trending", timeout=5).status_code == 200
+    assert instance.failures == 0
+    assert instance.available(time.monotonic())
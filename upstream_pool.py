@@ -0,0 +1,226 @@
+import time
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import event_log
+
+# Seconds allowed for an API request to one instance
+REQUEST_TIMEOUT = 15
+# Latency assumed for an instance before it has answered anything
+INITIAL_LATENCY = 1.0
+# Latency samples kept per instance, for its median and hedging deadline
+LATENCY_SAMPLES = 100
+# Percentile of an instance's latency after which a request is hedged;
+# below p95, so an instance that stalls now and then still gets hedged
+HEDGE_PERCENTILE = 0.9
+# Samples needed before the hedging deadline follows that percentile
+MIN_SAMPLES = 5
+# Bounds on how long to wait for one instance before asking another
+MIN_HEDGE_DELAY = 0.05
+MAX_HEDGE_DELAY = 5
+# Consecutive failures that open an instance's circuit
+FAILURE_THRESHOLD = 3
+# Seconds an open circuit keeps requests away from an instance
+OPEN_SECONDS = 30
+# Seconds between health checks of every instance
+HEALTH_INTERVAL = 30
+HEALTH_TIMEOUT = 5
+# Path fetched by the health checks
+HEALTH_PATH = "api/v1/stats"
+# Threads running upstream requests, hedges included
+REQUEST_THREADS = 8
+
+
+class UpstreamUnavailable(Exception):
+    """Raised when no instance could answer a request."""
+
+
+class Instance:
+    """
+    One upstream instance: its recent latencies and its circuit breaker.
+    Instances are ranked by the median of their last LATENCY_SAMPLES
+    latencies, which an occasional stall doesn't move. After
+    FAILURE_THRESHOLD failures in a row the circuit opens and requests go
+    elsewhere for OPEN_SECONDS; then a single request is let through, and
+    its outcome closes or reopens the circuit.
+    """
+
+    def __init__(self, url):
+        self.url = url if url.endswith("/") else url + "/"
+        self.samples = deque(maxlen=LATENCY_SAMPLES)
+        self.failures = 0
+        self.open_until = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def score(self):
+        """The median of the recent latencies."""
+        with self.lock:
+            samples = sorted(self.samples)
+        return samples[len(samples) // 2] if samples else INITIAL_LATENCY
+
+    def available(self, now):
+        return self.failures < FAILURE_THRESHOLD or now >= self.open_until
+
+    def claim(self, now):
+        """Note that a request is being sent; a trial of an open circuit holds it open."""
+        with self.lock:
+            if self.failures >= FAILURE_THRESHOLD:
+                self.open_until = now + OPEN_SECONDS
+
+    def record_success(self, elapsed=None):
+        """Note an answer, and how long it took unless that was noted already."""
+        with self.lock:
+            if elapsed is not None:
+                self.samples.append(elapsed)
+            self.failures = 0
+            self.open_until = 0.0
+
+    def record_latency(self, elapsed):
+        """Note a lower bound on a latency, for a request that lost a hedge."""
+        with self.lock:
+            self.samples.append(elapsed)
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= FAILURE_THRESHOLD:
+                if self.failures == FAILURE_THRESHOLD:
+                    event_log.log("upstream", instance=self.url, circuit="open")
+                self.open_until = time.monotonic() + OPEN_SECONDS
+
+    def hedge_delay(self):
+        """Seconds to wait for this instance before asking another: its p90."""
+        with self.lock:
+            samples = sorted(self.samples)
+        if len(samples) < MIN_SAMPLES:
+            delay = 2 * self.score
+        else:
+            delay = samples[min(len(samples) - 1, int(len(samples) * HEDGE_PERCENTILE))]
+        return min(max(delay, MIN_HEDGE_DELAY), MAX_HEDGE_DELAY)
+
+
+class UpstreamPool:
+    """
+    A set of interchangeable upstream instances. Requests go to the
+    available instance with the fewest recent failures and the lowest
+    median latency. When it hasn't answered by its p90 latency the request
+    is also sent to the next best one, and the first good answer wins; the
+    time the slower ones had taken by then counts as their latency.
+    Failed instances are skipped until their circuit closes, and a
+    background thread checks every instance periodically so their scores
+    stay current when they aren't being used.
+    """
+
+    def __init__(self, urls):
+        self.instances = [Instance(url) for url in urls]
+        self._pool = ThreadPoolExecutor(
+            max_workers=REQUEST_THREADS, thread_name_prefix="upstream"
+        )
+        self._stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Start the health checks; safe to call more than once."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._health_loop, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def best(self):
+        """The instance a new request would go to first."""
+        return self.ranked()[0]
+
+    def ranked(self):
+        """Instances in the order requests try them."""
+        now = time.monotonic()
+        available = [i for i in self.instances if i.available(now)]
+        if not available:
+            # Every circuit is open; try the one closest to closing
+            return sorted(self.instances, key=lambda i: i.open_until)
+        # Instances that failed lately go last, then the fastest first
+        return sorted(available, key=lambda i: (i.failures, i.score))
+
+    def get(self, path, timeout=REQUEST_TIMEOUT, stream=False):
+        """
+        GET path relative to an instance's root from the best instances,
+        hedging as described above, and return the response. With stream,
+        the body is left to be read from the response.
+        """
+        candidates = self.ranked()
+        pending = {}
+        errors = []
+        deadline = None
+        while candidates or pending:
+            if candidates and (not pending or time.monotonic() >= deadline):
+                instance = candidates.pop(0)
+                instance.claim(time.monotonic())
+                # Set once the request lost a hedge and its latency was noted
+                lost = threading.Event()
+                future = self._pool.submit(
+                    self._request, instance, path, timeout, stream, lost
+                )
+                pending[future] = (instance, time.monotonic(), lost)
+                deadline = time.monotonic() + instance.hedge_delay()
+            done, _ = wait(
+                pending,
+                timeout=max(0, deadline - time.monotonic()) if candidates else None,
+                return_when=FIRST_COMPLETED,
+            )
+            for future in done:
+                instance = pending.pop(future)[0]
+                try:
+                    response = future.result()
+                except Exception as e:
+                    errors.append(f"{instance.url}: {e}")
+                    # Ask the next instance now rather than at the deadline
+                    deadline = time.monotonic()
+                    continue
+                # Hedges that lost took at least this long; release their
+                # connections when they are done
+                for loser, (slower, started, lost) in pending.items():
+                    slower.record_latency(time.monotonic() - started)
+                    lost.set()
+                    loser.add_done_callback(_close_response)
+                return response
+        raise UpstreamUnavailable("; ".join(errors) or "no upstream instances")
+
+    def _request(self, instance, path, timeout, stream=False, lost=None):
+        # Imported on first use, it takes longer to load than the whole server
+        import requests
+
+        started = time.monotonic()
+        try:
+            response = requests.get(instance.url + path, timeout=timeout, stream=stream)
+        except requests.RequestException:
+            instance.record_failure()
+            raise
+        if response.status_code >= 500 or response.status_code == 429:
+            response.close()
+            instance.record_failure()
+            raise UpstreamUnavailable(f"returned {response.status_code}")
+        if lost is not None and lost.is_set():
+            instance.record_success()
+        else:
+            instance.record_success(time.monotonic() - started)
+        return response
+
+    def _health_loop(self):
+        while True:
+            for instance in self.instances:
+                if self._stop_event.is_set():
+                    return
+                try:
+                    self._request(instance, HEALTH_PATH, HEALTH_TIMEOUT)
+                except Exception:
+                    pass
+            if self._stop_event.wait(HEALTH_INTERVAL):
+                return
+
+
+def _close_response(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()